@@ -0,0 +1,52 @@
+"""
+Compares the peak memory and the time of a Prometheus scrape response built in one piece with the streamed response,
+for registries of growing size. Run from the root of the repository:
+
+python benchmarks/bench_exposition.py
+"""
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from knotty import exporters, meters, registry
+
+
+def measure(write_response: callable) -> tuple:
+    tracemalloc.start()
+    start = perf_counter()
+    write_response()
+    duration = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, duration
+
+
+def main(series_per_counter: int = 100) -> None:
+    starter = exporters._PrometheusStarter()
+    written = []
+
+    def buffered():
+        written.append(len(starter._metrics_translator().encode("ascii")))
+
+    def streamed():
+        written.append(sum(len(chunk) for chunk in starter._exposition_chunks()))
+
+    print("{0:>8}{1:>16}{2:>16}{3:>14}{4:>14}".format("series", "buffered MiB", "streamed MiB", "buffered ms",
+                                                       "streamed ms"))
+    for counter_count in (10, 100, 1000):
+        registry.MeterRegistry._meters = dict()
+        for index in range(counter_count):
+            counter = registry.MeterRegistry.get_meter("counter_{0}".format(index), meters.Counter)
+            for series in range(series_per_counter):
+                counter.increment(series, (("series", series), ("path", "/some/path/{0}".format(series))))
+        buffered_peak, buffered_time = measure(buffered)
+        streamed_peak, streamed_time = measure(streamed)
+        print("{0:>8}{1:>16.2f}{2:>16.2f}{3:>14.1f}{4:>14.1f}".format(
+            counter_count * series_per_counter, buffered_peak / 2 ** 20, streamed_peak / 2 ** 20, buffered_time * 1e3,
+            streamed_time * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Compares the cost of log calls when log events are counted by patching the Logger methods, as knotty used to, and when
+they are counted by the LogEventHandler on the root logger. Run from the root of the repository:
+
+python benchmarks/bench_logging.py
+"""
+import logging
+import os
+import sys
+from timeit import repeat
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from knotty import core, meters, registry
+
+
+def best_time(call: callable, number: int) -> float:
+    return min(repeat(call, number=number, repeat=5)) / number
+
+
+def measure(logger: logging.Logger, number: int) -> tuple:
+    return (best_time(lambda: logger.debug("disabled %s", 1), number),
+            best_time(lambda: logger.info("enabled %s", 1), number))
+
+
+def main(number: int = 100000) -> None:
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+    # The null handler keeps the enabled calls from falling back to the last resort handler on stderr.
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = True
+    results = dict()
+
+    registry.MeterRegistry._meters = dict()
+    original = {level: getattr(logging.Logger, level) for level in ("debug", "info", "warning", "error")}
+    patched_counter = meters.Counter("patched_log_events")
+    patched_counter.augmentor = lambda self, method, results, *args, **kwargs: self.set_tags({"level": method.__name__})
+    for level, method in original.items():
+        setattr(logging.Logger, level, patched_counter.auto_count_method(method))
+    results["patched Logger methods"] = measure(logger, number)
+    for level, method in original.items():
+        setattr(logging.Logger, level, method)
+
+    root_logger.addHandler(core.LogEventHandler(meters.Counter("handler_log_events")))
+    results["LogEventHandler"] = measure(logger, number)
+
+    print("{0:<26}{1:>14}{2:>14}".format("counting", "disabled ns", "enabled ns"))
+    for name, (disabled, enabled) in results.items():
+        print("{0:<26}{1:>14.0f}{2:>14.0f}".format(name, disabled * 1e9, enabled * 1e9))
+
+
+if __name__ == "__main__":
+    main()
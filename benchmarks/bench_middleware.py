@@ -0,0 +1,108 @@
+"""
+Measures the overhead the WSGI and ASGI middleware add to every request, against the bare applications, and compares
+the Flask instrumentation knotty used before, a Timer with an augmentor that searched the response callbacks for the
+status code, with the WSGIMiddleware. Run from the root of the repository:
+
+python benchmarks/bench_middleware.py
+"""
+import asyncio
+import os
+import sys
+from timeit import repeat
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from knotty import meters, middleware, registry
+import flask
+from flask.wrappers import Response
+from werkzeug.test import EnvironBuilder
+
+ENVIRON = {"REQUEST_METHOD": "GET", "PATH_INFO": "/users/1"}
+
+
+def best_time(call: callable, number: int) -> float:
+    return min(repeat(call, number=number, repeat=5)) / number
+
+
+def start_response(status, headers, exc_info=None):
+    return None
+
+
+def wsgi_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"ok"]
+
+
+def wsgi_request(app: callable) -> None:
+    body = app(ENVIRON, start_response)
+    for _ in body:
+        pass
+    close = getattr(body, "close", None)
+    if close is not None:
+        close()
+
+
+async def asgi_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def send(message):
+    pass
+
+
+def asgi_requests(app: callable, number: int) -> float:
+    scope = {"type": "http", "method": "GET", "path": "/users/1"}
+
+    async def run():
+        for _ in range(number):
+            await app(dict(scope), None, send)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return min(repeat(lambda: loop.run_until_complete(run()), number=1, repeat=5)) / number
+    finally:
+        loop.close()
+
+
+def flask_request(app: flask.Flask, environ_builder: EnvironBuilder) -> None:
+    wsgi_request(lambda environ, start: app.wsgi_app(environ_builder.get_environ(), start))
+
+
+def new_flask_app() -> flask.Flask:
+    app = flask.Flask("benchmark")
+    app.add_url_rule("/users/<int:user_id>", "user", lambda user_id: str(user_id))
+    return app
+
+
+def main(number: int = 20000) -> None:
+    registry.MeterRegistry._meters = dict()
+    results = dict()
+    results["bare WSGI app"] = best_time(lambda: wsgi_request(wsgi_app), number)
+    timed_wsgi_app = middleware.WSGIMiddleware(wsgi_app, "wsgi", route_resolver=lambda environ: "/users/<user_id>")
+    results["WSGIMiddleware"] = best_time(lambda: wsgi_request(timed_wsgi_app), number)
+
+    results["bare ASGI app"] = asgi_requests(asgi_app, number)
+    results["ASGIMiddleware"] = asgi_requests(middleware.ASGIMiddleware(asgi_app, "asgi"), number)
+
+    environ_builder = EnvironBuilder("/users/1")
+    app = new_flask_app()
+    results["bare Flask app"] = best_time(lambda: flask_request(app, environ_builder), number // 10)
+    app = new_flask_app()
+    flask_timer = registry.MeterRegistry.get_meter("flask_timer", meters.Timer)
+    flask_timer.augmentor = lambda self, method, results, *args, **kwargs: self.set_tags(
+        {"path": args[0]["PATH_INFO"], "method": args[0]["REQUEST_METHOD"],
+         "status_code": [response.__self__._status_code for response in results._callbacks
+                         if isinstance(response.__self__, Response)][0]})
+    app.wsgi_app = flask_timer.timer(app.wsgi_app)
+    results["Flask with Timer augmentor"] = best_time(lambda: flask_request(app, environ_builder), number // 10)
+    app = new_flask_app()
+    app.wsgi_app = middleware.WSGIMiddleware(app.wsgi_app, "flask")
+    results["Flask with WSGIMiddleware"] = best_time(lambda: flask_request(app, environ_builder), number // 10)
+
+    print("{0:<30}{1:>14}".format("application", "us/request"))
+    for name, seconds in results.items():
+        print("{0:<30}{1:>14.2f}".format(name, seconds * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Measures how long a checkpoint of the registry takes for registries of growing size, and which share of the default
+checkpoint interval that is. Run from the root of the repository:
+
+python benchmarks/bench_persistence.py
+"""
+import os
+import sys
+import tempfile
+from timeit import repeat
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from knotty import meters, persistence, registry
+
+
+def main(series_per_meter: int = 10) -> None:
+    print("{0:>8}{1:>10}{2:>16}{3:>16}".format("meters", "series", "checkpoint ms", "% of interval"))
+    for meter_count in (100, 1000, 10000):
+        registry.MeterRegistry._meters = dict()
+        for index in range(meter_count):
+            meter = registry.MeterRegistry.get_meter("counter_{0}".format(index), meters.Counter)
+            for series in range(series_per_meter):
+                meter.increment(series, (("series", series),))
+        with tempfile.TemporaryDirectory() as directory:
+            checkpointer = persistence.Checkpointer(os.path.join(directory, "knotty.checkpoint"))
+            duration = min(repeat(checkpointer.checkpoint, number=1, repeat=5))
+            checkpointer.checkpoint_file.close()
+        print("{0:>8}{1:>10}{2:>16.2f}{3:>16.3f}".format(meter_count, meter_count * series_per_meter, duration * 1e3,
+                                                         duration / checkpointer.interval * 100))
+
+
+if __name__ == "__main__":
+    main()
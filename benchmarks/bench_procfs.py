@@ -0,0 +1,39 @@
+"""
+Compares the time the system and process collectors take to collect their metrics when reading /proc directly and when
+going through psutil. Run from the root of the repository on Linux:
+
+python benchmarks/bench_procfs.py
+"""
+import os
+import sys
+from timeit import repeat
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from knotty import collectors, procfs, registry
+
+COLLECTORS = [collectors.ProcessCollector, collectors.ProcessResourceCollector, collectors.SystemCollector,
+              collectors.DiskIOCollector]
+
+
+def best_time(collector: collectors.Collector, number: int) -> float:
+    return min(repeat(collector.collect, number=number, repeat=5)) / number
+
+
+def main(number: int = 2000) -> None:
+    if not procfs.AVAILABLE:
+        print("/proc is not available on this platform, nothing to compare.")
+        return
+    print("{0:<28}{1:>12}{2:>12}{3:>10}".format("collector", "psutil us", "procfs us", "speedup"))
+    for collector_class in COLLECTORS:
+        timings = dict()
+        for use_procfs in (False, True):
+            registry.MeterRegistry._meters = dict()
+            collector_class.use_procfs = use_procfs
+            timings[use_procfs] = best_time(collector_class(), number)
+        collector_class.use_procfs = procfs.AVAILABLE
+        print("{0:<28}{1:>12.1f}{2:>12.1f}{3:>9.1f}x".format(collector_class.__name__, timings[False] * 1e6,
+                                                             timings[True] * 1e6, timings[False] / timings[True]))
+
+
+if __name__ == "__main__":
+    main()
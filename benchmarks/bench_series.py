@@ -0,0 +1,48 @@
+"""
+Measures what recording into a Counter and a Timer costs per call, and how much memory every series of a Timer takes.
+Run from the root of the repository:
+
+python benchmarks/bench_series.py
+"""
+import os
+import sys
+import tracemalloc
+from timeit import repeat
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from knotty import meters, registry
+
+
+def _per_call(statement: callable, number: int = 100000) -> float:
+    return min(repeat(statement, number=number, repeat=5)) / number * 1e9
+
+
+def main(series_count: int = 100000) -> None:
+    registry.MeterRegistry._meters = dict()
+    counter = meters.Counter("bench_counter")
+    timer = meters.Timer("bench_timer")
+    timed = timer.timer(lambda: None)
+    tags = (("route", "/users/<int:user_id>"), ("method", "GET"), ("status_code", 200))
+
+    print("{0:<40}{1:>8}".format("recording", "ns"))
+    print("{0:<40}{1:>8.0f}".format("Counter.increment", _per_call(counter.increment)))
+    print("{0:<40}{1:>8.0f}".format("Counter.increment with a metric key",
+                                    _per_call(lambda: counter.increment(1, tags))))
+    print("{0:<40}{1:>8.0f}".format("Timer decorated call", _per_call(timed)))
+    print("{0:<40}{1:>8.0f}".format("Timer._record with a metric key", _per_call(lambda: timer._record(tags, 1000))))
+
+    registry.MeterRegistry._meters = dict()
+    timer = meters.Timer("bench_series_timer")
+    keys = [tags + (("user", index),) for index in range(series_count)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for key in keys:
+        timer._record(key, 1000)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    print("{0:<40}{1:>8.0f}".format("bytes per Timer series", allocated / series_count))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ The __init__ file for Knotty is responsible initiating the monitors handled by t
 from knotty import core
 
 
-__all__ = ["core", "exporters", "meters", "registry"]
+__all__ = ["adapters", "agent", "collectors", "core", "exporters", "loops", "meters", "middleware", "persistence",
+           "procfs", "registry", "remote_write", "reservoirs", "snapshots"]
 
 core.Knotty.initiate_monitors()
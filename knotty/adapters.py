@@ -0,0 +1,195 @@
+"""
+This module instruments the HTTP clients built on requests and urllib3. Requests are timed at the HTTPAdapter level,
+which every requests.Session sends through, so calls made with a session are timed as well as calls made with the
+functions of requests.api. Every request is tagged by the host it went to and by a template of its path, eg
+"/users/{id}/orders" for "/users/42/orders?page=2", so query strings and identifiers do not create new series.
+
+The urllib3 connection pools of the instrumented adapters are exported by a ConnectionPoolCollector: the idle and the
+checked out connections of every pool, its size, and how many checkouts and new connections it has seen. A pool whose
+checked out connections reach its size makes requests wait or open connections that are thrown away afterwards, which
+shows up as a growing number of created connections.
+"""
+import re
+from functools import wraps
+from time import perf_counter_ns
+from urllib.parse import urlsplit
+from weakref import WeakSet
+from knotty import collectors, meters, registry
+
+_uuid_segment = re.compile(r"[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}")
+_hash_segment = re.compile(r"[0-9a-fA-F]{16,}")
+_token_segment = re.compile(r"(?=.*[0-9])[0-9a-zA-Z_\-.~]{24,}")
+
+
+def template_path(path: str) -> str:
+    """
+    Replaces the segments of a path that look like identifiers with placeholders: numbers with {id}, UUIDs with {uuid},
+    long hexadecimal strings with {hash} and other long tokens that contain digits with {token}.
+
+    :param path: str: The path of a URL, without the query string
+    :return: str
+    """
+    segments = path.split("/")
+    for index, segment in enumerate(segments):
+        if not segment:
+            continue
+        if segment.isdigit():
+            segments[index] = "{id}"
+        elif _uuid_segment.fullmatch(segment):
+            segments[index] = "{uuid}"
+        elif _hash_segment.fullmatch(segment):
+            segments[index] = "{hash}"
+        elif _token_segment.fullmatch(segment):
+            segments[index] = "{token}"
+    return "/".join(segments)
+
+
+def _host_tag(host: str, port: int, scheme: str) -> str:
+    """
+    Formats a host the same way for requests and for connection pools, leaving out the default port of the scheme.
+
+    :return: str
+    """
+    if port is None or (scheme, port) in (("http", 80), ("https", 443)):
+        return host
+    return "{0}:{1}".format(host, port)
+
+
+class ConnectionPoolCollector(collectors.Collector):
+    """
+    Collects the state of the urllib3 connection pools of a set of requests adapters, including the pools of their
+    proxy managers, tagged by the host each pool connects to.
+
+    :param name: str: The prefix of the metric names
+    """
+    def __init__(self, name: str = "requests_http_pool"):
+        super().__init__(name)
+        self.adapters = WeakSet()
+
+    def _pools(self) -> list:
+        pools = []
+        for adapter in list(self.adapters):
+            pool_managers = [getattr(adapter, "poolmanager", None)]
+            pool_managers += getattr(adapter, "proxy_manager", {}).values()
+            for pool_manager in pool_managers:
+                if pool_manager is None:
+                    continue
+                with pool_manager.pools.lock:
+                    pools += pool_manager.pools._container.values()
+        return pools
+
+    def collect(self) -> [meters.Metric]:
+        key = self._base_key()
+        metrics = []
+        for pool in self._pools():
+            queue = pool.pool
+            if queue is None:
+                # The pool has been closed.
+                continue
+            pool_key = key + (("host", _host_tag(pool.host, pool.port, pool.scheme)),)
+            idle = sum(1 for connection in list(queue.queue) if connection is not None)
+            metrics += [meters.Metric(self.name + "_idle_connections", pool_key, idle, "gauge"),
+                        meters.Metric(self.name + "_checked_out_connections", pool_key,
+                                      max(queue.maxsize - queue.qsize(), 0), "gauge"),
+                        meters.Metric(self.name + "_max_connections", pool_key, queue.maxsize, "gauge"),
+                        meters.Metric(self.name + "_checkouts_total", pool_key, pool.num_requests, "counter"),
+                        meters.Metric(self.name + "_connections_created_total", pool_key, pool.num_connections,
+                                      "counter")]
+        return metrics
+
+
+class RequestsInstrumentation:
+    """
+    Times every request sent through a requests HTTPAdapter in the Timer <name>, tagged by host, path template, method
+    and status code. Requests that fail without a response are tagged with the name of the exception instead of a
+    status code. The adapters that send requests are tracked by the ConnectionPoolCollector <name>_pool.
+
+    The host and path template of every URL and the series ID of every combination of tags are cached, the caches are
+    cleared when they grow past max_cached_urls entries.
+
+    :param name: str: The name of the Timer
+    :param path_templater: callable(path) that returns the template of a path, see template_path
+    :param max_cached_urls: int: The number of URLs and series IDs to keep the templates of
+    """
+    def __init__(self, name: str = "requests_http", path_templater: callable = template_path,
+                 max_cached_urls: int = 10000):
+        self.timer = registry.MeterRegistry.get_meter(name, meters.Timer)
+        self.pool_collector = registry.MeterRegistry.get_meter(name + "_pool", ConnectionPoolCollector)
+        self.path_templater = path_templater
+        self._max_cached_urls = max_cached_urls
+        self._urls = dict()
+        self._series_ids = meters.SeriesIdCache(max_cached_urls)
+        self._instrumented = None
+
+    def _url_tags(self, url: str) -> tuple:
+        tags = self._urls.get(url)
+        if tags is None:
+            if len(self._urls) >= self._max_cached_urls:
+                self._urls.clear()
+            parts = urlsplit(url)
+            tags = self._urls[url] = (_host_tag(parts.hostname, parts.port, parts.scheme),
+                                      self.path_templater(parts.path or "/"))
+        return tags
+
+    def _series_for(self, key: tuple) -> int:
+        url, method, status_code = key
+        host, path = self._url_tags(url)
+        return self.timer._series_id({"host": host, "path": path, "method": method, "status_code": status_code})
+
+    def _record(self, url: str, method: str, status_code, execution_time: int) -> None:
+        """
+        Records a finished request.
+
+        :param url: str: The URL the request was sent to
+        :param method: str: The request method
+        :param status_code: The status code of the response, or the name of the exception raised instead
+        :param execution_time: int: Nanoseconds the request took
+        :return:
+        """
+        self.timer._record_series(self._series_ids.get((url, method, status_code), self._series_for), execution_time)
+
+    def wrap_send(self, send: callable) -> callable:
+        """
+        Wraps the send method of an HTTPAdapter class so that every request it sends is timed.
+
+        :param send: The function that implements the send method
+        :return: callable
+        """
+        @wraps(send)
+        def timed_send(adapter, request, *args, **kwargs):
+            self.pool_collector.adapters.add(adapter)
+            start = perf_counter_ns()
+            try:
+                response = send(adapter, request, *args, **kwargs)
+            except Exception as e:
+                self._record(request.url, request.method, e.__class__.__name__, perf_counter_ns() - start)
+                raise
+            self._record(request.url, request.method, response.status_code, perf_counter_ns() - start)
+            return response
+
+        return timed_send
+
+    def instrument(self, adapter_class: type = None) -> None:
+        """
+        Starts timing the requests of every adapter of the given class, requests.adapters.HTTPAdapter by default.
+
+        :param adapter_class: The HTTPAdapter class to instrument
+        :return:
+        """
+        if adapter_class is None:
+            from requests.adapters import HTTPAdapter
+            adapter_class = HTTPAdapter
+        self.uninstrument()
+        self._instrumented = (adapter_class, adapter_class.send)
+        adapter_class.send = self.wrap_send(adapter_class.send)
+
+    def uninstrument(self) -> None:
+        """
+        Restores the send method of the instrumented adapter class.
+
+        :return:
+        """
+        if self._instrumented is not None:
+            adapter_class, send = self._instrumented
+            adapter_class.send = send
+            self._instrumented = None
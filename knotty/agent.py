@@ -0,0 +1,126 @@
+"""
+This module holds the knotty agent, a process that collects the metrics of every Python process on a host that uses
+the AgentExporter, and exports them from a single place. This avoids running an exporter thread, and possibly an http
+server, in each of many short lived or pre-forked processes. Start it with:
+
+python -m knotty.agent --socket /tmp/knotty.sock --port 2091
+
+The processes send the deltas of their meters as batches of snapshots (see knotty.snapshots), which the agent merges
+into its own registry. The agent then exports that registry like any other application would, by default through a
+PrometheusExporter and optionally through a PushgatewayExporter.
+"""
+import os
+import socket
+import stat
+from argparse import ArgumentParser
+from logging import getLogger
+from threading import Thread
+from knotty import exporters, registry, snapshots
+
+
+class KnottyAgent:
+    """
+    Receives batches of meter snapshots over a Unix domain socket, or over UDP when an address is given, and merges them
+    into the MeterRegistry of this process. A stale socket file left behind by a previous agent is replaced.
+    """
+    _logger = getLogger(__name__)
+
+    def __init__(self, socket_path: str = exporters.AgentExporter.default_socket_path, address: tuple = None,
+                 max_datagram_size: int = 65536):
+        self._max_datagram_size = max_datagram_size
+        if address:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.bind(address)
+        else:
+            if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                os.unlink(socket_path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(socket_path)
+        self._address = self._socket.getsockname()
+        self._thread = None
+
+    @property
+    def address(self):
+        """
+        The path of the Unix domain socket, or the (host, port) the agent is bound to.
+        """
+        return self._address
+
+    def receive(self) -> int:
+        """
+        Waits for a single batch and merges its snapshots into the registry. Snapshots that can not be merged are logged
+        and skipped, so that one bad meter does not cost the rest of the batch.
+
+        :return: int: The number of snapshots merged
+        """
+        batch = self._socket.recv(self._max_datagram_size)
+        merged = 0
+        for snapshot in snapshots.unpack_batch(batch):
+            try:
+                registry.MeterRegistry.merge_snapshot(snapshot)
+                merged += 1
+            except Exception as e:
+                self._logger.error(e)
+        return merged
+
+    def serve_forever(self) -> None:
+        """
+        Receives and merges batches until the process exits.
+
+        :return:
+        """
+        self._logger.debug("Knotty agent listening on {0}".format(self._address))
+        while True:
+            try:
+                self.receive()
+            except Exception as e:
+                self._logger.error(e)
+
+    def start(self) -> None:
+        """
+        Runs serve_forever in a background thread.
+
+        :return:
+        """
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._socket.close()
+        if isinstance(self._address, str) and os.path.exists(self._address):
+            os.unlink(self._address)
+
+
+def main(arguments: [str] = None) -> None:
+    """
+    The entry point of the agent, see python -m knotty.agent --help.
+
+    :param arguments: [str]: The command line arguments, defaults to sys.argv
+    :return:
+    """
+    parser = ArgumentParser(prog="knotty-agent", description="Collects and exports the metrics of the knotty "
+                                                             "processes running on this host.")
+    parser.add_argument("--socket", default=exporters.AgentExporter.default_socket_path,
+                        help="The Unix domain socket to listen on")
+    parser.add_argument("--udp", metavar="HOST:PORT", help="Listen on UDP instead of a Unix domain socket")
+    parser.add_argument("--host", default="0.0.0.0", help="The address of the metrics endpoint")
+    parser.add_argument("--port", type=int, default=2091, help="The port of the metrics endpoint")
+    parser.add_argument("--path", default="/metrics", help="The path of the metrics endpoint")
+    parser.add_argument("--pushgateway", help="Also push the metrics to this Pushgateway")
+    parser.add_argument("--push-interval", type=int, default=15, help="The Pushgateway push interval in seconds")
+    parser.add_argument("--job-name", help="The Pushgateway job name")
+    options = parser.parse_args(arguments)
+
+    address = None
+    if options.udp:
+        host, _, port = options.udp.rpartition(":")
+        address = (host or "0.0.0.0", int(port))
+    agent = KnottyAgent(socket_path=options.socket, address=address)
+    exporters.PrometheusExporter(server_name=options.host, port=options.port, path=options.path)
+    if options.pushgateway:
+        exporters.PushgatewayExporter(options.push_interval, options.pushgateway, job_name=options.job_name)
+    agent.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
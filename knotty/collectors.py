@@ -0,0 +1,244 @@
+"""
+This module holds the Collector, a meter that produces many metrics from a single measurement, along with the
+collectors behind the system and process monitors started by knotty.core. Where a Gauge calls its function for a
+single series, a Collector takes one snapshot of whatever it is measuring, eg a single psutil Process.oneshot(), and
+turns it into every metric it can provide. Collectors are registered with the MeterRegistry like any other meter.
+
+On Linux the system and process collectors read /proc directly (see knotty.procfs), elsewhere they use psutil. Set
+use_procfs to False on a collector class before it is created to always use psutil.
+"""
+from collections import deque
+from logging import getLogger
+from time import perf_counter_ns
+from knotty import meters, procfs, registry
+import gc
+import sys
+import psutil
+
+
+class Collector(meters.BaseMeter):
+    """
+    Base class for all collectors. Subclasses implement collect, which takes a measurement and returns all of the
+    metrics derived from it. The name of a collector should be a prefix of the names of its metrics, so that filtered
+    collections can find it (see MeterRegistry.find_meters). Collectors do not support snapshots, the knotty agent runs
+    collectors of its own.
+    """
+    logger = getLogger(__name__)
+    use_procfs = procfs.AVAILABLE
+
+    def __init__(self, name: str):
+        self._name = name
+        self._ensure_registered_with_registry()
+
+    def _base_key(self) -> tuple:
+        return tuple(self.get_tags().items())
+
+    def collect(self) -> [meters.Metric]:
+        """
+        Takes a measurement and translates it into metrics.
+
+        :return: [Metric]
+        """
+        raise NotImplementedError("Class {0} has not implemented the collect function.".format(self.__class__))
+
+    def series_keys(self):
+        return None
+
+    async def get_metrics(self) -> [meters.Metric]:
+        """
+        Returns the collected metrics, or no metrics at all if the measurement failed.
+
+        :return: [Metric]
+        """
+        try:
+            return self.collect()
+        except Exception as e:
+            self.logger.error(e)
+            return []
+
+
+class ProcessCollector(Collector):
+    """
+    Collects the CPU and memory percentage and the thread count of the current process, from a single read of
+    /proc/self/stat on Linux or from a single oneshot snapshot elsewhere.
+    """
+    def __init__(self, name: str = "process"):
+        self._process = psutil.Process()
+        self._reader = procfs.ProcessReader() if self.use_procfs else None
+        super().__init__(name)
+        self.add_tags({"pid": self._process.pid.real})
+
+    def collect(self) -> [meters.Metric]:
+        key = self._base_key()
+        if self._reader is not None:
+            cpu_percent, memory_percent, thread_count = self._reader.stat()
+        else:
+            with self._process.oneshot():
+                cpu_percent = self._process.cpu_percent()
+                memory_percent = self._process.memory_percent()
+                thread_count = self._process.num_threads()
+        return [meters.Metric("process_cpu_percentage", key, cpu_percent, "gauge"),
+                meters.Metric("process_memory_percentage", key, memory_percent, "gauge"),
+                meters.Metric("process_thread_count", key, thread_count, "gauge")]
+
+
+class ProcessResourceCollector(Collector):
+    """
+    Collects the open file count and the full memory info of the current process. These are expensive to measure, eg
+    the full memory info reads the memory maps of the process, so this collector is usually given a collection interval.
+    """
+    def __init__(self, name: str = "process"):
+        self._process = psutil.Process()
+        self._reader = procfs.ProcessReader() if self.use_procfs else None
+        super().__init__(name)
+        self.add_tags({"pid": self._process.pid.real})
+
+    def collect(self) -> [meters.Metric]:
+        key = self._base_key()
+        if self._reader is not None:
+            open_file_count = self._reader.open_file_count()
+            memory_info = self._reader.memory_full_info()
+        else:
+            with self._process.oneshot():
+                open_file_count = len(self._process.open_files())
+                memory_info = self._process.memory_full_info()
+            memory_info = zip(memory_info._fields, memory_info)
+        return [meters.Metric("process_open_file_count", key, open_file_count, "gauge")] + \
+            [meters.Metric("process_memory_info", key + (("memory_type", field),), value, "gauge")
+             for field, value in memory_info]
+
+
+class SystemCollector(Collector):
+    """
+    Collects the CPU percentage, the virtual memory statistics and the network io counters of the host.
+    """
+    def __init__(self, name: str = "system"):
+        self._reader = procfs.SystemReader() if self.use_procfs else None
+        super().__init__(name)
+
+    def collect(self) -> [meters.Metric]:
+        key = self._base_key()
+        if self._reader is not None:
+            memory = self._reader.virtual_memory()
+        else:
+            memory = psutil.virtual_memory()
+            memory = zip(memory._fields, memory)
+        network = psutil.net_io_counters()
+        return [meters.Metric("system_cpu_percentage", key, psutil.cpu_percent(), "gauge")] + \
+            [meters.Metric("system_memory_stats", key + (("stat", field),), value, "gauge")
+             for field, value in memory] + \
+            [meters.Metric("system_network_io_stats", key + (("stat", field),), value, "gauge")
+             for field, value in zip(network._fields, network)]
+
+
+class DiskIOCollector(Collector):
+    """
+    Collects the io counters of all disks of the host.
+    """
+    def __init__(self, name: str = "disk_io"):
+        self._reader = procfs.SystemReader() if self.use_procfs else None
+        super().__init__(name)
+
+    def collect(self) -> [meters.Metric]:
+        key = self._base_key()
+        if self._reader is not None:
+            counters = self._reader.disk_io_counters()
+        else:
+            counters = psutil.disk_io_counters()
+            counters = zip(counters._fields, counters)
+        return [meters.Metric("disk_io_stats", key + (("stat", field),), value, "gauge") for field, value in counters]
+
+
+class DiskSpaceCollector(Collector):
+    """
+    Collects the total and the used space of every mounted partition, scanning the partitions and querying the usage of
+    each of them once for both. Mount points that can not be queried are left out.
+    """
+    def __init__(self, name: str = "disk_space"):
+        super().__init__(name)
+
+    def collect(self) -> [meters.Metric]:
+        key = self._base_key()
+        totals = []
+        used = []
+        for partition in psutil.disk_partitions():
+            try:
+                usage = psutil.disk_usage(partition.mountpoint)
+            except OSError:
+                continue
+            mount_key = key + (("mount_point", partition.mountpoint),)
+            totals.append(meters.Metric("disk_space_total", mount_key, usage.total, "gauge"))
+            used.append(meters.Metric("disk_space_used", mount_key, usage.used, "gauge"))
+        return totals + used
+
+
+class RuntimeCollector(Collector):
+    """
+    Collects the state of the Python runtime: the number of collections the garbage collector ran and the objects it
+    collected or found uncollectable per generation, the number of objects tracked by each generation (gc.get_count)
+    and the number of allocated memory blocks (sys.getallocatedblocks).
+
+    The collector also registers a callback in gc.callbacks that measures the duration of every collection for the
+    LatencyHistogram <name>_gc_pause, tagged by generation. A collection can run while the thread it runs on holds the
+    lock of the histogram, eg while it is being drained, so the callback never records into the histogram itself. It
+    only reads the clock and appends the pause to a buffer of its generation, which holds at most max_pending_pauses
+    pauses, and the buffers are folded into the histogram before it is collected, drained or snapshotted. Call stop to
+    remove the callback.
+    """
+    max_pending_pauses = 10000
+
+    def __init__(self, name: str = "python"):
+        super().__init__(name)
+        self.pause_histogram = registry.MeterRegistry.get_meter(name + "_gc_pause", meters.LatencyHistogram)
+        base_key = tuple(self.pause_histogram.get_tags().items())
+        self._generation_keys = [base_key + (("generation", generation),) for generation in range(3)]
+        self._pending_pauses = [deque(maxlen=self.max_pending_pauses) for _ in range(3)]
+        self._collection_start = None
+        self.pause_histogram._fold_pending = self._fold_pauses
+        gc.callbacks.append(self._gc_callback)
+
+    def _gc_callback(self, phase: str, info: dict) -> None:
+        if phase == "start":
+            self._collection_start = perf_counter_ns()
+        elif self._collection_start is not None:
+            self._pending_pauses[info["generation"]].append(perf_counter_ns() - self._collection_start)
+            self._collection_start = None
+
+    def _fold_pauses(self) -> None:
+        """
+        Records the buffered pauses into the pause histogram. Only the pauses buffered when a generation is folded are
+        taken from its buffer, the callback may append more meanwhile.
+
+        :return:
+        """
+        for key, pauses in zip(self._generation_keys, self._pending_pauses):
+            if pauses:
+                self.pause_histogram.record_many([pauses.popleft() for _ in range(len(pauses))], key)
+
+    def stop(self) -> None:
+        """
+        Removes the garbage collector callback and records the pauses it buffered, no more pauses are recorded
+        afterwards.
+
+        :return:
+        """
+        if self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
+        self._fold_pauses()
+        if self.pause_histogram._fold_pending == self._fold_pauses:
+            self.pause_histogram._fold_pending = None
+
+    def collect(self) -> [meters.Metric]:
+        self._fold_pauses()
+        key = self._base_key()
+        metrics = []
+        for generation, (stats, tracked) in enumerate(zip(gc.get_stats(), gc.get_count())):
+            generation_key = key + (("generation", generation),)
+            metrics += [meters.Metric(self.name + "_gc_collections_total", generation_key, stats["collections"],
+                                      "counter"),
+                        meters.Metric(self.name + "_gc_objects_collected_total", generation_key, stats["collected"],
+                                      "counter"),
+                        meters.Metric(self.name + "_gc_objects_uncollectable_total", generation_key,
+                                      stats["uncollectable"], "counter"),
+                        meters.Metric(self.name + "_gc_objects_tracked", generation_key, tracked, "gauge")]
+        return metrics + [meters.Metric(self.name + "_allocated_blocks", key, sys.getallocatedblocks(), "gauge")]
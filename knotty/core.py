@@ -4,9 +4,8 @@ start all application monitors at runtime. The module also provides a few conven
 with minimal effort.
 """
 
-from knotty import meters, registry
-import psutil
-from logging import Logger, getLogger
+from knotty import meters, registry, collectors, middleware, adapters
+from logging import Handler, LogRecord, Logger, getLogger
 import sys
 from os import getenv
 
@@ -27,8 +26,59 @@ def histogram(name) -> meters.Histogram:
     return registry.MeterRegistry.get_meter(name, meters.Histogram)
 
 
+def meter(name) -> meters.Meter:
+    return registry.MeterRegistry.get_meter(name, meters.Meter)
+
+
+def latency_histogram(name) -> meters.LatencyHistogram:
+    return registry.MeterRegistry.get_meter(name, meters.LatencyHistogram)
+
+
+class LogEventHandler(Handler):
+    """
+    Counts the log records that reach it, by level and by logger name. Knotty does not attach it to any logger, since a
+    handler on the root logger would count as configuring logging, see Knotty._start_std_lib_monitoring, but it can be
+    added to a logger to count the records that logger handles. Calls for disabled levels are dropped by the logger
+    before they get here and cost nothing extra. The series ID of every level and logger name is kept in a
+    meters.SeriesIdCache.
+
+    :param log_counter: The Counter to count the records in
+    :param logger_depth: int: The number of components of the logger name to tag by, eg 1 tags "urllib3.connectionpool"
+        as "urllib3". 0 leaves the logger name out.
+    """
+    def __init__(self, log_counter: meters.Counter, logger_depth: int = 1):
+        super().__init__()
+        self._counter = log_counter
+        self._logger_depth = logger_depth
+        self._series_ids = meters.SeriesIdCache()
+
+    def _series_for(self, key: tuple) -> int:
+        level_name, logger_name = key
+        tags = {"level": level_name.lower()}
+        if self._logger_depth:
+            tags["logger"] = ".".join(logger_name.split(".")[:self._logger_depth])
+        return self._counter._series_id(tags)
+
+    def handle(self, record: LogRecord) -> bool:
+        """
+        Counts the record. Counting does not need the lock that Handler.handle takes around emit, nor the filters.
+
+        :param record: logging.LogRecord
+        :return: bool
+        """
+        self._counter._add(self._series_ids.get((record.levelname, record.name), self._series_for), 1)
+        return True
+
+    def emit(self, record: LogRecord) -> None:
+        self.handle(record)
+
+
 class Knotty:
     exclusions = getenv("KNOTTY_EXCLUDE") or []
+    expensive_monitor_interval = float(getenv("KNOTTY_EXPENSIVE_MONITOR_INTERVAL") or 30)
+    checkpoint_path = getenv("KNOTTY_CHECKPOINT_PATH")
+    _requests_instrumentation = None
+    _call_handlers = None
 
     @classmethod
     def _check_library_monitor_status(cls, library_name: str) -> bool:
@@ -39,69 +89,55 @@ class Knotty:
     @classmethod
     def _start_system_monitors(cls) -> None:
         """
-        This function starts a number of monitors for system level metrics. Most of these are gathered using the psutil
-        package. The metrics gathered here are still subject to changes as the package is developed.
+        This function starts a number of monitors for system level metrics. These are gathered using the psutil package
+        through the collectors of knotty.collectors, each of which takes a single measurement for all of its metrics.
+        The metrics gathered here are still subject to changes as the package is developed. The monitors that are
+        expensive to measure, such as the disk space and the full memory info, are only collected once every
+        expensive_monitor_interval seconds (environment variable KNOTTY_EXPENSIVE_MONITOR_INTERVAL).
         :return:
         """
         logger = getLogger(f"{cls.__name__}._start_system_monitors")
         logger.debug("Knotty starting system and process level monitoring.")
 
-        process = psutil.Process()
-        process_cpu_gauge = gauge("process_cpu_percentage")
-        process_cpu_gauge.add_tags({"pid": process.pid.real})
-        process_cpu_gauge.set_gauge_function(process.cpu_percent)
-
-        system_cpu_gauge = gauge("system_cpu_percentage")
-        system_cpu_gauge.set_gauge_function(psutil.cpu_percent)
+        registry.MeterRegistry.get_meter("process", collectors.ProcessCollector)
+        registry.MeterRegistry.get_meter("process", collectors.ProcessResourceCollector) \
+            .set_collection_interval(cls.expensive_monitor_interval)
+        registry.MeterRegistry.get_meter("system", collectors.SystemCollector)
+        registry.MeterRegistry.get_meter("disk_io", collectors.DiskIOCollector)
+        registry.MeterRegistry.get_meter("disk_space", collectors.DiskSpaceCollector) \
+            .set_collection_interval(cls.expensive_monitor_interval)
 
-        process_memory_gauge = gauge("process_memory_percentage")
-        process_memory_gauge.add_tags({"pid": process.pid.real})
-        process_memory_gauge.set_gauge_function(process.memory_percent)
-
-        process_thread_gauge = gauge("process_thread_count")
-        process_thread_gauge.add_tags({"pid": process.pid.real})
-        process_thread_gauge.set_gauge_function(process.num_threads)
-
-        process_files_gauge = gauge("process_open_file_count")
-        process_files_gauge.add_tags({"pid": process.pid.real})
-        process_files_gauge.set_gauge_function(lambda: len(process.open_files()))
-
-        process_mem_info_gauge = gauge("process_memory_info")
-        process_mem_info_gauge.add_tags({"pid": process.pid.real})
-        process_mem_info_gauge.set_gauge_function(lambda: process.memory_full_info()._asdict(), key_tag="memory_type")
-
-        disk_total_gauge = gauge("disk_space_total")
-        disk_total_gauge.set_gauge_function(lambda: {part.mountpoint: psutil.disk_usage(part.mountpoint).total
-                                                     for part in psutil.disk_partitions()}, key_tag="mount_point")
-
-        disk_used_gauge = gauge("disk_space_used")
-        disk_used_gauge.set_gauge_function(lambda: {part.mountpoint: psutil.disk_usage(part.mountpoint).used
-                                                    for part in psutil.disk_partitions()}, key_tag="mount_point")
-
-        disk_io_gauge = gauge("disk_io_stats")
-        disk_io_gauge.set_gauge_function(lambda: psutil.disk_io_counters()._asdict(), key_tag="stat")
-
-        system_memory_gauge = gauge("system_memory_stats")
-        system_memory_gauge.set_gauge_function(lambda: psutil.virtual_memory()._asdict(), key_tag="stat")
-
-        system_network_gauge = gauge("system_network_io_stats")
-        system_network_gauge.set_gauge_function(lambda: psutil.net_io_counters()._asdict(), key_tag="stat")
+    @classmethod
+    def _start_runtime_monitors(cls) -> None:
+        """
+        This function starts the monitors of the Python runtime itself, the garbage collector pauses, collections and
+        tracked objects as well as the allocated memory blocks.
+        :return:
+        """
+        logger = getLogger(f"{cls.__name__}._start_runtime_monitors")
+        logger.debug("Knotty starting Python runtime monitoring.")
+        registry.MeterRegistry.get_meter("python", collectors.RuntimeCollector)
 
     @classmethod
     def _start_std_lib_monitoring(cls) -> None:
         """
         The function will be responsible for setting up monitors for any functionality in the standard library. This
-        will continue to grow as development continues.
+        will continue to grow as development continues. Log events are counted by a LogEventHandler that
+        Logger.callHandlers passes every emitted record to before the handlers of the logger. No handler is added to the
+        root logger, so logging.basicConfig and logging.lastResort keep working as if Knotty was not imported.
         :return:
         """
         logger = getLogger(f"{cls.__name__}._start_std_lib_monitoring")
-        logging_counter = counter("logback_events_count")
+        log_event_handler = LogEventHandler(counter("logback_events_count"))
+        if cls._call_handlers is None:
+            cls._call_handlers = Logger.callHandlers
+        call_handlers = cls._call_handlers
+
+        def count_and_call_handlers(self, record):
+            log_event_handler.handle(record)
+            call_handlers(self, record)
 
-        logging_counter.augmentor = lambda self, method, results, *args, **kwargs: self.set_tags({"level": method.__name__})
-        Logger.info = logging_counter.auto_count_method(Logger.info)
-        Logger.warning = logging_counter.auto_count_method(Logger.warning)
-        Logger.error = logging_counter.auto_count_method(Logger.error)
-        Logger.debug = logging_counter.auto_count_method(Logger.debug)
+        Logger.callHandlers = count_and_call_handlers
         logger.debug("Knotty started standard library monitoring.")
 
     @classmethod
@@ -110,7 +146,9 @@ class Knotty:
         This function will maintain a list of monitors for third party packages. It will check for the presence of the
         libraries in the registered system modules, and if found we will wrap the functionality the appropriate meter
         and provide a useful augmentor. The environment variable KNOTTY_EXCLUDE can be used to create a comma separated
-        list of libraries to exclude from monitoring.
+        list of libraries to exclude from monitoring. Flask applications are timed by a WSGIMiddleware, which tags the
+        requests by their route template, and requests is instrumented at the HTTPAdapter level so that sessions are
+        timed too, see knotty.adapters.
         :return:
         """
         logger = getLogger(f"{cls.__name__}._start_third_party_lib_monitors")
@@ -118,35 +156,32 @@ class Knotty:
 
         if cls._check_library_monitor_status("requests"):
             logger.debug("Knotty discovered requests, adding metrics.")
-            import requests
-            request_timer = timer("requests_http")
-            request_timer.augmentor = lambda self, method, results, *args, **kwargs: self.set_tags({"url": args[1],
-                                                                                                    "method": args[0],
-                                                                                                    "status_code": results.status_code})
-            requests.api.request = request_timer.timer(requests.api.request)
+            if cls._requests_instrumentation is not None:
+                cls._requests_instrumentation.uninstrument()
+            cls._requests_instrumentation = adapters.RequestsInstrumentation("requests_http")
+            cls._requests_instrumentation.instrument()
 
         if cls._check_library_monitor_status("flask") or cls._check_library_monitor_status("Flask"):
             logger.debug("Knotty discovered flask, adding metrics.")
             from flask import Flask
-            from flask.wrappers import Response
-            flask_timer = timer("flask_http_request")
-            flask_timer.augmentor = lambda self, method, results, *args, **kwargs: self.set_tags({"path": args[1]["PATH_INFO"],
-                                                                                                  "method": args[1]["REQUEST_METHOD"],
-                                                                                                  "status_code": [response.__self__._status_code
-                                                                                                                  for response in results._callbacks
-                                                                                                                  if isinstance(response.__self__, Response)][0]})
-            Flask.wsgi_app = flask_timer.timer(Flask.wsgi_app)
+            flask_middleware = middleware.WSGIMiddleware(name="flask_http_request")
+            Flask.wsgi_app = flask_middleware.wrap_method(Flask.wsgi_app)
 
     @classmethod
     def initiate_monitors(cls) -> None:
         """
         Simple function to make sure that all automatically registered meters have been created. This function should be
         called through the __init__ file of the package, however it is also left publicly accessible in the event that
-        you cannot start your code with a guarantee that Knotty will be the last package loaded.
+        you cannot start your code with a guarantee that Knotty will be the last package loaded. When the environment
+        variable KNOTTY_CHECKPOINT_PATH is set, the totals of the Counters and Timers are checkpointed to that file and
+        restored from it when the process starts again, see MeterRegistry.enable_persistence.
         :return:
         """
         logger = getLogger(f"{cls.__name__}.initiate_monitors")
         logger.debug("Knotty initiating.")
+        if cls.checkpoint_path:
+            registry.MeterRegistry.enable_persistence(cls.checkpoint_path)
         cls._start_std_lib_monitoring()
         cls._start_system_monitors()
+        cls._start_runtime_monitors()
         cls._start_third_party_lib_monitors()
@@ -1,21 +1,49 @@
-from knotty import registry
+from knotty import registry, meters, snapshots, remote_write
 import requests
 import time
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock, local
 from uuid import uuid4
 from base64 import urlsafe_b64encode
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from logging import getLogger
 import pickle
+import json
+from urllib.parse import urlsplit, parse_qs
 import socket
 import struct
+import errno
+import atexit
+from collections import deque
+from queue import Queue, Full
 
 
 class Exporter:
     """
-    Base class for all exporters.
+    Base class for all exporters. Exporters that push their metrics collect them from the registry batch by batch and
+    send them in chunks of at most chunk_size metrics, so neither the collected metrics nor the translated data of the
+    whole registry are held at once.
     """
+    chunk_size = 1000
+
+    def _metric_chunks(self, translate: callable) -> iter:
+        """
+        Collects the metrics of the registry incrementally and translates them into chunks of at most chunk_size.
+        :param translate: callable(name, tags, value) that translates a single sample of a knotty.meters.MetricBatch
+        :return: A generator of lists of translated metrics
+        """
+        chunk = []
+        for batches in registry.MeterRegistry.iter_metric_batches():
+            for batch in batches:
+                name = batch.name
+                for tags, value in zip(batch.keys, batch.values):
+                    chunk.append(translate(name, tags, value))
+                    if len(chunk) >= self.chunk_size:
+                        yield chunk
+                        chunk = []
+        if chunk:
+            yield chunk
+
     def _metrics_translator(self):
         raise NotImplementedError()
 
@@ -37,33 +65,40 @@ class OpenTSDBExporter(Exporter):
         self._thread = Thread(target=self._export, daemon=True)
         self._thread.start()
 
+    def _translated_chunks(self) -> iter:
+        """
+        Gathers the metrics from the Registry and translates them into chunks of dictionaries that will be sent as json
+        data to the OpenTSDB instance.
+        :return:
+        """
+        unix_time = int(time.time())
+        return self._metric_chunks(lambda name, tags, value: {"metric": name.replace("_", "."),
+                                                              "timestamp": unix_time,
+                                                              "value": value,
+                                                              "tags": dict(tags)
+                                                              })
+
     def _metrics_translator(self) -> [dict]:
         """
         Gathers all metrics from the Registry and translates them into a list of dictionaries that will be sent as json
         data to the OpenTSDB instance.
         :return:
         """
-        metrics = registry.MeterRegistry.get_all_metrics()
-        unix_time = int(time.time())
-        return [{"metric": metric.name.replace("_", "."),
-                 "timestamp": unix_time,
-                 "value": metric.value,
-                 "tags": dict(metric.tags)
-                 } for metric in metrics]
+        return [data_point for chunk in self._translated_chunks() for data_point in chunk]
 
     def _export(self) -> None:
         """
         This function is the target of the exporters thread, and will run continuously until application shutdown,
-        sending metrics to the OpenTSDB instance at the requested push interval.
+        sending metrics to the OpenTSDB instance at the requested push interval, one chunk per request.
         :return:
         """
         while True:
             try:
-                metric_data = self._metrics_translator()
                 self._logger.debug("Push metrics to OpenTSDB...")
-                res = requests.post(url=self._endpoint, data=metric_data)
-                self._logger.debug("Response from OpenTSDB; Status: {0}, Content: {1}".format(res.status_code,
-                                                                                              res.content))
+                for metric_data in self._translated_chunks():
+                    res = requests.post(url=self._endpoint, data=metric_data)
+                    self._logger.debug("Response from OpenTSDB; Status: {0}, Content: {1}".format(res.status_code,
+                                                                                                  res.content))
 
             except Exception as e:
                 self._logger.error(e)
@@ -77,6 +112,8 @@ class _PrometheusStarter(Exporter):
     The PrometheusStarter is used to encapsulate the shared behaviors between creating a metrics endpoint for scraping
     and creating a set of data to send to a PushGateway.
     """
+    _logger = getLogger(__name__)
+
     def _tag_translator(self, tag_dict: dict) -> str:
         """
         This takes a dictionary of tags and translates them into the string format that Prometheus and Pushgateway
@@ -86,24 +123,121 @@ class _PrometheusStarter(Exporter):
         """
         return "{"+", ".join(['{0}="{1}"'.format(key, value) for key, value in tag_dict.items()])+"}"
 
-    def _metrics_translator(self) -> str:
+    def _filters_from_query(self, query: {str: [str]}) -> tuple:
+        """
+        Reads the metric filters from the query parameters of a scrape, eg /metrics?name[]=process_&tag[]=pid:12. Every
+        name[] is a metric name prefix and a metric needs to start with any of them, every tag[] is a tag the metric
+        needs to have, given as key:value or as just the key to accept any value.
+        :param query: The parsed query string, mapping every parameter to its list of values
+        :return: tuple: The names and tags to pass to registry.MeterRegistry.get_all_metrics
+        """
+        names = query.get("name[]") or None
+        tags = dict()
+        for tag in query.get("tag[]") or []:
+            key, separator, value = tag.partition(":")
+            tags[key] = value if separator else None
+        return names, tags or None
+
+    _stream_buffers = local()
+
+    def _exposition_chunks(self, names: [str] = None, tags: dict = None, chunk_size: int = 65536):
+        """
+        Generates the document in the format expected by Prometheus or PushGateway as ascii encoded chunks of at most
+        chunk_size bytes, unless a single line is longer. The metrics are collected from the registry batch by batch
+        (see registry.MeterRegistry.iter_metric_batches) and every batch is written before the next one is collected.
+        Within a batch the metrics are grouped by their name under the type names that Prometheus defines, in the order
+        the names are first collected. Prometheus requires the samples of a family to be written together, so a family
+        needs to be exported by the meters of a single name, which the registry always collects in one batch. A family
+        that comes back in a later batch anyway could not be written under its type name, so it is dropped and logged.
+
+        The lines are encoded straight into a buffer that every thread allocates once and reuses, so producing the
+        document only ever holds one batch of metrics and one chunk of it. Every chunk is a view of that buffer, and is
+        only valid until the next chunk is requested.
+        :param names: [str]: Only include the metrics starting with any of these prefixes
+        :param tags: {str: str}: Only include the metrics with these tags, see registry.MeterRegistry.get_all_metrics
+        :param chunk_size: int: The size of the chunks
+        :return: A generator of memoryview chunks
+        """
+        buffer = getattr(self._stream_buffers, "buffer", None)
+        if buffer is None or len(buffer) != chunk_size:
+            buffer = self._stream_buffers.buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        position = 0
+        # One entry per metric name and type, mapped to the header of its group and the family the header names.
+        metric_groups = dict()
+        written_families = set()
+        for batches in registry.MeterRegistry.iter_metric_batches(names, tags):
+            batch_headers = dict()
+            batch_families = set()
+            for batch in batches:
+                metric_key = (batch.name, batch.prometheus_type)
+                group = metric_groups.get(metric_key)
+                if group is None:
+                    name = batch.name
+                    if batch.prometheus_type in ["histogram", "summary"]:
+                        name = "_".join(name.split("_")[0:-1])
+                    group = metric_groups[metric_key] = ("#TYPE {0} {1}\n".format(name, batch.prometheus_type), name)
+                header, family = group
+                if family in written_families:
+                    continue
+                batch_families.add(family)
+                batch_headers.setdefault(header, len(batch_headers))
+            written_families |= batch_families
+            # The batches are sorted by group in place, the sort is stable so the metrics of a group keep their order.
+            batches.sort(key=lambda sorted_batch: batch_headers.get(
+                metric_groups[(sorted_batch.name, sorted_batch.prometheus_type)][0], -1))
+            group = None
+            for batch in batches:
+                header = metric_groups[(batch.name, batch.prometheus_type)][0]
+                if header not in batch_headers:
+                    self._logger.warning("Dropping {0} samples of {1}, its family was already written by another "
+                                         "meter".format(len(batch), batch.name))
+                    continue
+                for index, (metric_tags, value) in enumerate(zip(batch.keys, batch.values)):
+                    line = "{0}{1} {2}\n".format(batch.name, self._tag_translator(dict(metric_tags)), value) \
+                        .encode("ascii")
+                    if not index and header != group:
+                        group = header
+                        line = header.encode("ascii") + line
+                    end = position + len(line)
+                    if end > chunk_size:
+                        if position:
+                            yield view[:position]
+                            position, end = 0, len(line)
+                        if end > chunk_size:
+                            yield memoryview(line)
+                            continue
+                    buffer[position:end] = line
+                    position = end
+        if position:
+            yield view[:position]
+
+    def _metrics_translator(self, names: [str] = None, tags: dict = None) -> str:
         """
         This gets all of the metrics from the registry and creates a document in the format expected by Prometheus or
         PushGateway. This includes the grouping of metrics by their name, and the addition of the expected type names
-        that Prometheus defines.
+        that Prometheus defines, see _exposition_chunks.
+        :param names: [str]: Only include the metrics starting with any of these prefixes
+        :param tags: {str: str}: Only include the metrics with these tags, see registry.MeterRegistry.get_all_metrics
         :return: str: Formatted string containing all metrics to export.
         """
-        metrics = registry.MeterRegistry.get_all_metrics()
-        metric_builder = dict()
-        for metric in metrics:
-            name = metric.name
-            if metric.prometheus_type in ["histogram", "summary"]:
-                name = "_".join(name.split("_")[0:-1])
-            key = "#TYPE {0} {1}\n".format(name, metric.prometheus_type)
-            value = "{0}{1} {2}\n".format(metric.name, self._tag_translator(dict(metric.tags)), metric.value)
-            metric_builder[key] = (metric_builder.get(key) or []) + [value]
+        return b"".join([bytes(chunk) for chunk in self._exposition_chunks(names, tags)]).decode("ascii")
 
-        return "".join([key+"".join(value) for key, value in metric_builder.items()])
+    def _slow_calls_translator(self) -> str:
+        """
+        Collects the slow calls captured by every registered Timer and formats them as a json document. This backs the
+        debug endpoint of the PrometheusExporter.
+        :return: str: json list of the captured slow calls, slowest first for each timer and metric key
+        """
+        timers = [meter for meter in list(registry.MeterRegistry._meters.values()) if isinstance(meter, meters.Timer)]
+        return json.dumps([{"timer": timer.name,
+                            "duration": call.duration,
+                            "timestamp": call.timestamp,
+                            "tags": dict(call.tags),
+                            "arguments": call.arguments}
+                           for timer in timers
+                           for calls in timer.get_slowest_calls().values()
+                           for call in calls], default=str)
 
     def _export(self):
         return NotImplementedError()
@@ -134,7 +268,8 @@ class PushgatewayExporter(_PrometheusStarter):
         """
         while True:
             try:
-                metric_data = self._metrics_translator()
+                # The chunks are views of a reused buffer, requests sends copies of them with chunked encoding.
+                metric_data = (bytes(chunk) for chunk in self._exposition_chunks())
                 b64_instance = urlsafe_b64encode(self._instance.encode('ascii')).decode("ascii")
                 req = requests.post(url="{0}/metrics/job/{1}/instance@base64/{2}".format(self._endpoint, self._job_name,
                                                                                          b64_instance),
@@ -153,15 +288,23 @@ class PrometheusExporter(_PrometheusStarter):
     The Prometheus Exporter manages a metrics endpoint for Prometheus to scrape. This can be handled through its own
     built in http server, or through providing a Flask app which which will have an endpoint added to it. Note that the
     built in http server only aims to provide minimal functionality, and if you need any sort of security, please
-    implement that through Flask.
+    implement that through Flask. The slow calls captured by Timers (see Timer.enable_slow_call_capture) are served as
+    json at the debug_path, pass None to disable it.
+
+    By default the metrics are streamed to the scraper in chunks as they are formatted, with chunked transfer encoding,
+    so the size of a scrape response never has to be held in memory at once. Pass streaming=False to send every
+    response in one piece with a Content-Length instead.
     """
     _logger = getLogger(__name__)
 
-    def __init__(self, flask_app=None, server_name: str = "0.0.0.0", port: int = 2091, path: str = "/metrics"):
+    def __init__(self, flask_app=None, server_name: str = "0.0.0.0", port: int = 2091, path: str = "/metrics",
+                 debug_path: str = "/debug/slow_calls", streaming: bool = True):
         self._flask_app = flask_app
         self._server_name = server_name
         self._port = port
         self._path = path
+        self._debug_path = debug_path
+        self._streaming = streaming
         self._logger.debug("Starting PrometheusExporter thread")
         self._thread = Thread(target=self._export, daemon=True)
         self._thread.start()
@@ -172,22 +315,78 @@ class PrometheusExporter(_PrometheusStarter):
         format.
         """
         metrics_path: str = None
+        debug_path: str = None
+        streaming: bool = True
+        protocol_version = "HTTP/1.1"
         logger = getLogger(__name__)
 
+        def _send_body(self, status: int, content_type: str, body: bytes) -> None:
+            self.send_response(status)
+            if content_type:
+                self.send_header("Content-type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream_metrics(self, names: [str], tags: dict) -> None:
+            """
+            Writes the metrics to the socket chunk by chunk, with chunked transfer encoding for HTTP/1.1 clients. For
+            older clients the end of the response is marked by closing the connection.
+            :param names: [str]: The name filters of the scrape
+            :param tags: {str: str}: The tag filters of the scrape
+            :return:
+            """
+            chunked = self.request_version != "HTTP/1.0"
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain")
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            for chunk in self._exposition_chunks(names, tags):
+                if chunked:
+                    self.wfile.write(b"%x\r\n" % len(chunk))
+                    self.wfile.write(chunk)
+                    self.wfile.write(b"\r\n")
+                else:
+                    self.wfile.write(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+
         def do_GET(self):
-            if self.path == self.metrics_path:
+            url = urlsplit(self.path)
+            if url.path == self.metrics_path:
                 self.logger.debug("Serving request for metrics at {0}".format(self.path))
-                self.send_response(200)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(self._metrics_translator().encode("ascii"))
+                names, tags = self._filters_from_query(parse_qs(url.query))
+                if self.streaming:
+                    self._stream_metrics(names, tags)
+                else:
+                    self._send_body(200, "text/plain", self._metrics_translator(names, tags).encode("ascii"))
+                self.server.path = self.path
+            elif self.debug_path and url.path == self.debug_path:
+                self.logger.debug("Serving request for slow calls at {0}".format(self.path))
+                self._send_body(200, "application/json", self._slow_calls_translator().encode("utf-8"))
                 self.server.path = self.path
             else:
                 self.logger.debug("Request was made to the metrics server for an unknown path {0}".format(self.path))
-                self.send_response(404)
-                self.end_headers()
+                self._send_body(404, None, b"")
                 self.server.path = self.path
 
+    def _flask_metrics(self):
+        """
+        Serves the metrics for the Flask endpoint, applying the filters of the request like the built in server does.
+        When streaming, the metrics are returned as a generator of chunks which Flask streams to the scraper.
+        :return: str, or a generator of bytes
+        """
+        from flask import request
+        names, tags = self._filters_from_query(request.args.to_dict(flat=False))
+        if self._streaming:
+            # The chunks are views of a reused buffer, the WSGI server gets copies it can hold on to.
+            return (bytes(chunk) for chunk in self._exposition_chunks(names, tags))
+        return self._metrics_translator(names, tags)
+
     def __start_http_server(self) -> None:
         """
         Starts the http server to handle incoming metrics requests from Prometheus if no other WSGI application (eg
@@ -195,7 +394,9 @@ class PrometheusExporter(_PrometheusStarter):
         :return:
         """
         server = ThreadingHTTPServer((self._server_name, self._port), type("handler", (self._PrometheusHandler,),
-                                                                           {"metrics_path": self._path}))
+                                                                           {"metrics_path": self._path,
+                                                                            "debug_path": self._debug_path,
+                                                                            "streaming": self._streaming}))
         self._logger.debug("Starting http server, binding to {0}:{1}/{2}"
                            .format(self._server_name, self._port, self._path))
         server.serve_forever()
@@ -208,7 +409,13 @@ class PrometheusExporter(_PrometheusStarter):
         """
         if self._flask_app:
             self._logger.debug("Adding metrics endpoint {0} to provided Flask Application.".format(self._path))
-            self._flask_app.route(self._path)(lambda: (self._metrics_translator(), 200, {"Content-Type": "text/plain"}))
+            # Every view needs an endpoint name of its own, Flask names views after their functions otherwise.
+            self._flask_app.add_url_rule(self._path, endpoint="knotty_metrics",
+                                         view_func=lambda: (self._flask_metrics(), 200, {"Content-Type": "text/plain"}))
+            if self._debug_path:
+                self._flask_app.add_url_rule(self._debug_path, endpoint="knotty_slow_calls",
+                                             view_func=lambda: (self._slow_calls_translator(), 200,
+                                                                {"Content-Type": "application/json"}))
         else:
             self.__start_http_server()
 
@@ -227,31 +434,38 @@ class InfluxDBExporter(Exporter):
         self._thread = Thread(target=self._export, daemon=True)
         self._thread.start()
 
+    def _translated_chunks(self) -> iter:
+        """
+        Gathers the metrics from the Registry and translates them into chunks of dictionaries that will be sent as json
+        data to the InfluxDB instance.
+        :return:
+        """
+        timestamp = datetime.utcnow().isoformat()+"Z"
+        return self._metric_chunks(lambda name, tags, value: {"measurement": name,
+                                                              "time": timestamp,
+                                                              "fields": {"value": value},
+                                                              "tags": dict(tags)
+                                                              })
+
     def _metrics_translator(self) -> [dict]:
         """
         Gathers all metrics from the Registry and translates them into a list of dictionaries that will be sent as json
         data to the InfluxDB instance.
         :return:
         """
-        metrics = registry.MeterRegistry.get_all_metrics()
-        timestamp = datetime.utcnow().isoformat()+"Z"
-        return [{"measurement": metric.name,
-                 "time": timestamp,
-                 "fields": {"value": metric.value},
-                 "tags": dict(metric.tags)
-                 } for metric in metrics]
+        return [point for chunk in self._translated_chunks() for point in chunk]
 
     def _export(self) -> None:
         """
         This function is the target of the exporters thread, and will run continuously until application shutdown,
-        sending metrics to the InfluxDB instance at the requested push interval.
+        sending metrics to the InfluxDB instance at the requested push interval, one chunk per write.
         :return:
         """
         while True:
             try:
-                metric_data = self._metrics_translator()
                 self._logger.debug("Push metrics to InfluxDB...")
-                self._client.write_points(metric_data)
+                for metric_data in self._translated_chunks():
+                    self._client.write_points(metric_data)
                 self._logger.debug("Metrics pushed successfully.")
 
             except Exception as e:
@@ -282,36 +496,44 @@ class GraphiteExporter(Exporter):
     def _join_tags(self, tags: dict):
         return ".".join(["{0}.{1}".format(key, value) for key, value in tags])
 
+    def _translated_chunks(self) -> iter:
+        """
+        Gathers the metrics from the Registry and translates them into chunks of tuples to be pickled and sent to
+        Graphite.
+        :return:
+        """
+        timestamp = int(time.time())
+        return self._metric_chunks(lambda name, tags, value: ((name.replace("_", ".")+"."+self._join_tags(tags))
+                                                              .replace(" ", "_")
+                                                              .replace("/", ".")
+                                                              .replace("..", "."),
+                                                              (timestamp, value)))
+
     def _metrics_translator(self) -> [tuple]:
         """
         Gathers all metrics from the Registry and translates them into tuples to be pickled and sent to Graphite
         :return:
         """
-        metrics = registry.MeterRegistry.get_all_metrics()
-        timestamp = int(time.time())
-        return [((metric.name.replace("_", ".")+"."+self._join_tags(metric.tags))
-                 .replace(" ", "_")
-                 .replace("/", ".")
-                 .replace("..", "."),
-                (timestamp, metric.value)) for metric in metrics]
+        return [metric for chunk in self._translated_chunks() for metric in chunk]
 
     def _export(self) -> None:
         """
         This function is the target of the exporters thread, and will run continuously until application shutdown,
-        sending metrics to the Graphite instance at the requested push interval.
+        sending metrics to the Graphite instance at the requested push interval. Every chunk is sent as a pickle message
+        of its own over a single connection.
         :return:
         """
         while True:
             try:
-                metric_data = self._metrics_translator()
                 self._logger.debug("Pickling metrics to push to Graphite...")
-                payload = pickle.dumps(metric_data, protocol=self._pickle_protocol)
-                header = struct.pack("!L", len(payload))
-                message = header + payload
                 sock = socket.socket(family=self._socket_family)
-                sock.connect((self._graphite_endpoint, self._graphite_port))
-                sock.sendall(message)
-                sock.close()
+                try:
+                    sock.connect((self._graphite_endpoint, self._graphite_port))
+                    for metric_data in self._translated_chunks():
+                        payload = pickle.dumps(metric_data, protocol=self._pickle_protocol)
+                        sock.sendall(struct.pack("!L", len(payload)) + payload)
+                finally:
+                    sock.close()
                 self._logger.debug("Metrics pushed successfully.")
 
             except Exception as e:
@@ -319,3 +541,375 @@ class GraphiteExporter(Exporter):
 
             finally:
                 time.sleep(self._push_interval)
+
+
+class AgentExporter(Exporter):
+    """
+    Sends the metrics of this process to a knotty agent running on the same host (see knotty.agent), which merges the
+    metrics of every process and exports them from a single place. Every push_interval the meters are drained (see
+    knotty.meters.BaseMeter.drain) and their deltas are sent to the agent in datagrams, over a Unix domain socket by
+    default or over UDP when an address is given. Datagrams that can not be delivered, eg while the agent restarts, are
+    kept and sent with the next flush, up to max_pending_datagrams. The remaining deltas are flushed when the process
+    exits, which suits short lived processes.
+
+    The snapshot of a meter that does not fit in a datagram is split into snapshots of ranges of its series. Only a
+    single series that is larger than a datagram can not be sent, it is dropped and counted in the Counter
+    <name>_dropped_snapshots, tagged by the meter, which is only registered once a snapshot has been dropped.
+    """
+    _logger = getLogger(__name__)
+    default_socket_path = "/tmp/knotty.sock"
+
+    def __init__(self, push_interval: int = 10, socket_path: str = default_socket_path, address: tuple = None,
+                 max_datagram_size: int = 65000, max_pending_datagrams: int = 1000,
+                 name: str = "knotty_agent_exporter") -> None:
+        self._push_interval = push_interval
+        self._destination = address or socket_path
+        self._socket = socket.socket(socket.AF_INET if address else socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._max_datagram_size = max_datagram_size
+        self._pending = deque(maxlen=max_pending_datagrams)
+        self._flush_lock = Lock()
+        self._name = name
+        self._logger.debug("Starting AgentExporter thread, flushing to {0} every {1} seconds."
+                           .format(self._destination, push_interval))
+        atexit.register(self._flush_at_exit)
+        self._thread = Thread(target=self._export, daemon=True)
+        self._thread.start()
+
+    def _metrics_translator(self) -> [bytes]:
+        """
+        Drains all meters of the Registry, split into snapshots that each fit in a datagram, and packs the snapshots
+        into batches that each fit in a single datagram.
+        :return: [bytes]
+        """
+        batches = []
+        batch = []
+        size = 0
+        # A batch starts with its magic marker and version, and every snapshot is framed by a varint of at most 5 bytes.
+        capacity = self._max_datagram_size - len(snapshots.BATCH_MAGIC) - 1
+        for snapshot in registry.MeterRegistry.drain_all(capacity - 5):
+            if len(snapshot) + 5 > capacity:
+                self._drop_snapshot(snapshot)
+                continue
+            if batch and size + len(snapshot) + 5 > capacity:
+                batches.append(snapshots.pack_batch(batch))
+                batch = []
+                size = 0
+            batch.append(snapshot)
+            size += len(snapshot) + 5
+        if batch:
+            batches.append(snapshots.pack_batch(batch))
+        return batches
+
+    def _flush(self) -> None:
+        """
+        Drains the meters and sends every pending datagram to the agent, stopping at the first one that can not be
+        delivered for now. A datagram that is too large for the socket can never be delivered, so it does not hold up
+        the rest: it is split in two batches that are sent in its place, see _split_datagram.
+        :return:
+        """
+        with self._flush_lock:
+            self._pending.extend(self._metrics_translator())
+            while self._pending:
+                datagram = self._pending[0]
+                try:
+                    self._socket.sendto(datagram, self._destination)
+                except OSError as e:
+                    if e.errno != errno.EMSGSIZE:
+                        raise
+                    self._pending.popleft()
+                    self._split_datagram(datagram)
+                    continue
+                self._pending.popleft()
+
+    def _split_datagram(self, datagram: bytes) -> None:
+        """
+        Puts the two halves of a datagram that is too large to send at the front of the pending datagrams. A datagram of
+        a single snapshot means that the socket does not take datagrams of max_datagram_size, which is halved. The
+        snapshot is merged back into its meter, so that the next flush drains it again in smaller snapshots.
+        :param datagram: bytes: A batch of snapshots, see knotty.snapshots.pack_batch
+        :return:
+        """
+        batch = snapshots.unpack_batch(datagram)
+        if len(batch) < 2:
+            self._max_datagram_size = len(datagram) // 2
+            self._logger.warning("The socket does not take datagrams of {0} bytes, splitting snapshots into datagrams "
+                                 "of at most {1} bytes".format(len(datagram), self._max_datagram_size))
+            registry.MeterRegistry.merge_snapshot(batch[0])
+            return
+        half = len(batch) // 2
+        self._pending.appendleft(snapshots.pack_batch(batch[half:]))
+        self._pending.appendleft(snapshots.pack_batch(batch[:half]))
+
+    def _drop_snapshot(self, snapshot: bytes) -> None:
+        """
+        Drops a snapshot of a single series that is too large to send to the agent, and counts it.
+        :param snapshot: bytes
+        :return:
+        """
+        name = snapshots.SnapshotReader(snapshot).name
+        self._logger.error("Dropping a snapshot of {0} of {1} bytes that is too large to send to the agent"
+                           .format(name, len(snapshot)))
+        registry.MeterRegistry.get_meter(self._name + "_dropped_snapshots", meters.Counter) \
+            .increment(1, (("meter", name),))
+
+    def _flush_at_exit(self) -> None:
+        try:
+            self._flush()
+        except Exception as e:
+            self._logger.error(e)
+
+    def _export(self) -> None:
+        """
+        This function is the target of the exporters thread, and will run continuously until application shutdown,
+        flushing the metrics to the agent at the requested push interval.
+        :return:
+        """
+        while True:
+            try:
+                self._flush()
+                self._logger.debug("Metrics flushed to the agent successfully.")
+
+            except Exception as e:
+                self._logger.error(e)
+
+            finally:
+                time.sleep(self._push_interval)
+
+
+class RemoteWriteExporter(Exporter):
+    """
+    Pushes the metrics to an endpoint of the Prometheus remote write protocol, eg Prometheus with its remote write
+    receiver enabled, Cortex, Mimir, Thanos or VictoriaMetrics, for processes that can not be scraped. Every
+    push_interval the metrics are collected batch by batch, and their samples are spread over the shards by series, so
+    the samples of a series are always sent in order by the same shard. Every shard has a thread that sends snappy
+    compressed protobuf WriteRequests (see knotty.remote_write) of at most max_samples_per_send samples, taken from a
+    bounded queue that holds at most queue_capacity samples. Samples that do not fit in the queue are dropped instead of
+    holding up the collection.
+
+    Sends that fail with a connection error, a status of 429 or a server error are retried up to max_retries times, with
+    a backoff that doubles from min_backoff up to max_backoff seconds. Sends that are rejected with another status are
+    dropped, as retrying them can not succeed. The samples are counted by result (sent, dropped or failed) in the
+    Counter <name>_samples and the retries in the Counter <name>_retries. The queued samples are flushed when the
+    process exits, which suits short lived processes.
+
+    :param push_interval: int: The number of seconds between two collections
+    :param endpoint: str: The URL of the remote write endpoint
+    :param shards: int: The number of queues and threads that send in parallel
+    :param max_samples_per_send: int: The largest number of samples in a single WriteRequest
+    :param queue_capacity: int: The number of samples every shard queues at most
+    :param max_retries: int: The number of times a failed send is retried
+    :param min_backoff: float: The number of seconds to wait before the first retry
+    :param max_backoff: float: The largest number of seconds to wait between two retries
+    :param timeout: float: The number of seconds to wait for a response, and for the flush at exit
+    :param headers: {str: str}: Extra headers to send, eg for authentication
+    :param name: str: The prefix of the names of the Counters of the exporter
+    :param max_cached_series: int: The number of series to keep the encoded labels of
+    """
+    _logger = getLogger(__name__)
+
+    def __init__(self, push_interval: int, endpoint: str, shards: int = 4, max_samples_per_send: int = 2000,
+                 queue_capacity: int = 10000, max_retries: int = 10, min_backoff: float = .03, max_backoff: float = 5,
+                 timeout: float = 10, headers: dict = None, name: str = "knotty_remote_write",
+                 max_cached_series: int = 100000) -> None:
+        self._push_interval = push_interval
+        self._endpoint = endpoint
+        self._max_samples_per_send = max_samples_per_send
+        self._max_retries = max_retries
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._timeout = timeout
+        self._headers = {"Content-Encoding": remote_write.CONTENT_ENCODING,
+                         "Content-Type": remote_write.CONTENT_TYPE,
+                         "User-Agent": "knotty",
+                         "X-Prometheus-Remote-Write-Version": remote_write.PROTOCOL_VERSION,
+                         **(headers or {})}
+        self._max_cached_series = max_cached_series
+        self._series = dict()
+        self._collect_lock = Lock()
+        self._closed = False
+        self.samples_counter = registry.MeterRegistry.get_meter(name + "_samples", meters.Counter)
+        self.retries_counter = registry.MeterRegistry.get_meter(name + "_retries", meters.Counter)
+        self._result_keys = {result: self.samples_counter._key_with_tags({"result": result})
+                             for result in ("sent", "dropped", "failed")}
+        self._queues = [Queue(max(1, queue_capacity // max_samples_per_send)) for _ in range(shards)]
+        self._senders = [Thread(target=self._send_loop, args=(shard_queue,), daemon=True)
+                         for shard_queue in self._queues]
+        for sender in self._senders:
+            sender.start()
+        self._logger.debug("Starting RemoteWriteExporter thread, pushing to {0} every {1} seconds with {2} shards."
+                           .format(endpoint, push_interval, shards))
+        atexit.register(self._flush_at_exit)
+        self._thread = Thread(target=self._export, daemon=True)
+        self._thread.start()
+
+    def _series_for(self, name: str, tags: tuple) -> tuple:
+        """
+        Returns the encoded labels of a series and the shard that sends its samples, both are cached.
+
+        :return: tuple(bytes, int)
+        """
+        series = self._series.get((name, tags))
+        if series is None:
+            if len(self._series) >= self._max_cached_series:
+                self._series.clear()
+            labels = remote_write.encode_labels(name, tags)
+            series = self._series[(name, tags)] = (labels, hash(labels) % len(self._queues))
+        return series
+
+    def _enqueue(self, shard: int, samples: [tuple]) -> None:
+        try:
+            self._queues[shard].put_nowait(samples)
+        except Full:
+            self._logger.warning("The queue of shard {0} is full, dropping {1} samples".format(shard, len(samples)))
+            self.samples_counter.increment(len(samples), self._result_keys["dropped"])
+
+    def _metrics_translator(self) -> int:
+        """
+        Collects the metrics of the registry and queues their samples on the shards, in sends of at most
+        max_samples_per_send samples. Values that can not be converted to a float are left out.
+
+        :return: int: The number of samples collected
+        """
+        with self._collect_lock:
+            timestamp = int(time.time() * 1000)
+            pending = [[] for _ in self._queues]
+            collected = 0
+            for batches in registry.MeterRegistry.iter_metric_batches():
+                for batch in batches:
+                    name = batch.name
+                    for tags, value in zip(batch.keys, batch.values):
+                        try:
+                            value = float(value)
+                        except (TypeError, ValueError):
+                            continue
+                        labels, shard = self._series_for(name, tags)
+                        samples = pending[shard]
+                        samples.append((labels, value, timestamp))
+                        collected += 1
+                        if len(samples) >= self._max_samples_per_send:
+                            self._enqueue(shard, samples)
+                            pending[shard] = []
+            for shard, samples in enumerate(pending):
+                if samples:
+                    self._enqueue(shard, samples)
+            return collected
+
+    def _send(self, session: requests.Session, samples: [tuple]) -> bool:
+        """
+        Sends the samples in a single WriteRequest, retrying the send as long as it can succeed.
+
+        :param session: requests.Session: The session of the shard
+        :param samples: [tuple(bytes, float, int)]: See remote_write.encode_write_request
+        :return: bool: Whether the samples were accepted
+        """
+        payload = remote_write.compress(remote_write.encode_write_request(samples))
+        backoff = self._min_backoff
+        for attempt in range(self._max_retries + 1):
+            if attempt:
+                self.retries_counter.increment()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+            try:
+                response = session.post(self._endpoint, data=payload, headers=self._headers, timeout=self._timeout)
+            except requests.RequestException as e:
+                self._logger.warning("Remote write to {0} failed: {1}".format(self._endpoint, e))
+                continue
+            if response.status_code < 300:
+                self.samples_counter.increment(len(samples), self._result_keys["sent"])
+                return True
+            self._logger.warning("Remote write to {0} failed with status {1}: {2}"
+                                 .format(self._endpoint, response.status_code, response.text[:256]))
+            if response.status_code != 429 and response.status_code < 500:
+                break
+        self.samples_counter.increment(len(samples), self._result_keys["failed"])
+        return False
+
+    def _send_loop(self, shard_queue: Queue) -> None:
+        """
+        The target of the thread of a shard, sends the queued samples until the exporter is closed.
+
+        :param shard_queue: Queue: The queue of the shard
+        :return:
+        """
+        session = requests.Session()
+        while True:
+            samples = shard_queue.get()
+            try:
+                if samples is None:
+                    return
+                self._send(session, samples)
+            except Exception as e:
+                self._logger.error(e)
+            finally:
+                shard_queue.task_done()
+
+    def _wait_until_sent(self, timeout: float = None) -> bool:
+        """
+        Waits until every queued send has been sent or given up on.
+
+        :param timeout: float: The number of seconds to wait at most, None to wait as long as it takes
+        :return: bool: False if the timeout expired first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for shard_queue in self._queues:
+            with shard_queue.all_tasks_done:
+                while shard_queue.unfinished_tasks:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    shard_queue.all_tasks_done.wait(remaining)
+        return True
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Collects the metrics right away and waits until they and the samples queued before them have been sent.
+
+        :param timeout: float: The number of seconds to wait at most, None to wait as long as it takes
+        :return: bool: False if the timeout expired before everything was sent
+        """
+        self._metrics_translator()
+        return self._wait_until_sent(timeout)
+
+    def close(self, timeout: float = None) -> bool:
+        """
+        Flushes the metrics and stops the exporter.
+
+        :param timeout: float: The number of seconds to wait for the flush at most, None to wait as long as it takes
+        :return: bool: False if the timeout expired before everything was sent
+        """
+        if self._closed:
+            return True
+        self._closed = True
+        atexit.unregister(self._flush_at_exit)
+        flushed = self.flush(timeout)
+        for shard_queue in self._queues:
+            try:
+                shard_queue.put_nowait(None)
+            except Full:
+                # The shard is still retrying, its daemon thread ends with the process.
+                pass
+        return flushed
+
+    def _flush_at_exit(self) -> None:
+        try:
+            if not self.close(self._timeout):
+                self._logger.error("Not every sample could be sent to {0} before exiting".format(self._endpoint))
+        except Exception as e:
+            self._logger.error(e)
+
+    def _export(self) -> None:
+        """
+        This function is the target of the exporters thread, and will run continuously until the exporter is closed,
+        queueing the metrics for the shards at the requested push interval. The first metrics are queued one interval
+        after the exporter starts, a process that exits before then sends its metrics with the flush at exit.
+        :return:
+        """
+        while True:
+            time.sleep(self._push_interval)
+            if self._closed:
+                return
+            try:
+                self._logger.debug("Queued {0} samples for remote write.".format(self._metrics_translator()))
+
+            except Exception as e:
+                self._logger.error(e)
@@ -0,0 +1,145 @@
+"""
+This module monitors an asyncio event loop of the application. The LoopMonitor attaches to a loop and measures how late
+the loop runs a low frequency heartbeat, which is how long any callback has to wait before the loop gets to it, and
+counts the pending tasks. Optionally a watchdog thread detects callbacks that block the loop for longer than a
+threshold and captures the stack they were blocking at, without timing every callback like the debug mode of asyncio.
+"""
+import asyncio
+import sys
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from threading import Thread, Event, get_ident
+from time import time, sleep
+from knotty import collectors, meters, registry
+
+
+@dataclass
+class SlowCallback:
+    """
+    A callback that blocked the event loop for longer than the slow callback threshold, with the stack of the loop
+    thread at the time it was detected.
+    """
+    timestamp: float
+    stack: str
+
+
+class LoopMonitor(collectors.Collector):
+    """
+    Monitors an asyncio event loop, see attach. The scheduling lag of the heartbeat is recorded in the LatencyHistogram
+    <name>_lag, and the monitor exports the number of pending tasks as <name>_pending_tasks and the number of slow
+    callbacks as <name>_slow_callbacks_total. The monitor only ever runs its heartbeat on the loop, which counts the
+    pending tasks once per interval, everything else is read from other threads.
+    """
+    def __init__(self, name: str = "asyncio_loop"):
+        super().__init__(name)
+        self.lag_histogram = registry.MeterRegistry.get_meter(name + "_lag", meters.LatencyHistogram)
+        self._loop = None
+        self._loop_thread = None
+        self._interval = 1.0
+        self._lag_key = None
+        self._expected = None
+        self._handle = None
+        self._pending_tasks = 0
+        self._slow_callback_threshold = None
+        self._slow_callback_count = 0
+        self._slow_callbacks = deque()
+        self._attached = False
+
+    def attach(self, loop: asyncio.AbstractEventLoop = None, interval: float = 1.0,
+               slow_callback_threshold: float = None, max_slow_callbacks: int = 10) -> None:
+        """
+        Starts monitoring the given loop. This can be called from any thread, the heartbeat starts once the loop runs.
+
+        :param loop: The loop to monitor, required unless attach is called from a coroutine or callback running on it
+        :param interval: float: The number of seconds between two heartbeats
+        :param slow_callback_threshold: float: Enables the detection of callbacks that block the loop for longer than
+            this number of seconds. Blocks longer than twice the threshold are always detected, shorter ones may be.
+        :param max_slow_callbacks: int: The number of the most recent slow callbacks to keep the stacks of
+        :return:
+        """
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                raise ValueError("No event loop is running in this thread, pass the loop to monitor to attach")
+        self._loop = loop
+        self._interval = interval
+        self._lag_key = tuple(self.lag_histogram.get_tags().items())
+        self._slow_callback_threshold = slow_callback_threshold
+        self._slow_callbacks = deque(maxlen=max_slow_callbacks)
+        self._attached = True
+        self._loop.call_soon_threadsafe(self._start)
+
+    def detach(self) -> None:
+        """
+        Stops monitoring the loop.
+
+        :return:
+        """
+        self._attached = False
+        if self._handle is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._handle.cancel)
+
+    def _start(self) -> None:
+        self._loop_thread = get_ident()
+        self._expected = None
+        self._heartbeat()
+        if self._slow_callback_threshold:
+            Thread(target=self._watch, daemon=True).start()
+
+    def _heartbeat(self) -> None:
+        if not self._attached:
+            return
+        now = self._loop.time()
+        if self._expected is not None:
+            self.lag_histogram.record(int(max(now - self._expected, 0) * 1e9), self._lag_key)
+        self._pending_tasks = len(asyncio.all_tasks(self._loop))
+        self._expected = now + self._interval
+        self._handle = self._loop.call_at(self._expected, self._heartbeat)
+
+    def _watch(self) -> None:
+        """
+        The target of the watchdog thread. It posts a probe to the loop and waits for the loop to run it, a probe that
+        is not run within the threshold means the loop is blocked, and the stack of the loop thread shows where. A loop
+        that has been stopped, eg between two calls of run_until_complete, does not run the probe either but is not
+        blocked, so the watchdog waits for it to run again.
+
+        :return:
+        """
+        threshold = self._slow_callback_threshold
+        answered = Event()
+        while self._attached and not self._loop.is_closed():
+            if not self._loop.is_running():
+                sleep(threshold)
+                continue
+            answered.clear()
+            try:
+                self._loop.call_soon_threadsafe(answered.set)
+            except RuntimeError:
+                return
+            if not answered.wait(threshold) and self._loop.is_running():
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+                self._slow_callback_count += 1
+                self._slow_callbacks.append(SlowCallback(time(), stack))
+                # Every block is only reported once, wait for the loop to get to the probe or to stop.
+                while self._attached and self._loop.is_running() and not answered.wait(threshold):
+                    pass
+            sleep(threshold)
+
+    def get_slow_callbacks(self) -> [SlowCallback]:
+        """
+        Returns the most recent slow callbacks, oldest first.
+
+        :return: [SlowCallback]
+        """
+        return list(self._slow_callbacks)
+
+    def collect(self) -> [meters.Metric]:
+        key = self._base_key()
+        metrics = [meters.Metric(self.name + "_pending_tasks", key, self._pending_tasks, "gauge")]
+        if self._slow_callback_threshold:
+            metrics.append(meters.Metric(self.name + "_slow_callbacks_total", key, self._slow_callback_count,
+                                         "counter"))
+        return metrics
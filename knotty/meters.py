@@ -2,12 +2,20 @@
 This module is responsible for holding the base definitions of the different types of metric meters.
 """
 from logging import getLogger
-from time import time
+from time import time, monotonic, perf_counter_ns, thread_time_ns, process_time_ns
+from math import exp
 from functools import wraps
-from numpy import percentile, histogram
-from knotty import registry
+from random import random
+from threading import Lock
+from numpy import histogram, percentile, ndarray, arange, int64, float64, intp, frombuffer, cumsum, searchsorted, \
+    asarray, ceil, vstack, linspace, bincount, frexp, argpartition, add, argsort, concatenate, ones, minimum
+from knotty import registry, reservoirs, snapshots
 from dataclasses import dataclass
-from collections import deque, OrderedDict
+from collections import OrderedDict
+from heapq import heappush, heapreplace
+from itertools import count
+from array import array
+from copy import copy
 
 
 def _add_tags(tag_dict: dict, new_tags: dict) -> dict:
@@ -34,7 +42,7 @@ def _remove_tags(tag_dict: dict, tag_key_list: [str]) -> dict:
     :param tag_key_list: A list of the tag keys to be removed
     :return: Returns the tag dictionary with the requested keys removed
     """
-    new_dict = tag_dict
+    new_dict = dict(tag_dict)
     for tag in tag_key_list:
         del (new_dict[tag])
     return new_dict
@@ -51,6 +59,96 @@ class Metric:
     prometheus_type: str
 
 
+def _value_column(values: list):
+    """
+    Stores a column of metric values compactly: in an array("q") when they are all integers, in an array("d") when
+    they are all floats, and as the list itself otherwise, so every value keeps its type when it is exported.
+
+    :param values: list
+    :return: array or list
+    """
+    if all(type(value) is int for value in values):
+        try:
+            return array("q", values)
+        except OverflowError:
+            return values
+    if all(type(value) is float for value in values):
+        return array("d", values)
+    return values
+
+
+class MetricBatch:
+    """
+    The samples of a single metric name in columns: the name and type are stored once, followed by the metric key of
+    every sample and a compact column of their values (see _value_column). Meters produce their metrics as batches
+    (see BaseMeter.get_batches), which keeps the number of objects created for a collection in proportion to the
+    number of metric names instead of the number of samples. The metric keys are the tuples the meters already hold.
+    """
+    __slots__ = ("name", "prometheus_type", "keys", "values")
+
+    def __init__(self, name: str, prometheus_type: str, keys: list, values):
+        self.name = name
+        self.prometheus_type = prometheus_type
+        self.keys = keys
+        self.values = values
+
+    @classmethod
+    def from_items(cls, name: str, prometheus_type: str, items) -> "MetricBatch":
+        """
+        Builds a batch from (metric key, value) pairs, eg the items of a dict of series.
+
+        :param name: str
+        :param prometheus_type: str
+        :param items: An iterable of (tuple, value) pairs
+        :return: MetricBatch
+        """
+        items = list(items)
+        return cls(name, prometheus_type, [key for key, _ in items], _value_column([value for _, value in items]))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def metrics(self) -> [Metric]:
+        """
+        Expands the batch into one Metric per sample.
+
+        :return: [Metric]
+        """
+        name, prometheus_type = self.name, self.prometheus_type
+        return [Metric(name, key, value, prometheus_type) for key, value in zip(self.keys, self.values)]
+
+
+def _batches_from_metrics(metrics: [Metric]) -> [MetricBatch]:
+    """
+    Groups consecutive metrics with the same name and type into batches, keeping their order.
+
+    :param metrics: [Metric]
+    :return: [MetricBatch]
+    """
+    batches = []
+    keys = values = None
+    for metric in metrics:
+        if not batches or batches[-1].name != metric.name or batches[-1].prometheus_type != metric.prometheus_type:
+            keys, values = [], []
+            batches.append(MetricBatch(metric.name, metric.prometheus_type, keys, values))
+        keys.append(metric.tags)
+        values.append(metric.value)
+    for batch in batches:
+        batch.values = _value_column(batch.values)
+    return batches
+
+
+@dataclass()
+class SlowCall:
+    """
+    Dataclass for storing a single slow invocation captured by a Timer.
+    """
+    duration: float
+    timestamp: float
+    tags: tuple
+    arguments: object
+
+
 class GlobalTags:
     """
     Class for storing global level tags. These will be applied to all metrics generated by all meters.
@@ -78,6 +176,217 @@ class GlobalTags:
         cls.tags = _remove_tags(cls.tags, tags)
 
 
+class TagSets:
+    """
+    The global intern table of tag sets. Every distinct metric key is given a small integer series ID the first time it
+    is seen, and is held once however many meters record it. Counters and Timers store their values in columns indexed
+    by these IDs (see _SeriesTable), so recording only hashes an integer, and the metric keys are only looked up again
+    when the metrics are exported. The IDs of series that no meter holds any more, eg once a meter has been drained, can
+    be released with release_unused and are then reused for new metric keys. Every release increments generation, so
+    anything that caches series IDs outside of the meters can tell that its IDs may have been released.
+    """
+    _ids = dict()
+    _keys = []
+    _free_ids = []
+    _unused_ids = set()
+    _lock = Lock()
+    generation = 0
+
+    @classmethod
+    def intern(cls, key: tuple) -> int:
+        """
+        Returns the series ID of a metric key, assigning the next ID if the key has not been seen before.
+
+        :param key: tuple: A metric key of (tag, value) pairs
+        :return: int
+        """
+        series_id = cls._ids.get(key)
+        if series_id is None:
+            with cls._lock:
+                series_id = cls._ids.get(key)
+                if series_id is None:
+                    if cls._free_ids:
+                        series_id = cls._free_ids.pop()
+                        cls._keys[series_id] = key
+                    else:
+                        cls._keys.append(key)
+                        series_id = len(cls._keys) - 1
+                    cls._ids[key] = series_id
+        return series_id
+
+    @classmethod
+    def release_unused(cls, used_ids: set) -> int:
+        """
+        Releases the series IDs that are not in used_ids, along with their metric keys. An ID is only released once it
+        was unused at two consecutive calls, so that an ID which was looked up just before a call, but not recorded
+        yet, is not released from under the recording. See registry.MeterRegistry.release_unused_series, which collects
+        the IDs that the registered meters hold.
+
+        :param used_ids: set: The series IDs that are still held
+        :return: int: The number of IDs released
+        """
+        with cls._lock:
+            unused_ids = {series_id for series_id, key in enumerate(cls._keys)
+                          if key is not None and series_id not in used_ids}
+            released = unused_ids & cls._unused_ids
+            for series_id in released:
+                del cls._ids[cls._keys[series_id]]
+                cls._keys[series_id] = None
+            cls._free_ids += released
+            cls._unused_ids = unused_ids - released
+            if released:
+                cls.generation += 1
+        return len(released)
+
+    @classmethod
+    def key_of(cls, series_id: int) -> tuple:
+        """
+        Returns the metric key of a series ID.
+
+        :param series_id: int
+        :return: tuple
+        """
+        return cls._keys[series_id]
+
+    @classmethod
+    def canonical(cls, key: tuple) -> tuple:
+        """
+        Returns the interned instance of a metric key, so the meters that keep their series in dicts share their keys.
+
+        :param key: tuple
+        :return: tuple
+        """
+        return cls._keys[cls.intern(key)]
+
+    @classmethod
+    def size(cls) -> int:
+        return len(cls._keys) - len(cls._free_ids)
+
+
+class SeriesIdCache:
+    """
+    Caches series IDs under keys of the caller's choosing, eg the route, method and status code of a request, so that
+    code recording the same series over and over looks the tags up once. The cache is cleared whenever series IDs are
+    released, see TagSets.generation, and when it grows past max_size entries.
+
+    :param max_size: int: The number of keys to cache, None for no limit
+    """
+    def __init__(self, max_size: int = None):
+        self._max_size = max_size
+        self._ids = dict()
+        self._generation = TagSets.generation
+
+    def get(self, key, factory: callable):
+        """
+        Returns the series IDs cached under key, calling factory(key) to look them up on a miss.
+
+        :param key: Any hashable key
+        :param factory: callable(key) that returns the series ID, or a tuple of series IDs, of the key
+        :return: The value factory returned for key
+        """
+        if self._generation != TagSets.generation:
+            self._ids = dict()
+            self._generation = TagSets.generation
+        series_id = self._ids.get(key)
+        if series_id is None:
+            if self._max_size is not None and len(self._ids) >= self._max_size:
+                self._ids = dict()
+            series_id = self._ids[key] = factory(key)
+        return series_id
+
+
+class _SeriesTable:
+    """
+    Numeric columns indexed by series ID (see TagSets). Each series is given the next slot of every column the first
+    time it is written, so a Timer and its Counter can keep all their values in a single table. The values of a column
+    are held in an array("q") as long as they are integers that fit, and in a list once they are not, so every value
+    keeps its type.
+
+    :param column_count: int: The number of values every series has
+    :param meter: BaseMeter: The meter to report new series to the registry index for, see BaseMeter._index_series
+    """
+    __slots__ = ("_slots", "ids", "columns", "meter")
+    _new_series_lock = Lock()
+
+    def __init__(self, column_count: int = 1, meter: "BaseMeter" = None):
+        self._slots = dict()
+        self.ids = array("q")
+        self.columns = [array("q") for _ in range(column_count)]
+        self.meter = meter
+
+    def slot(self, series_id: int) -> int:
+        """
+        Returns the slot of a series, adding the series if it is not in the table yet.
+
+        :param series_id: int
+        :return: int
+        """
+        slot = self._slots.get(series_id)
+        if slot is None:
+            added = False
+            with self._new_series_lock:
+                slot = self._slots.get(series_id)
+                if slot is None:
+                    for values in self.columns:
+                        values.append(0)
+                    self.ids.append(series_id)
+                    slot = self._slots[series_id] = len(self.ids) - 1
+                    added = True
+            if added and self.meter is not None:
+                self.meter._index_series(TagSets.key_of(series_id))
+        return slot
+
+    def _as_list(self, column: int) -> list:
+        """
+        Switches a column to a list, under the lock that new series are added under so that no slot is appended to the
+        array while it is copied.
+
+        :param column: int
+        :return: list
+        """
+        with self._new_series_lock:
+            values = self.columns[column]
+            if not isinstance(values, list):
+                values = self.columns[column] = list(values)
+        return values
+
+    def add(self, slot: int, amount, column: int = 0) -> None:
+        values = self.columns[column]
+        try:
+            values[slot] += amount
+        except (TypeError, OverflowError):
+            self._as_list(column)[slot] += amount
+
+    def set(self, slot: int, value, column: int = 0) -> None:
+        values = self.columns[column]
+        try:
+            values[slot] = value
+        except (TypeError, OverflowError):
+            self._as_list(column)[slot] = value
+
+    def get(self, series_id: int, column: int = 0, default=None):
+        slot = self._slots.get(series_id)
+        return default if slot is None else self.columns[column][slot]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def export(self, column: int = 0) -> tuple:
+        """
+        Copies a column for an export, looking up the metric key of every series.
+
+        :param column: int
+        :return: tuple([tuple], array or list): The metric keys and their values, in the order the series were added
+        """
+        values = self.columns[column]
+        length = min(len(self.ids), len(values))
+        keys = TagSets._keys
+        return [keys[series_id] for series_id in self.ids[:length]], values[:length]
+
+    def as_dict(self, column: int = 0) -> dict:
+        return dict(zip(*self.export(column)))
+
+
 class BaseMeter:
     """
     The BaseMeter class provides some common functionality that should be shared across any fully fleshed out meter
@@ -85,8 +394,24 @@ class BaseMeter:
     """
     _name = None
     _tags = dict()
-    _metric_keys = set()
     _context_tags = dict()
+    _series_cache = None
+    _sample_rate = 1
+    _random_sampling = False
+    snapshot_type = None
+    owner = None
+    _skipped_calls = 0
+    _collection_interval = None
+    _collected_metrics = None
+    _collected_at = None
+    # Guards the state that drain swaps out, meters that record from several threads give every instance its own.
+    _state_lock = Lock()
+    # Whether the meter has series that follow from its current tags, see tag_series_keys.
+    _tag_derived_series = False
+    # Records values that were buffered outside of the meter into it, before it is collected, snapshotted or drained.
+    # This lets callbacks that must not take the state lock, eg the garbage collector pauses of RuntimeCollector, feed
+    # the meter.
+    _fold_pending = None
 
     @property
     def name(self) -> str:
@@ -119,6 +444,39 @@ class BaseMeter:
         copy_globals = GlobalTags.tags
         return {**copy_globals, **self._tags, **self._context_tags}
 
+    def _key_with_tags(self, tags: dict = None) -> tuple:
+        """
+        Builds the metric key for the current tags of the meter, combined with any extra tags given.
+
+        :param tags: {str, str} dictionary of extra tags, these take precedence over the tags of the meter
+        :return: tuple
+        """
+        if tags:
+            return tuple({**self.get_tags(), **tags}.items())
+        return tuple(self.get_tags().items())
+
+    def _series_id(self, tags: dict = None) -> int:
+        """
+        Returns the series ID (see TagSets) of the current tags of the meter, combined with any extra tags given. The ID
+        of the tags of the meter itself is cached along with copies of the tags it was looked up for, and is only used
+        while the tags of the meter and the global tags are still equal to them and no IDs have been released, so
+        recording without context tags neither builds nor hashes a metric key, even when the tag dicts are changed in
+        place.
+
+        :param tags: {str, str} dictionary of extra tags, these take precedence over the tags of the meter
+        :return: int
+        """
+        if tags or self._context_tags:
+            return TagSets.intern(self._key_with_tags(tags))
+        cache = self._series_cache
+        if cache is not None and cache[0] == TagSets.generation and cache[1] == self._tags and \
+                cache[2] == GlobalTags.tags:
+            return cache[3]
+        generation = TagSets.generation
+        series_id = TagSets.intern(tuple(self.get_tags().items()))
+        self._series_cache = (generation, dict(self._tags), dict(GlobalTags.tags), series_id)
+        return series_id
+
     def set_context_tags(self, tags: dict) -> None:
         """
         Sets the context tag dictionary of the meter to the input dictionary. These should always be reset between
@@ -164,6 +522,44 @@ class BaseMeter:
         """
         self._tags = _remove_tags(self._tags, tags)
 
+    def set_sample_rate(self, sample_rate: int, randomize: bool = False) -> None:
+        """
+        Sets the sampling rate used by the decorators of the meter. With a sample rate of N only 1 in N calls of a
+        decorated method will be measured, the other calls only bump an internal counter of skipped calls. Sampled calls
+        are recorded with a weight equal to the number of calls they represent (themselves plus any skipped calls since
+        the previous sample) so the extrapolated sums and counts stay correct. The calls skipped since the most recent
+        sample are not counted until the next sample is taken, so counts trail the true number of calls by those, which
+        is fewer than sample_rate calls unless randomize is set.
+        By default every Nth call is sampled, with randomize set each call is sampled with a probability of 1/N instead.
+        A sample rate of 1 (the default) measures every call exactly.
+
+        :param sample_rate: int: Measure 1 in sample_rate calls
+        :param randomize: bool: Whether to pick the sampled calls randomly instead of deterministically
+        :return:
+        """
+        if sample_rate < 1:
+            raise ValueError("Sample rate must be a positive integer, received {0}".format(sample_rate))
+        self._sample_rate = int(sample_rate)
+        self._random_sampling = randomize
+        self._skipped_calls = 0
+
+    def _sample_weight(self) -> int:
+        """
+        Decides whether the current call should be sampled. This should only be called when the sample rate is above 1.
+
+        :return: int: 0 if the call should be skipped, otherwise the number of calls that the sample represents
+        """
+        if self._random_sampling:
+            if random() * self._sample_rate >= 1:
+                self._skipped_calls += 1
+                return 0
+        elif self._skipped_calls + 1 < self._sample_rate:
+            self._skipped_calls += 1
+            return 0
+        weight = self._skipped_calls + 1
+        self._skipped_calls = 0
+        return weight
+
     def augmentor(self, method, method_results, *args, **kwargs) -> None:
         """
         Meters have the option to be able to use augmentor functions when they are using decorators to monitor a method.
@@ -180,14 +576,213 @@ class BaseMeter:
         """
         pass
 
+    def set_collection_interval(self, interval: float = None) -> None:
+        """
+        Sets the minimum number of seconds between two collections of the meter. Until the interval has passed the
+        registry serves the metrics of the previous collection, which keeps frequent scrapes from running expensive
+        measurements every time. Passing None collects the meter on every request again.
+
+        :param interval: float
+        :return:
+        """
+        self._collection_interval = interval or None
+        self._collected_metrics = None
+        self._collected_at = None
+
+    @property
+    def collection_age(self) -> float:
+        """
+        The number of seconds since the metrics the registry serves for this meter were collected, None if the meter
+        does not have a collection interval or has not been collected yet. This is exported as the gauge
+        <name>_collection_age_seconds, see collect_batches.
+
+        :return: float
+        """
+        if self._collected_at is None:
+            return None
+        return monotonic() - self._collected_at
+
+    @classmethod
+    def _produces_batches(cls) -> bool:
+        """
+        Tells whether the meter class implements get_batches itself, rather than get_metrics. Whichever of the two a
+        class overrides last is the one its metrics come from, the other one is derived from it.
+
+        :return: bool
+        """
+        for klass in cls.__mro__:
+            if klass is BaseMeter:
+                break
+            if "get_batches" in klass.__dict__:
+                return True
+            if "get_metrics" in klass.__dict__:
+                return False
+        raise NotImplementedError("Class {0} has not implemented the get_batches or the get_metrics function. "
+                                  "All meters must implement one of them".format(cls))
+
+    async def _get_batches(self) -> [MetricBatch]:
+        if self._produces_batches():
+            return await self.get_batches()
+        return _batches_from_metrics(await self.get_metrics())
+
+    async def collect_batches(self) -> [MetricBatch]:
+        """
+        Returns the metrics of the meter for the registry as batches, collecting the meter at most once per collection
+        interval. A meter with a collection interval adds the gauge <name>_collection_age_seconds, the number of seconds
+        since the metrics it serves were collected, so consumers can tell how fresh they are.
+
+        :return: [MetricBatch]
+        """
+        if self._fold_pending is not None:
+            self._fold_pending()
+        if self._collection_interval is None:
+            return await self._get_batches()
+        now = monotonic()
+        if self._collected_at is None or now - self._collected_at >= self._collection_interval:
+            self._collected_metrics = await self._get_batches()
+            self._collected_at = now
+        return self._collected_metrics + [MetricBatch(self.name + "_collection_age_seconds", "gauge",
+                                                      [tuple(self.get_tags().items())],
+                                                      array("d", [now - self._collected_at]))]
+
+    async def collect_metrics(self) -> [Metric]:
+        """
+        Returns the metrics of the meter for the registry, collecting the meter at most once per collection interval.
+
+        :return: [Metric]
+        """
+        return [metric for batch in await self.collect_batches() for metric in batch.metrics()]
+
+    def series_keys(self):
+        """
+        Returns the metric keys of the series the meter currently holds. The registry indexes the meters by these tags
+        when they are registered (see MeterRegistry.find_meters), after which the meters report every new series through
+        _index_series. A tag value of None stands for any value, and returning None means the series can not be known
+        without collecting the meter.
+
+        :return: A collection of metric keys, or None
+        """
+        return ()
+
+    def tag_series_keys(self):
+        """
+        Returns the metric keys of the series that follow from the current tags of the meter rather than from what was
+        recorded into it, eg the measurement of a Gauge. As tags can change at any time, the registry reads these at
+        every filtered collection for the meters that set _tag_derived_series. The values are as for series_keys.
+
+        :return: A collection of metric keys, or None
+        """
+        return ()
+
+    def series_ids(self) -> set:
+        """
+        Returns the series IDs (see TagSets) that the meter holds, which TagSets.release_unused must not release.
+
+        :return: set
+        """
+        return set()
+
+    def _index_series(self, key: tuple) -> None:
+        """
+        Reports a new series to the registry index, see MeterRegistry.index_series.
+
+        :param key: tuple: The metric key of the series
+        :return:
+        """
+        registry.MeterRegistry.index_series(self, key)
+
+    def snapshot(self) -> bytes:
+        """
+        Captures the current state of the meter in a compact binary snapshot (see knotty.snapshots). The snapshot can be
+        merged into a meter of the same type in another process, or persisted and merged back in later.
+
+        :return: bytes
+        """
+        return self._snapshot_writer().getvalue()
+
+    def _snapshot_writer(self) -> snapshots.SnapshotWriter:
+        if self._fold_pending is not None:
+            self._fold_pending()
+        writer = snapshots.SnapshotWriter(self.snapshot_type, self.name)
+        self._write_snapshot(writer)
+        return writer
+
+    def merge(self, snapshot: bytes) -> None:
+        """
+        Merges a snapshot taken from a meter of the same type into this meter. What merging means depends on the meter
+        type, eg counts and sums are added while gauges take the most recently merged value.
+
+        :param snapshot: bytes: A snapshot created by the snapshot method
+        :return:
+        """
+        reader = snapshots.SnapshotReader(snapshot)
+        if reader.meter_type != self.snapshot_type:
+            raise ValueError("Can not merge a snapshot of a {0} into {1} {2}"
+                             .format(reader.meter_type, self.snapshot_type, self.name))
+        self._merge_snapshot(reader)
+
+    def drain(self) -> bytes:
+        """
+        Takes a snapshot of the meter and resets it, so that every drained snapshot only holds what was recorded since
+        the previous one. Merging the drained snapshots one after the other adds up to the same state as merging a
+        single snapshot, which lets a process ship deltas to the knotty agent (see knotty.agent). The state is swapped
+        out under the state lock of the meter, which every recording takes as well, so no recording can go to the
+        drained state after it has been copied.
+
+        :return: bytes
+        """
+        return self._drain_writer().getvalue()
+
+    def drain_split(self, max_size: int) -> [bytes]:
+        """
+        Drains the meter like drain, split into snapshots of at most max_size bytes that each hold a range of the series
+        (see knotty.snapshots.SnapshotWriter.split), eg to send them in datagrams. A snapshot of a single series that is
+        larger than max_size can not be split, and is the only snapshot that exceeds it.
+
+        :param max_size: int: The size in bytes the snapshots should not exceed
+        :return: [bytes]
+        """
+        return self._drain_writer().split(max_size)
+
+    def _drain_writer(self) -> snapshots.SnapshotWriter:
+        if self._fold_pending is not None:
+            self._fold_pending()
+        with self._state_lock:
+            drained = copy(self)
+            self._reset()
+        drained._fold_pending = None
+        return drained._snapshot_writer()
+
+    def _reset(self) -> None:
+        raise NotImplementedError("Class {0} does not support snapshots".format(self.__class__))
+
+    def _write_snapshot(self, writer: snapshots.SnapshotWriter) -> None:
+        raise NotImplementedError("Class {0} does not support snapshots".format(self.__class__))
+
+    def _merge_snapshot(self, reader: snapshots.SnapshotReader) -> None:
+        raise NotImplementedError("Class {0} does not support snapshots".format(self.__class__))
+
+    async def get_batches(self) -> [MetricBatch]:
+        """
+        All meters need to expose an async method to return their metrics to the registry, either as batches through
+        this method or as a list of metrics through get_metrics.
+
+        :return: [MetricBatch]
+        """
+        if self._produces_batches():
+            raise NotImplementedError("Class {0} has not implemented the get_batches function".format(self.__class__))
+        return _batches_from_metrics(await self.get_metrics())
+
     async def get_metrics(self) -> [Metric]:
         """
-        All meters need to expose and async method to return a list of metrics to the registry.
+        Returns the metrics of the meter as a list with one Metric per sample. Meters that implement get_batches get
+        this from their batches.
 
         :return: [Metric]
         """
-        raise NotImplementedError("Class {0} has not implemented the get_metrics functions. "
-                                  "All meters must implement this function".format(self.__class__))
+        if not self._produces_batches():
+            raise NotImplementedError("Class {0} has not implemented the get_metrics function".format(self.__class__))
+        return [metric for batch in await self.get_batches() for metric in batch.metrics()]
 
 
 class Timer(BaseMeter):
@@ -195,51 +790,337 @@ class Timer(BaseMeter):
     The Timer Meter is designed to measure the total execution time of a given callable as well as keeping track of how
     many times it has been called. This provides a good sense of the average execution time of a function. If more
     detail is need, try using the Histogram instead.
+
+    Times are measured with the monotonic perf_counter_ns clock and stored as integer nanoseconds, they are only
+    converted to seconds when metrics are exported. Optionally the Timer can also record the CPU time spent in each call
+    (see set_cpu_clock), which makes it possible to tell CPU bound calls apart from calls that are mostly waiting.
     """
+    _cpu_clocks = {"thread": thread_time_ns, "process": process_time_ns}
+    snapshot_type = "Timer"
+    # The columns of the series table the Timer shares with its Counter.
+    _total_column, _current_column, _count_column = 0, 1, 2
+
     def __init__(self, name: str):
         self._name = name
-        # Current times can probably get blasted out of here.
-        self.current_time = dict()
-        self.total_time = dict()
+        self._state_lock = Lock()
+        self._series = _SeriesTable(3, self)
+        self._cpu_times = _SeriesTable()
+        self._cpu_clock = None
+        self._slow_calls = None
+        self._slow_call_limit = 0
+        self._slow_call_window = None
+        self._slow_call_window_start = 0
+        self._argument_summarizer = None
+        self._slow_call_sequence = count()
+        self.latency_histogram = None
         self.counter = Counter(name + "_time_count")
         self.counter.modify_prometheus_type("summary")
+        self.counter.owner = self
+        self.counter._series, self.counter._count_column = self._series, self._count_column
+        self.counter._state_lock = self._state_lock
         self._ensure_registered_with_registry()
 
+    @property
+    def current_time(self) -> {tuple: int}:
+        """
+        The last time recorded for every series in nanoseconds.
+
+        :return: {tuple: int}
+        """
+        return self._series.as_dict(self._current_column)
+
+    @property
+    def total_time(self) -> {tuple: int}:
+        """
+        The total time recorded for every series in nanoseconds.
+
+        :return: {tuple: int}
+        """
+        return self._series.as_dict(self._total_column)
+
+    @property
+    def cpu_time(self) -> {tuple: int}:
+        """
+        The total CPU time recorded for every series in nanoseconds, for the series that recorded any.
+
+        :return: {tuple: int}
+        """
+        return self._cpu_times.as_dict()
+
+    def set_cpu_clock(self, clock: str = "thread") -> None:
+        """
+        Enables recording of CPU time next to the wall time of every timed call. The CPU time is exported as a separate
+        counter named <name>_cpu_time_total.
+
+        :param clock: str: "thread" to use thread_time_ns, "process" to use process_time_ns or None to disable
+        :return:
+        """
+        if clock is None:
+            self._cpu_clock = None
+            return
+        if clock not in self._cpu_clocks:
+            raise ValueError("Unknown cpu clock {0}, expected one of {1}".format(clock, list(self._cpu_clocks)))
+        self._cpu_clock = self._cpu_clocks[clock]
+
+    def enable_latency_histogram(self, significant_digits: int = 2,
+                                 highest_trackable_value: float = 3600) -> "LatencyHistogram":
+        """
+        Starts recording every measured time into a LatencyHistogram named <name>_latency, so the full distribution of
+        the timed calls is exported next to the sum and count of the Timer.
+
+        :param significant_digits: int: The precision of the recorded times, see LatencyHistogram.set_precision
+        :param highest_trackable_value: float: The highest time in seconds that can be told apart from larger ones
+        :return: LatencyHistogram: The histogram, eg to change its export mode
+        """
+        latency_histogram = registry.MeterRegistry.get_meter(self.name + "_latency", LatencyHistogram)
+        latency_histogram.set_precision(significant_digits, highest_trackable_value)
+        self.latency_histogram = latency_histogram
+        return latency_histogram
+
+    def enable_slow_call_capture(self, max_calls: int = 10, window: float = 60,
+                                 argument_summarizer: callable = None) -> None:
+        """
+        Starts keeping the max_calls slowest invocations of every metric key in a bounded min-heap, so the memory used
+        is fixed and every capture costs at most O(log max_calls). The captured calls are dropped every window seconds
+        so they always describe the current window, pass None to never drop them. The argument_summarizer is called
+        with the args and kwargs of a call only when the call is slow enough to be kept, and its return value is stored
+        with the call. Keep it cheap and make sure it does not hold on to large objects.
+
+        :param max_calls: int: The number of slow calls to keep per metric key
+        :param window: float: The length of a capture window in seconds
+        :param argument_summarizer: callable(args, kwargs) that returns a small summary of the call arguments
+        :return:
+        """
+        if max_calls < 1:
+            raise ValueError("max_calls must be a positive integer, received {0}".format(max_calls))
+        self._slow_call_limit = max_calls
+        self._slow_call_window = None if window is None else int(window * 1e9)
+        self._slow_call_window_start = perf_counter_ns()
+        self._argument_summarizer = argument_summarizer
+        self._slow_calls = dict()
+
+    def disable_slow_call_capture(self) -> None:
+        """
+        Stops capturing slow calls and releases the captured ones.
+
+        :return:
+        """
+        self._slow_calls = None
+
+    def _capture_slow_call(self, metric_key: tuple, execution_time: int, args: tuple = None,
+                           kwargs: dict = None) -> None:
+        """
+        Offers a call to the slow call heap of the given metric key. Durations that were not measured by the timer
+        itself, eg those recorded through record_many, have no arguments and are kept without a summary.
+
+        :param metric_key: tuple
+        :param execution_time: int: Wall time of the call in nanoseconds
+        :param args: The args that were passed into the timed method, None if they are not known
+        :param kwargs: The keyword args that were passed into the timed method
+        :return:
+        """
+        now = perf_counter_ns()
+        if self._slow_call_window is not None and now - self._slow_call_window_start >= self._slow_call_window:
+            self._slow_calls = dict()
+            self._slow_call_window_start = now
+        heap = self._slow_calls.get(metric_key)
+        if heap is None:
+            heap = self._slow_calls[metric_key] = []
+        elif len(heap) >= self._slow_call_limit and execution_time <= heap[0][0]:
+            return
+        arguments = None if self._argument_summarizer is None or args is None else \
+            self._argument_summarizer(args, kwargs or {})
+        entry = (execution_time, next(self._slow_call_sequence), SlowCall(execution_time / 1e9, time(), metric_key,
+                                                                           arguments))
+        if len(heap) < self._slow_call_limit:
+            heappush(heap, entry)
+        else:
+            heapreplace(heap, entry)
+
+    def get_slowest_calls(self) -> {tuple: [SlowCall]}:
+        """
+        Returns the slowest calls captured in the current window for every metric key, slowest first. This is empty
+        unless enable_slow_call_capture has been called.
+
+        :return: {tuple: [SlowCall]}
+        """
+        slow_calls = self._slow_calls
+        if not slow_calls:
+            return dict()
+        if self._slow_call_window is not None and \
+                perf_counter_ns() - self._slow_call_window_start >= self._slow_call_window:
+            return dict()
+        return {key: [entry[2] for entry in sorted(heap, reverse=True)] for key, heap in list(slow_calls.items())}
+
+    def _record(self, metric_key: tuple, execution_time: int, cpu_time: int = None, weight: int = 1) -> None:
+        """
+        Stores a single measurement for the given metric key.
+
+        :param metric_key: tuple
+        :param execution_time: int: Wall time of the call in nanoseconds
+        :param cpu_time: int: CPU time of the call in nanoseconds, if it was measured
+        :param weight: int: The number of calls this measurement represents when sampling
+        :return:
+        """
+        self._record_series(TagSets.intern(metric_key), execution_time, cpu_time, weight)
+
+    def _record_series(self, series_id: int, execution_time: int, cpu_time: int = None, weight: int = 1) -> None:
+        """
+        Stores a single measurement for the given series ID, see _record.
+
+        :param series_id: int: See TagSets
+        :param execution_time: int: Wall time of the call in nanoseconds
+        :param cpu_time: int: CPU time of the call in nanoseconds, if it was measured
+        :param weight: int: The number of calls this measurement represents when sampling
+        :return:
+        """
+        with self._state_lock:
+            series = self._series
+            slot = series._slots.get(series_id)
+            if slot is None:
+                slot = series.slot(series_id)
+            series.add(slot, execution_time * weight)
+            series.set(slot, execution_time, self._current_column)
+            series.add(slot, weight, self._count_column)
+            if cpu_time is not None:
+                self._cpu_times.add(self._cpu_times.slot(series_id), cpu_time * weight)
+        if self.latency_histogram is not None:
+            self.latency_histogram.record(execution_time, TagSets.key_of(series_id), weight)
+
+    def record_many(self, durations, tags: dict = None) -> None:
+        """
+        Records a batch of durations for a single series at once, eg when timings have been collected elsewhere. The
+        durations are converted, summed and counted in one vectorized operation.
+
+        :param durations: A list or NumPy array of durations in seconds
+        :param tags: {str, str} dictionary of extra tags for the series, combined with the tags of the Timer
+        :return:
+        """
+        durations = (asarray(durations, dtype=float64) * 1e9).astype(int64)
+        if not len(durations):
+            return
+        series_id = self._series_id(tags)
+        metric_key = TagSets.key_of(series_id)
+        with self._state_lock:
+            series = self._series
+            slot = series.slot(series_id)
+            series.add(slot, int(durations.sum()))
+            series.set(slot, int(durations[-1]), self._current_column)
+            series.add(slot, len(durations), self._count_column)
+        if self.latency_histogram is not None:
+            self.latency_histogram.record_many(durations, metric_key)
+        if self._slow_calls is not None:
+            slowest = durations if len(durations) <= self._slow_call_limit else \
+                durations[argpartition(durations, -self._slow_call_limit)[-self._slow_call_limit:]]
+            for duration in slowest:
+                self._capture_slow_call(metric_key, int(duration))
+        self.reset_context_tags()
+
     def timer(self, method: callable) -> callable:
         """
         Wraps the given method and measures how long it takes to run at every invocation. The augmentor can be
         utilized to provide any additionally needed functionality around the method call. The times are summed as the
-        process continues to run, and a Counter is incremented at each execution to provide a full summary metric.
+        process continues to run, and a Counter is incremented at each execution to provide a full summary metric. If a
+        sample rate has been set only the sampled calls are measured.
 
         :param method: callable
         :return:
         """
         @wraps(method)
         def measure_execution(*args, callback_timer: Timer = self, **kwargs):
-            start = time()
-            method_result = method(*args, **kwargs)
-            execution_time = time() - start
+            weight = 1 if callback_timer._sample_rate == 1 else callback_timer._sample_weight()
+            if not weight:
+                return method(*args, **kwargs)
+            cpu_clock = callback_timer._cpu_clock
+            if cpu_clock is None:
+                cpu_time = None
+                start = perf_counter_ns()
+                method_result = method(*args, **kwargs)
+                execution_time = perf_counter_ns() - start
+            else:
+                cpu_start = cpu_clock()
+                start = perf_counter_ns()
+                method_result = method(*args, **kwargs)
+                execution_time = perf_counter_ns() - start
+                cpu_time = cpu_clock() - cpu_start
             callback_timer.augmentor(callback_timer, method, method_result, *args, **kwargs)
-            metric_key = tuple(callback_timer.get_tags().items())
-            callback_timer._metric_keys.add(metric_key)
-            callback_timer.current_time[metric_key] = execution_time
-            callback_timer.total_time[metric_key] = (callback_timer.total_time.get(metric_key) or 0) + execution_time
-            callback_timer.counter.increment(metric_key=metric_key)
+            series_id = callback_timer._series_id()
+            callback_timer._record_series(series_id, execution_time, cpu_time, weight)
+            if callback_timer._slow_calls is not None:
+                callback_timer._capture_slow_call(TagSets.key_of(series_id), execution_time, args, kwargs)
             callback_timer.reset_context_tags()
             return method_result
 
         return measure_execution
 
-    async def get_metrics(self) -> [Metric]:
+    def series_keys(self):
+        return self._series.export()[0]
+
+    def series_ids(self) -> set:
+        return {*self._series.ids, *self._cpu_times.ids}
+
+    def _index_series(self, key: tuple) -> None:
         """
-        Returns a list of metrics for the Timer instance. This will only return the sum of the time spent, however a
-        complimentary Counter will generate the partner metric for the summary to be complete.
+        Reports a new series for the Timer and for its Counter, which shares its series.
 
-        :return: [Metric]
+        :param key: tuple
+        :return:
+        """
+        super()._index_series(key)
+        self.counter._index_series(key)
+
+    def _reset(self) -> None:
+        self._series = _SeriesTable(3, self)
+        self._cpu_times = _SeriesTable()
+        self.counter._series = self._series
+
+    def _write_snapshot(self, writer: snapshots.SnapshotWriter) -> None:
         """
-        total_metrics = [Metric(self.name+"_time_sum", key, value, "summary")
-                         for key, value in self.total_time.items()]
-        return total_metrics
+        Writes the total time, CPU time and count of every series. The count is taken from the partner Counter so that
+        a Timer snapshot is complete on its own.
+
+        :param writer: knotty.snapshots.SnapshotWriter
+        :return:
+        """
+        series = self._series
+        length = len(series)
+        writer.write_series_count(length)
+        for series_id, total_time, count in zip(series.ids[:length], series.columns[self._total_column][:length],
+                                                series.columns[self._count_column][:length]):
+            writer.write_series_key(TagSets.key_of(series_id))
+            writer.write_number(total_time)
+            writer.write_number(count)
+            writer.write_optional_number(self._cpu_times.get(series_id))
+
+    def _merge_snapshot(self, reader: snapshots.SnapshotReader) -> None:
+        for _ in range(reader.read_varint()):
+            key = reader.read_tags()
+            total_time = reader.read_number()
+            count = reader.read_number()
+            cpu_time = reader.read_optional_number()
+            series_id = TagSets.intern(key)
+            with self._state_lock:
+                slot = self._series.slot(series_id)
+                self._series.add(slot, total_time)
+                self._series.add(slot, count, self._count_column)
+                if cpu_time is not None:
+                    self._cpu_times.add(self._cpu_times.slot(series_id), cpu_time)
+
+    async def get_batches(self) -> [MetricBatch]:
+        """
+        Returns the metrics of the Timer instance. This will only return the sum of the time spent, however a
+        complimentary Counter will generate the partner metric for the summary to be complete. If CPU time is being
+        recorded, its total is returned as well.
+
+        :return: [MetricBatch]
+        """
+        batches = []
+        for name, prometheus_type, times in ((self.name + "_time_sum", "summary", self._series),
+                                             (self.name + "_cpu_time_total", "counter", self._cpu_times)):
+            keys, values = times.export()
+            if keys:
+                batches.append(MetricBatch(name, prometheus_type, keys, array("d", [value / 1e9 for value in values])))
+        return batches
 
 
 class Counter(BaseMeter):
@@ -249,27 +1130,42 @@ class Counter(BaseMeter):
     Gauge instead.
     """
 
+    snapshot_type = "Counter"
+    _count_column = 0
+
     def __init__(self, name: str):
         self._name = name
-        self._count = dict()
+        self._state_lock = Lock()
+        self._series = _SeriesTable(meter=self)
         self._ensure_registered_with_registry()
         self._prometheus_type = "counter"
 
+    @property
+    def _count(self) -> {tuple: int}:
+        """
+        The count of every series by metric key.
+
+        :return: {tuple: int}
+        """
+        return self._series.as_dict(self._count_column)
+
     def auto_count_method(self, method: callable) -> callable:
         """
         Wraps the given method and increments the counter by 1 every time the function is called. The augmentor can be
-        utilized to provide any additionally needed functionality around the method call.
+        utilized to provide any additionally needed functionality around the method call. If a sample rate has been set
+        only the sampled calls run the augmentor, and they increment the counter by the number of calls they represent.
 
         :param method: callable
         :return:
         """
         @wraps(method)
         def count_execution(*args, callback_counter: Counter = self, **kwargs):
+            weight = 1 if callback_counter._sample_rate == 1 else callback_counter._sample_weight()
             method_result = method(*args, **kwargs)
+            if not weight:
+                return method_result
             callback_counter.augmentor(callback_counter, method, method_result, *args, **kwargs)
-            metric_key = tuple(callback_counter.get_tags().items())
-            callback_counter._metric_keys.add(metric_key)
-            callback_counter.increment(metric_key=metric_key)
+            callback_counter._add(callback_counter._series_id(), weight)
             callback_counter.reset_context_tags()
             return method_result
 
@@ -294,18 +1190,276 @@ class Counter(BaseMeter):
         :param metric_key:
         :return:
         """
+        if metric_key:
+            series_id = TagSets._ids.get(metric_key)
+            self._add(TagSets.intern(metric_key) if series_id is None else series_id, amount)
+        else:
+            self._add(self._series_id(), amount)
+        self.reset_context_tags()
+
+    def increment_many(self, amounts: {tuple: int}) -> None:
+        """
+        Increments several series of the Counter at once. The keys are metric keys as used by increment, a key of None
+        stands for the current tags of the Counter.
+
+        :param amounts: {tuple: int} The amount to increment each metric key by
+        :return:
+        """
+        for key, amount in amounts.items():
+            self._add(self._series_id() if key is None else TagSets.intern(key), amount)
+        self.reset_context_tags()
+
+    def _add(self, series_id: int, amount) -> None:
+        """
+        Increments the series with the given series ID, see TagSets.
+
+        :param series_id: int
+        :param amount:
+        :return:
+        """
+        with self._state_lock:
+            series = self._series
+            slot = series._slots.get(series_id)
+            if slot is None:
+                slot = series.slot(series_id)
+            values = series.columns[self._count_column]
+            try:
+                values[slot] += amount
+            except (TypeError, OverflowError):
+                series.add(slot, amount, self._count_column)
+
+    def series_keys(self):
+        return self._series.export(self._count_column)[0]
+
+    def series_ids(self) -> set:
+        return set(self._series.ids)
+
+    def _reset(self) -> None:
+        if self.owner is not None:
+            # The series table is shared with the owning Timer, whose sums are meaningless without the counts.
+            self.owner._reset()
+            return
+        self._series = _SeriesTable(meter=self)
+
+    def _write_snapshot(self, writer: snapshots.SnapshotWriter) -> None:
+        keys, values = self._series.export(self._count_column)
+        writer.write_series_count(len(keys))
+        for key, value in zip(keys, values):
+            writer.write_series_key(key)
+            writer.write_number(value)
+
+    def _merge_snapshot(self, reader: snapshots.SnapshotReader) -> None:
+        self.increment_many({reader.read_tags(): reader.read_number() for _ in range(reader.read_varint())})
+
+    async def get_batches(self) -> [MetricBatch]:
+        """
+        Returns the metrics of the Counter instance.
+
+        :return: [MetricBatch]
+        """
+        keys, values = self._series.export(self._count_column)
+        if not keys:
+            return []
+        return [MetricBatch(self.name, self._prometheus_type, keys,
+                            values if isinstance(values, array) else _value_column(values))]
+
+
+class _MovingRates:
+    """
+    Keeps the exponentially weighted moving rates of a single Meter series. Marks are only added to a pending count, the
+    rates are updated in fixed ticks which are caught up lazily whenever the series is marked or read, so both are O(1)
+    no matter how long the series has been idle.
+    """
+    tick_interval = 5.0
+    windows = (("1m", 1), ("5m", 5), ("15m", 15))
+    alphas = tuple(1 - exp(-5.0 / 60.0 / minutes) for _, minutes in windows)
+
+    __slots__ = ("count", "uncounted", "rates", "initialized", "start_time", "last_tick")
+
+    def __init__(self, now: float):
+        self.count = 0
+        self.uncounted = 0
+        self.rates = [0.0] * len(self.alphas)
+        self.initialized = False
+        self.start_time = now
+        self.last_tick = now
+
+    def mark(self, amount: int, now: float) -> None:
+        if now - self.last_tick >= self.tick_interval:
+            self.tick(now)
+        self.count += amount
+        self.uncounted += amount
+
+    def tick(self, now: float) -> None:
+        """
+        Applies every tick that has elapsed since the last one. The first elapsed tick absorbs the pending marks, the
+        remaining ones had no marks and only decay the rates, which can be done in a single step.
+
+        :param now: float: The current monotonic time
+        :return:
+        """
+        ticks = int((now - self.last_tick) // self.tick_interval)
+        if ticks < 1:
+            return
+        self.last_tick += ticks * self.tick_interval
+        instant_rate = self.uncounted / self.tick_interval
+        self.uncounted = 0
+        for index, alpha in enumerate(self.alphas):
+            if self.initialized:
+                rate = self.rates[index] + alpha * (instant_rate - self.rates[index])
+            else:
+                rate = instant_rate
+            self.rates[index] = rate * (1 - alpha) ** (ticks - 1)
+        self.initialized = True
+
+    def mean_rate(self, now: float) -> float:
+        elapsed = now - self.start_time
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+
+class Meter(BaseMeter):
+    """
+    The Meter measures the rate at which events occur. Next to the total number of events it keeps exponentially
+    weighted moving rates over 1, 5 and 15 minutes, as well as the mean rate since the series was first marked, all in
+    events per second. This makes throughput directly available to push backends that can not cheaply compute rates
+    from counters themselves.
+    """
+    snapshot_type = "Meter"
+
+    def __init__(self, name: str):
+        self._name = name
+        self._state_lock = Lock()
+        self._rates = dict()
+        self._ensure_registered_with_registry()
+
+    def mark(self, amount: int = 1, metric_key: tuple = None) -> None:
+        """
+        Marks the occurrence of the given number of events for the corresponding metric_key.
+
+        :param amount: int
+        :param metric_key: tuple
+        :return:
+        """
         key = metric_key or tuple(self.get_tags().items())
-        self._metric_keys.add(key)
-        self._count[key] = (self._count.get(key) or 0) + amount
+        now = monotonic()
+        with self._state_lock:
+            rates = self._rates.get(key)
+            if rates is None:
+                key = TagSets.canonical(key)
+                rates = self._rates[key] = _MovingRates(now)
+                self._index_series(key)
+            rates.mark(amount, now)
         self.reset_context_tags()
 
-    async def get_metrics(self) -> [Metric]:
+    def auto_mark_method(self, method: callable) -> callable:
         """
-        Returns a list of metrics for the Counter instance.
+        Wraps the given method and marks one event every time the function is called. The augmentor can be utilized to
+        provide any additionally needed functionality around the method call. If a sample rate has been set only the
+        sampled calls run the augmentor, and they mark the number of calls they represent.
 
-        :return: [Metric]
+        :param method: callable
+        :return:
         """
-        return [Metric(self.name, key, value, self._prometheus_type) for key, value in self._count.items()]
+        @wraps(method)
+        def mark_execution(*args, callback_meter: Meter = self, **kwargs):
+            weight = 1 if callback_meter._sample_rate == 1 else callback_meter._sample_weight()
+            method_result = method(*args, **kwargs)
+            if not weight:
+                return method_result
+            callback_meter.augmentor(callback_meter, method, method_result, *args, **kwargs)
+            callback_meter.mark(amount=weight, metric_key=tuple(callback_meter.get_tags().items()))
+            return method_result
+
+        return mark_execution
+
+    def _drain_writer(self) -> snapshots.SnapshotWriter:
+        """
+        Drained Meter snapshots only hold the number of events marked since the previous drain and no rates. Merging
+        them marks those events, so the moving rates are calculated by the meter the snapshots are merged into.
+
+        :return: knotty.snapshots.SnapshotWriter
+        """
+        with self._state_lock:
+            rates, self._rates = self._rates, dict()
+        writer = snapshots.SnapshotWriter(self.snapshot_type, self.name)
+        writer.write_series_count(len(rates))
+        for key, series in rates.items():
+            writer.write_series_key(key)
+            writer.write_number(series.count)
+            writer.write_varint(0)
+            writer.write_array([])
+        return writer
+
+    def series_keys(self):
+        return self._rates.keys()
+
+    def _reset(self) -> None:
+        self._rates = dict()
+
+    def _write_snapshot(self, writer: snapshots.SnapshotWriter) -> None:
+        """
+        Writes the count and the moving rates of every series, after ticking them.
+
+        :param writer: knotty.snapshots.SnapshotWriter
+        :return:
+        """
+        now = monotonic()
+        rates = dict(self._rates)
+        writer.write_series_count(len(rates))
+        for key, series in rates.items():
+            series.tick(now)
+            writer.write_series_key(key)
+            writer.write_number(series.count)
+            writer.write_varint(int(series.initialized))
+            writer.write_array(series.rates)
+
+    def _merge_snapshot(self, reader: snapshots.SnapshotReader) -> None:
+        """
+        Adds the counts and the moving rates of the snapshot to those of this Meter. This is correct when the snapshot
+        comes from a different source of events, such as another process. The events of a drained snapshot, which has no
+        rates, are marked instead.
+
+        :param reader: knotty.snapshots.SnapshotReader
+        :return:
+        """
+        now = monotonic()
+        for _ in range(reader.read_varint()):
+            key = reader.read_tags()
+            count = reader.read_number()
+            initialized = bool(reader.read_varint())
+            merged_rates = reader.read_array()
+            with self._state_lock:
+                series = self._rates.get(key)
+                if series is None:
+                    key = TagSets.canonical(key)
+                    series = self._rates[key] = _MovingRates(now)
+                    self._index_series(key)
+                if not len(merged_rates):
+                    series.mark(count, now)
+                    continue
+                series.tick(now)
+                series.count += count
+                series.rates = [rate + float(merged) for rate, merged in zip(series.rates, merged_rates)]
+                series.initialized = series.initialized or initialized
+
+    async def get_batches(self) -> [MetricBatch]:
+        """
+        Returns the metrics of the Meter instance. This ticks every series that is due before reading it.
+
+        :return: [MetricBatch]
+        """
+        now = monotonic()
+        series = list(self._rates.items())
+        if not series:
+            return []
+        rate_items = []
+        for key, rates in series:
+            rates.tick(now)
+            rate_items += [(key + (("window", window),), rate) for (window, _), rate in zip(rates.windows, rates.rates)]
+        return [MetricBatch.from_items(self.name + "_total", "counter", [(key, rates.count) for key, rates in series]),
+                MetricBatch.from_items(self.name + "_rate", "gauge", rate_items),
+                MetricBatch.from_items(self.name + "_mean_rate", "gauge",
+                                       [(key, rates.mean_rate(now)) for key, rates in series])]
 
 
 class Gauge(BaseMeter):
@@ -315,12 +1469,16 @@ class Gauge(BaseMeter):
     """
 
     logger = getLogger(__name__)
+    snapshot_type = "Gauge"
+    merged_value_ttl = 300
+    _tag_derived_series = True
 
     def __init__(self, name: str):
         self._name = name
         self.value_function = None
         self.key_tag = None
         self.value_key = None
+        self._merged_values = dict()
         self._ensure_registered_with_registry()
         self._integer_return = True
 
@@ -371,9 +1529,9 @@ class Gauge(BaseMeter):
         self.value_key = value_key
         self._integer_return = not bool(key_tag) and not bool(value_key)
 
-    async def get_metrics(self) -> [Metric]:
+    def _measure(self) -> [Metric]:
         """
-        Returns a list of metrics for the Gauge instance.
+        Calls the gauge function and translates its measurement into metrics.
 
         :return: [Metric]
         """
@@ -410,45 +1568,205 @@ class Gauge(BaseMeter):
 
         except Exception as e:
             self.logger.error(e)
+        return []
+
+    def series_keys(self):
+        return list(self._merged_values)
+
+    def tag_series_keys(self):
+        """
+        The series of a gauge function are only known once it is measured. A gauge function returning a dictionary adds
+        its key_tag with any value to the tags of the gauge, one returning a list of dictionaries can add any tag.
+
+        :return: A list of metric keys, or None
+        """
+        if self.value_function is None:
+            return ()
+        if self._integer_return:
+            return [tuple(self.get_tags().items())]
+        if self.key_tag is not None:
+            return [tuple({**self.get_tags(), self.key_tag: None}.items())]
+        return None
+
+    def _reset(self) -> None:
+        """
+        Gauges hold measurements rather than sums, so there is nothing to reset when they are drained.
+
+        :return:
+        """
+        pass
+
+    def _write_snapshot(self, writer: snapshots.SnapshotWriter) -> None:
+        """
+        Writes the current measurement of the gauge function, and any values merged into this gauge, as gauges are not
+        additive.
+
+        :param writer: knotty.snapshots.SnapshotWriter
+        :return:
+        """
+        values = {**self._live_merged_values(),
+                  **{metric.tags: metric.value for metric in (self._measure() if self.value_function else [])}}
+        writer.write_series_count(len(values))
+        for key, value in values.items():
+            writer.write_series_key(key)
+            writer.write_number(value)
+
+    def _merge_snapshot(self, reader: snapshots.SnapshotReader) -> None:
+        """
+        Stores the values of the snapshot, replacing any earlier merged value of the same series. They are exported
+        next to the measurements of the gauge function until merged_value_ttl seconds have passed without a newer value,
+        so the series of processes that have exited disappear.
+
+        :param reader: knotty.snapshots.SnapshotReader
+        :return:
+        """
+        now = monotonic()
+        for _ in range(reader.read_varint()):
+            key = reader.read_tags()
+            if key not in self._merged_values:
+                self._index_series(key)
+            self._merged_values[key] = (reader.read_number(), now)
+
+    def set_merged_value_ttl(self, ttl: float = 300) -> None:
+        """
+        Sets the number of seconds a merged value is exported for after it was merged, pass None to keep merged values
+        until they are replaced.
+
+        :param ttl: float
+        :return:
+        """
+        self.merged_value_ttl = ttl
+
+    def _live_merged_values(self) -> {tuple: float}:
+        """
+        Drops the merged values that have outlived merged_value_ttl, and returns the others.
+
+        :return: {tuple: float}
+        """
+        oldest = None if self.merged_value_ttl is None else monotonic() - self.merged_value_ttl
+        live_values = dict()
+        for key, entry in list(self._merged_values.items()):
+            if oldest is None or entry[1] >= oldest:
+                live_values[key] = entry[0]
+            elif self._merged_values.get(key) is entry:
+                del self._merged_values[key]
+        return live_values
+
+    async def get_batches(self) -> [MetricBatch]:
+        """
+        Returns the metrics of the Gauge instance.
+
+        :return: [MetricBatch]
+        """
+        items = [(metric.tags, metric.value) for metric in self._measure()] if self.value_function is not None else []
+        items += list(self._live_merged_values().items())
+        return [MetricBatch.from_items(self.name, "gauge", items)] if items else []
 
 
 class Histogram(BaseMeter):
     """
     The Histogram meter is used to keep track of a set of data and provide statistical analysis regarding their
-    distribution.
+    distribution. The values of every series are kept in a reservoir, by default the most recent values regardless of
+    their age are kept. Use set_reservoir to keep the values of a time window instead (see knotty.reservoirs).
+
+    Snapshots hold the count and sum of every series next to a sketch of its values, at most sketch_size weighted
+    centroids, rather than the values themselves. The snapshots merged into a histogram are kept apart from its
+    reservoirs, their counts and sums are added to those of the reservoirs and their sketches are combined with the
+    reservoir values for the buckets and percentiles.
     """
+    snapshot_type = "Histogram"
+    sketch_size = 100
 
     # Todo: Add method to summarize function call time.
     logger = getLogger(__name__)
 
     def __init__(self, name: str):
         self._name = name
+        self._state_lock = Lock()
         self._current_values = dict()
         self._bin_count = 10
         self._percentiles = [50, 75, 90, 95, 99]
         self._max_data_values = 1000
+        self._reservoir_class = None
+        self._reservoir_arguments = dict()
+        self._merged = dict()
         self._ensure_registered_with_registry()
 
-    def add_new_value(self, value: float, metric_key: tuple = None) -> None:
+    def set_reservoir(self, reservoir_class: "type(reservoirs.Reservoir)" = None, **reservoir_arguments) -> None:
+        """
+        Sets the kind of reservoir used to store the values of every series, eg:
+
+        histogram.set_reservoir(reservoirs.SlidingTimeWindowReservoir, window=60)
+
+        The reservoir_arguments are passed to the reservoir class for every new series. Passing no class restores the
+        default reservoir that keeps the most recent values (see set_max_data_values). Any previously stored values are
+        discarded.
+
+        :param reservoir_class: A subclass of knotty.reservoirs.Reservoir
+        :param reservoir_arguments: Keyword arguments for the reservoir class
+        :return:
+        """
+        self._reservoir_class = reservoir_class
+        self._reservoir_arguments = reservoir_arguments
+        self._current_values = dict()
+
+    def _new_reservoir(self) -> reservoirs.Reservoir:
+        """
+        Creates the reservoir for a new series.
+
+        :return: knotty.reservoirs.Reservoir
+        """
+        if self._reservoir_class is None:
+            return reservoirs.RecentValuesReservoir(self._max_data_values)
+        return self._reservoir_class(**self._reservoir_arguments)
+
+    def _reservoir_for(self, key: tuple) -> reservoirs.Reservoir:
+        """
+        Finds the reservoir of the given metric key, creating it for a new series.
+
+        :param key: tuple
+        :return: knotty.reservoirs.Reservoir
+        """
+        reservoir = self._current_values.get(key)
+        if reservoir is None:
+            key = TagSets.canonical(key)
+            reservoir = self._current_values[key] = self._new_reservoir()
+            self._index_series(key)
+        return reservoir
+
+    def add_new_value(self, value: float, metric_key: tuple = None, weight: int = 1) -> None:
         """
         Stores a new value for the given metric key. If no metric key is provided the current tags of the histogram will
-        be used.
+        be used. A weight above 1 means that the value was sampled and stands in for that many observations.
 
         :param value: float (or int)
         :param metric_key: tuple
+        :param weight: int: The number of observations the value represents
         :return:
         """
-        key = metric_key or tuple(self.get_tags().items())
-        self._metric_keys.add(key)
-        if self._current_values.get(key):
-            self._current_values[key].append(value)
-        else:
-            self._current_values[key] = deque([value], maxlen=self._max_data_values)
+        metric_key = metric_key or tuple(self.get_tags().items())
+        with self._state_lock:
+            self._reservoir_for(metric_key).update(value, weight)
+
+    def add_values(self, values, tags: dict = None, weight: int = 1) -> None:
+        """
+        Stores a batch of values for a single series at once. The tags are combined with the tags of the histogram a
+        single time and reservoirs that support it store the whole batch in one vectorized operation.
+
+        :param values: A list or NumPy array of values
+        :param tags: {str, str} dictionary of extra tags for the series, combined with the tags of the histogram
+        :param weight: int: The number of observations each value represents
+        :return:
+        """
+        metric_key = self._key_with_tags(tags)
+        with self._state_lock:
+            self._reservoir_for(metric_key).update_many(values, weight)
 
     def set_max_data_values(self, max_data_values: int) -> None:
         """
-        Sets the maximum number of data points that the histogram will keep. Storing more data will result in more
-        memory being used, as well as an increase in cpu usage for calculating metrics. 
+        Sets the maximum number of data points that the histogram will keep per series when using the default
+        reservoir. Storing more data will result in more memory being used, as well as an increase in cpu usage for
+        calculating metrics.
         :param max_data_values: int
         :return: 
         """
@@ -473,14 +1791,18 @@ class Histogram(BaseMeter):
     def summarize_method(self, method: callable) -> callable:
         """
         Wraps the given method and adds it's return value to the current set of stored metrics. The augmentor can be
-        utilized to provide any additionally needed functionality around the method call.
+        utilized to provide any additionally needed functionality around the method call. If a sample rate has been set
+        only the return values of the sampled calls are stored, weighted by the number of calls they represent.
 
         :param method: A callable method that should return either an int or a float (or something castable to either)
         :return:
         """
         @wraps(method)
         def track_execution(*args, callback_summary: Histogram = self, **kwargs):
+            weight = 1 if callback_summary._sample_rate == 1 else callback_summary._sample_weight()
             method_result = method(*args, **kwargs)
+            if not weight:
+                return method_result
             if not (isinstance(method_result, int) or isinstance(method_result, float)):
                 try:
                     method_result = float(method_result)
@@ -491,8 +1813,7 @@ class Histogram(BaseMeter):
                     callback_summary.logger.error(e)
             callback_summary.augmentor(callback_summary, method, method_result, *args, **kwargs)
             metric_key = tuple(callback_summary.get_tags().items())
-            callback_summary._metric_keys.add(metric_key)
-            callback_summary.add_new_value(method_result, metric_key=metric_key)
+            callback_summary.add_new_value(method_result, metric_key=metric_key, weight=weight)
             return method_result
 
         return track_execution
@@ -504,7 +1825,8 @@ class Histogram(BaseMeter):
         :param percentile_value: The percentile to calculate, eg 95 will return the 95th percentile
         :return: {tuple: tuple(int, int)} Key tuple corresponds to metric key, value tuple is value and percentile
         """
-        return {key: percentile(value, percentile_value) for key, value in self._current_values.items()}
+        return {key: self._snapshot_percentiles(self._current_values.get(key), values, [percentile_value])[0]
+                for key, (values, _) in self._reservoir_snapshots()}
 
     def _get_histogram(self, number_of_bins: int = 10) -> {tuple: tuple}:
         """
@@ -513,29 +1835,580 @@ class Histogram(BaseMeter):
         :param number_of_bins: The requested number of bins to be automatically generated by numpy
         :return: {tuple: tuple([],[]} Key tuple corresponds to metric key, value tuple represents numpy histogram
         """
-        return {key: histogram(value, bins=number_of_bins) for key, value in self._current_values.items()}
+        return {key: histogram(values, bins=number_of_bins, weights=weights)
+                for key, (values, weights) in self._reservoir_snapshots()}
 
-    async def get_metrics(self) -> [Metric]:
+    def _reservoir_snapshots(self) -> [tuple]:
         """
-        Returns a list of metrics for the Histogram instance. These metrics include the sum of all measured points, the
-        count of all measured points, the number of values in each bucket, and metrics displaying the different
-        percentiles that the instance is instantiated to track.
+        Takes a snapshot of the reservoir of every series, skipping the series whose reservoirs are currently empty. The
+        snapshots are taken under the state lock so that none of them is read while a value is being recorded.
 
-        :return: [Metric]
+        :return: [(tuple, (values, weights))]
+        """
+        with self._state_lock:
+            taken = [(key, reservoir.snapshot()) for key, reservoir in self._current_values.items()]
+        return [(key, snapshot) for key, snapshot in taken if len(snapshot[0])]
+
+    def _snapshot_percentiles(self, reservoir: reservoirs.Reservoir, values, percentiles: [float]) -> list:
+        """
+        Calculates the requested percentiles from the values of a reservoir snapshot. Reservoirs that override
+        Reservoir.percentiles weight them by something the snapshot does not hold, like the decay weights of the
+        ExponentiallyDecayingReservoir, so those calculate them on their own under the state lock.
+
+        :param reservoir: knotty.reservoirs.Reservoir: The reservoir the snapshot was taken from
+        :param values: The values of the snapshot
+        :param percentiles: [float]: The percentiles to calculate, eg [50, 99]
+        :return: list: The value of each requested percentile
+        """
+        if reservoir is None or type(reservoir).percentiles is reservoirs.Reservoir.percentiles:
+            return list(percentile(values, percentiles))
+        with self._state_lock:
+            return reservoir.percentiles(percentiles)
+
+    def _statistics(self, reservoir_snapshots: [tuple]) -> {tuple: tuple}:
+        """
+        Calculates the sum, count, histogram and percentiles of every snapshot. The series that keep the same number of
+        the most recent values and have filled their reservoirs are stacked into a single array, so that a single
+        vectorized calculation covers all of them instead of one calculation per series and statistic.
+
+        :param reservoir_snapshots: [(tuple, (values, weights))] as returned by _reservoir_snapshots
+        :return: {tuple: tuple(sum, count, bin counts, bin edges, percentiles)}
+        """
+        statistics = dict()
+        stackable = dict()
+        for key, (values, weights) in reservoir_snapshots:
+            reservoir = self._current_values.get(key)
+            merged = self._merged.get(key)
+            if merged is not None:
+                total, number = _weighted_totals(values, weights)
+                values, weights = _combine_weighted(values, weights, merged[2], merged[3])
+                counts, edges = histogram(values, bins=self._bin_count, weights=weights)
+                statistics[key] = (total + merged[1], number + merged[0], counts, edges,
+                                   _weighted_percentiles(values, weights, self._percentiles))
+                continue
+            if weights is None and isinstance(reservoir, reservoirs.RecentValuesReservoir) and \
+                    len(values) == reservoir.size:
+                stackable.setdefault(reservoir.size, []).append((key, values))
+                continue
+            counts, edges = histogram(values, bins=self._bin_count, weights=weights)
+            total, number = _weighted_totals(values, weights)
+            statistics[key] = (total, number, counts, edges,
+                               self._snapshot_percentiles(reservoir, values, self._percentiles))
+
+        for group in stackable.values():
+            stack = vstack([values for _, values in group])
+            totals = stack.sum(axis=1)
+            counts, edges = _stacked_histograms(stack, self._bin_count)
+            percentiles = percentile(stack, self._percentiles, axis=1).T
+            for index, (key, _) in enumerate(group):
+                statistics[key] = (totals[index].item(), stack.shape[1], counts[index], edges[index],
+                                   percentiles[index])
+        return statistics
+
+    def _series_snapshots(self) -> [tuple]:
+        """
+        Takes a snapshot of the reservoir of every series like _reservoir_snapshots, adding the series that only hold
+        merged snapshots with no values of their own.
+
+        :return: [(tuple, (values, weights))]
+        """
+        reservoir_snapshots = self._reservoir_snapshots()
+        merged = dict(self._merged)
+        if merged:
+            reservoir_keys = {key for key, _ in reservoir_snapshots}
+            reservoir_snapshots += [(key, (_no_values, None)) for key in merged if key not in reservoir_keys]
+        return reservoir_snapshots
+
+    def series_keys(self):
+        return self._current_values.keys() | self._merged.keys()
+
+    def _reset(self) -> None:
+        self._current_values = dict()
+        self._merged = dict()
+
+    def _write_snapshot(self, writer: snapshots.SnapshotWriter) -> None:
+        """
+        Writes the count and sum of every series, followed by a sketch of its values: at most sketch_size centroids and
+        their weights (see _compress_values).
+
+        :param writer: knotty.snapshots.SnapshotWriter
+        :return:
+        """
+        series_snapshots = self._series_snapshots()
+        writer.write_series_count(len(series_snapshots))
+        for key, (values, weights) in series_snapshots:
+            total, number = _weighted_totals(values, weights)
+            merged = self._merged.get(key)
+            if merged is not None:
+                total, number = total + merged[1], number + merged[0]
+                values, weights = _combine_weighted(values, weights, merged[2], merged[3])
+            centroids, centroid_weights = _compress_values(values, weights, self.sketch_size)
+            writer.write_series_key(key)
+            writer.write_number(number)
+            writer.write_number(total)
+            writer.write_array(centroids)
+            writer.write_array(centroid_weights)
+
+    def _merge_snapshot(self, reader: snapshots.SnapshotReader) -> None:
+        """
+        Adds the counts and sums of the snapshot to those merged into this histogram before, and combines the sketches,
+        compressing them back to sketch_size centroids. The reservoirs are left alone.
+
+        :param reader: knotty.snapshots.SnapshotReader
+        :return:
+        """
+        for _ in range(reader.read_varint()):
+            key = reader.read_tags()
+            number = reader.read_number()
+            total = reader.read_number()
+            centroids = reader.read_array()
+            centroid_weights = reader.read_array()
+            with self._state_lock:
+                merged = self._merged.get(key)
+                if merged is None:
+                    key = TagSets.canonical(key)
+                    self._merged[key] = [number, total, centroids, centroid_weights]
+                    self._index_series(key)
+                    continue
+                merged[0] += number
+                merged[1] += total
+                merged[2], merged[3] = _compress_values(*_combine_weighted(merged[2], merged[3], centroids,
+                                                                           centroid_weights), self.sketch_size)
+
+    async def get_batches(self) -> [MetricBatch]:
+        """
+        Returns the metrics of the Histogram instance. These metrics include the sum of all measured points, the count
+        of all measured points, the number of values in each bucket, and metrics displaying the different percentiles
+        that the instance is instantiated to track.
+
+        :return: [MetricBatch]
+        """
+        reservoir_snapshots = self._series_snapshots()
+        if not reservoir_snapshots:
+            return []
+        statistics = self._statistics(reservoir_snapshots)
+        keys = [key for key, _ in reservoir_snapshots]
+        bucket_keys, bucket_counts = [], array("q")
+        for key in keys:
+            counts, edges = statistics[key][2:4]
+            bucket_keys += [key + (("le", str(edges[bin_value + 1])),) for bin_value in range(self._bin_count)]
+            bucket_counts.extend(int(count) for count in counts[:self._bin_count])
+        percentile_keys, percentile_values = [], array("d")
+        for index, p in enumerate(self._percentiles):
+            percentile_keys += [key + (("percentile", str(p)),) for key in keys]
+            percentile_values.extend(float(statistics[key][4][index]) for key in keys)
+        return [MetricBatch(self.name + "_sum", "histogram", keys, _value_column([statistics[key][0] for key in keys])),
+                MetricBatch(self.name + "_count", "histogram", keys,
+                            _value_column([statistics[key][1] for key in keys])),
+                MetricBatch(self.name + "_bucket", "histogram", bucket_keys, bucket_counts),
+                MetricBatch(self.name + "_percentile", "gauge", percentile_keys, percentile_values)]
+
+
+_no_values = asarray([], dtype=float64)
+
+
+def _weighted_totals(values, weights) -> tuple:
+    """
+    Sums a set of values and counts the observations they stand for.
+
+    :param values: A list or NumPy array of values
+    :param weights: The weight of every value, or None if every value stands for a single observation
+    :return: tuple(sum, count)
+    """
+    values = asarray(values)
+    if weights is None:
+        return values.sum().item(), len(values)
+    weights = asarray(weights)
+    return (values * weights).sum().item(), weights.sum().item()
+
+
+def _combine_weighted(values, weights, other_values, other_weights) -> tuple:
+    """
+    Concatenates two sets of weighted values, either set of weights can be None for values of a single observation.
+
+    :return: tuple(numpy.ndarray, numpy.ndarray)
+    """
+    weights = ones(len(values)) if weights is None else asarray(weights, dtype=float64)
+    other_weights = ones(len(other_values)) if other_weights is None else asarray(other_weights, dtype=float64)
+    return concatenate([asarray(values, dtype=float64), asarray(other_values, dtype=float64)]), \
+        concatenate([weights, other_weights])
+
+
+def _compress_values(values, weights, size: int) -> tuple:
+    """
+    Compresses a set of weighted values into a sketch of at most size centroids in order of value. The values are
+    sorted and split into runs of equal weight, and every run is replaced by its weighted mean and total weight, so the
+    weights of the sketch still add up to the observations the values stand for.
+
+    :param values: A list or NumPy array of values
+    :param weights: The weight of every value, or None if every value stands for a single observation
+    :param size: int: The maximum number of centroids
+    :return: tuple(numpy.ndarray, numpy.ndarray): The centroids and their weights
+    """
+    values = asarray(values, dtype=float64)
+    weights = ones(len(values)) if weights is None else asarray(weights, dtype=float64)
+    order = argsort(values, kind="stable")
+    values, weights = values[order], weights[order]
+    if len(values) <= size:
+        return values, weights
+    cumulative = cumsum(weights)
+    runs = minimum((cumulative - weights) * size // cumulative[-1], size - 1).astype(intp)
+    run_weights = bincount(runs, weights, minlength=size)
+    run_sums = bincount(runs, values * weights, minlength=size)
+    kept = run_weights > 0
+    return run_sums[kept] / run_weights[kept], run_weights[kept]
+
+
+def _weighted_percentiles(values: ndarray, weights: ndarray, percentiles: [float]) -> list:
+    """
+    Calculates percentiles of weighted values as the smallest value whose cumulative weight reaches each percentile.
+
+    :param values: numpy.ndarray
+    :param weights: numpy.ndarray
+    :param percentiles: [float]
+    :return: list
+    """
+    order = argsort(values, kind="stable")
+    values = values[order]
+    cumulative = cumsum(weights[order])
+    positions = searchsorted(cumulative, asarray(percentiles, dtype=float64) / 100.0 * cumulative[-1])
+    return list(values[positions.clip(0, len(values) - 1)])
+
+
+def _stacked_histograms(stack: ndarray, number_of_bins: int) -> tuple:
+    """
+    Calculates an equal width histogram over every row of a 2d array at once, with the same bins numpy.histogram would
+    produce for each row on its own.
+
+    :param stack: numpy.ndarray: One row of values per series
+    :param number_of_bins: int
+    :return: tuple(numpy.ndarray, numpy.ndarray): The bin counts and the bin edges, one row per series
+    """
+    rows = arange(len(stack))[:, None]
+    values = stack.astype(float64, copy=False)
+    first = values.min(axis=1)
+    last = values.max(axis=1)
+    empty_range = first == last
+    first[empty_range] -= 0.5
+    last[empty_range] += 0.5
+    edges = linspace(first, last, number_of_bins + 1, axis=1)
+    indices = ((values - first[:, None]) / (last - first)[:, None] * number_of_bins).astype(intp)
+    indices[indices == number_of_bins] -= 1
+    indices[values < edges[rows, indices]] -= 1
+    indices[(values >= edges[rows, indices + 1]) & (indices != number_of_bins - 1)] += 1
+    counts = bincount((indices + rows * number_of_bins).ravel(), minlength=len(stack) * number_of_bins)
+    return counts.reshape(len(stack), number_of_bins), edges
+
+
+class _LogLinearLayout:
+    """
+    Describes the bucket layout of a LatencyHistogram, following the HdrHistogram scheme. Values are split into
+    exponentially growing buckets which are each divided into a fixed number of linear sub buckets, so every recorded
+    value is kept with the requested number of significant decimal digits. The layout is shared by all the series of a
+    LatencyHistogram, only the counts are kept per series.
+    """
+    def __init__(self, significant_digits: int, highest_trackable_value: int):
+        if not 1 <= significant_digits <= 5:
+            raise ValueError("significant_digits must be between 1 and 5, received {0}".format(significant_digits))
+        if highest_trackable_value < 2:
+            raise ValueError("highest_trackable_value must be at least 2, received {0}".format(highest_trackable_value))
+        largest_single_unit_resolution = 2 * 10 ** significant_digits
+        sub_bucket_count_magnitude = (largest_single_unit_resolution - 1).bit_length()
+        self.sub_bucket_half_count_magnitude = max(sub_bucket_count_magnitude, 1) - 1
+        self.sub_bucket_count = 1 << (self.sub_bucket_half_count_magnitude + 1)
+        self.sub_bucket_half_count = self.sub_bucket_count >> 1
+        self.sub_bucket_mask = self.sub_bucket_count - 1
+        bucket_count = 1
+        smallest_untrackable_value = self.sub_bucket_count
+        while smallest_untrackable_value <= highest_trackable_value:
+            smallest_untrackable_value <<= 1
+            bucket_count += 1
+        self.highest_trackable_value = highest_trackable_value
+        self.counts_length = (bucket_count + 1) * self.sub_bucket_half_count
+        self._highest_equivalent_values = None
+
+    def index_of(self, value: int) -> int:
+        """
+        Finds the index of the counts slot for the given value.
+
+        :param value: int: A non negative value no larger than the highest trackable value
+        :return: int
+        """
+        bucket_index = (value | self.sub_bucket_mask).bit_length() - self.sub_bucket_half_count_magnitude - 1
+        return ((bucket_index + 1) << self.sub_bucket_half_count_magnitude) + \
+            (value >> bucket_index) - self.sub_bucket_half_count
+
+    def indexes_of(self, values: ndarray) -> ndarray:
+        """
+        Vectorized version of index_of. The bit length of every value is taken from the exponent of its float
+        representation, which is exact for every value below 2 ** 53.
+
+        :param values: numpy.ndarray: Non negative int64 values no larger than the highest trackable value
+        :return: numpy.ndarray
+        """
+        bit_lengths = frexp(values | self.sub_bucket_mask)[1].astype(int64)
+        bucket_indexes = bit_lengths - self.sub_bucket_half_count_magnitude - 1
+        return ((bucket_indexes + 1) << self.sub_bucket_half_count_magnitude) + \
+            (values >> bucket_indexes) - self.sub_bucket_half_count
+
+    def highest_equivalent_values(self) -> ndarray:
+        """
+        Gives the highest value that is counted in each slot of the counts, this is what percentiles and buckets are
+        reported as.
+
+        :return: numpy.ndarray
+        """
+        if self._highest_equivalent_values is None:
+            indexes = arange(self.counts_length, dtype=int64)
+            bucket_indexes = (indexes >> self.sub_bucket_half_count_magnitude) - 1
+            sub_bucket_indexes = (indexes & (self.sub_bucket_half_count - 1)) + self.sub_bucket_half_count
+            first_bucket = bucket_indexes < 0
+            sub_bucket_indexes[first_bucket] -= self.sub_bucket_half_count
+            bucket_indexes[first_bucket] = 0
+            self._highest_equivalent_values = (sub_bucket_indexes << bucket_indexes) + (1 << bucket_indexes) - 1
+        return self._highest_equivalent_values
+
+
+class LatencyHistogram(BaseMeter):
+    """
+    The LatencyHistogram records durations into log-linear buckets, similar to an HdrHistogram, instead of storing the
+    measured values. Every series holds a preallocated vector of counts, so recording a value is a few integer
+    operations without any allocation, and any percentile can be calculated over all recorded values with the precision
+    set by significant_digits. Values are recorded as integer nanoseconds and exported in seconds.
+
+    By default the histogram is exported as cumulative Prometheus buckets, see set_export_mode to export percentiles
+    instead. A Timer can record into a LatencyHistogram through Timer.enable_latency_histogram.
+    """
+    default_buckets = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10]
+    snapshot_type = "LatencyHistogram"
+
+    def __init__(self, name: str):
+        self._name = name
+        self._state_lock = Lock()
+        self._significant_digits = 2
+        self._highest_trackable_value = 3600 * 10 ** 9
+        self._layout = _LogLinearLayout(self._significant_digits, self._highest_trackable_value)
+        self._counts = dict()
+        self._total_count = dict()
+        self._total_sum = dict()
+        self._export_mode = "buckets"
+        self._buckets = self.default_buckets
+        self._percentiles = [50, 75, 90, 95, 99]
+        self._ensure_registered_with_registry()
+
+    def set_precision(self, significant_digits: int = 2, highest_trackable_value: float = 3600) -> None:
+        """
+        Sets the number of significant decimal digits that recorded values keep, and the highest value in seconds that
+        can be told apart from larger ones. Larger values are counted as the highest trackable value. More digits and a
+        higher range mean larger count vectors per series. Any previously recorded values are discarded.
+
+        :param significant_digits: int: Between 1 and 5
+        :param highest_trackable_value: float: In seconds
+        :return:
+        """
+        self._layout = _LogLinearLayout(significant_digits, int(highest_trackable_value * 1e9))
+        self._significant_digits = significant_digits
+        self._highest_trackable_value = self._layout.highest_trackable_value
+        self._counts = dict()
+        self._total_count = dict()
+        self._total_sum = dict()
+
+    def set_export_mode(self, export_mode: str) -> None:
+        """
+        Sets whether the histogram is exported as cumulative Prometheus buckets ("buckets") or as the percentiles set
+        through set_percentiles ("percentiles").
+
+        :param export_mode: str
+        :return:
+        """
+        if export_mode not in ["buckets", "percentiles"]:
+            raise ValueError("Export mode must be either 'buckets' or 'percentiles', received {0}".format(export_mode))
+        self._export_mode = export_mode
+
+    def set_buckets(self, buckets: [float]) -> None:
+        """
+        Sets the upper bounds in seconds of the buckets exported in the "buckets" export mode. A +Inf bucket is always
+        added.
+
+        :param buckets: [float]
+        :return:
+        """
+        self._buckets = sorted(buckets)
+
+    def set_percentiles(self, percentiles: [float]) -> None:
+        """
+        Sets the list of percentiles that will be calculated when metrics are exported in the "percentiles" mode.
+
+        :param percentiles: [float]
+        :return:
+        """
+        self._percentiles = percentiles
+
+    def _counts_for(self, key: tuple) -> array:
+        """
+        Finds the counts of the given metric key, allocating them for a new series.
+
+        :param key: tuple
+        :return: array
+        """
+        counts = self._counts.get(key)
+        if counts is None:
+            key = TagSets.canonical(key)
+            counts = self._counts[key] = array("q", bytes(8 * self._layout.counts_length))
+            self._total_count[key] = 0
+            self._total_sum[key] = 0
+            self._index_series(key)
+        return counts
+
+    def record(self, value: int, metric_key: tuple = None, weight: int = 1) -> None:
+        """
+        Records a duration in nanoseconds for the given metric key. If no metric key is provided the current tags of
+        the histogram will be used.
+
+        :param value: int: The duration in nanoseconds
+        :param metric_key: tuple
+        :param weight: int: The number of observations the value represents when sampling
+        :return:
+        """
+        key = metric_key or tuple(self.get_tags().items())
+        value = min(max(int(value), 0), self._highest_trackable_value)
+        with self._state_lock:
+            counts = self._counts_for(key)
+            counts[self._layout.index_of(value)] += weight
+            self._total_count[key] += weight
+            self._total_sum[key] += value * weight
+
+    def record_many(self, values, metric_key: tuple = None, weight: int = 1) -> None:
+        """
+        Records a batch of durations in nanoseconds for the given metric key in one vectorized operation.
+
+        :param values: A list or NumPy array of durations in nanoseconds
+        :param metric_key: tuple
+        :param weight: int: The number of observations each value represents when sampling
+        :return:
+        """
+        values = asarray(values, dtype=int64).clip(0, self._highest_trackable_value)
+        if not len(values):
+            return
+        key = metric_key or tuple(self.get_tags().items())
+        bucket_counts = bincount(self._layout.indexes_of(values), minlength=self._layout.counts_length) * weight
+        with self._state_lock:
+            counts = self._counts_for(key)
+            frombuffer(counts, dtype=int64)[:] += bucket_counts
+            self._total_count[key] += len(values) * weight
+            self._total_sum[key] += int(values.sum()) * weight
+
+    def add_new_value(self, value: float, metric_key: tuple = None, weight: int = 1) -> None:
+        """
+        Records a duration in seconds for the given metric key.
+
+        :param value: float: The duration in seconds
+        :param metric_key: tuple
+        :param weight: int: The number of observations the value represents when sampling
+        :return:
+        """
+        self.record(int(value * 1e9), metric_key, weight)
+
+    def get_percentiles(self, percentiles: [float], metric_key: tuple = None) -> [float]:
+        """
+        Calculates the requested percentiles in seconds over every value recorded for the metric key.
+
+        :param percentiles: [float]: The percentiles to calculate, eg [50, 99.9]
+        :param metric_key: tuple
+        :return: [float]
+        """
+        key = metric_key or tuple(self.get_tags().items())
+        counts = frombuffer(self._counts[key], dtype=int64)
+        cumulative = cumsum(counts)
+        targets = ceil(asarray(percentiles, dtype=float) / 100.0 * cumulative[-1]).clip(1, None)
+        indexes = searchsorted(cumulative, targets)
+        return [float(value) / 1e9 for value in self._layout.highest_equivalent_values()[indexes]]
+
+    def series_keys(self):
+        return self._counts.keys()
+
+    def _reset(self) -> None:
+        self._counts = dict()
+        self._total_count = dict()
+        self._total_sum = dict()
+
+    def _write_snapshot(self, writer: snapshots.SnapshotWriter) -> None:
+        """
+        Writes the precision of the histogram followed by the count, sum and non empty buckets of every series.
+
+        :param writer: knotty.snapshots.SnapshotWriter
+        :return:
+        """
+        writer.write_varint(self._significant_digits)
+        writer.write_varint(self._highest_trackable_value)
+        counts = dict(self._counts)
+        writer.write_series_count(len(counts))
+        for key, series_counts in counts.items():
+            series_counts = frombuffer(series_counts, dtype=int64)
+            indexes = series_counts.nonzero()[0]
+            writer.write_series_key(key)
+            writer.write_number(self._total_count[key])
+            writer.write_number(self._total_sum[key])
+            writer.write_array(indexes, dtype=int64)
+            writer.write_array(series_counts[indexes], dtype=int64)
+
+    def _merge_snapshot(self, reader: snapshots.SnapshotReader) -> None:
+        """
+        Adds the bucket counts, counts and sums of the snapshot to this histogram. Buckets of a snapshot with a
+        different precision are added to the buckets that hold their highest values here.
+
+        :param reader: knotty.snapshots.SnapshotReader
+        :return:
+        """
+        layout = _LogLinearLayout(reader.read_varint(), reader.read_varint())
+        same_layout = layout.counts_length == self._layout.counts_length and \
+            layout.sub_bucket_count == self._layout.sub_bucket_count
+        for _ in range(reader.read_varint()):
+            key = reader.read_tags()
+            total_count = reader.read_number()
+            total_sum = reader.read_number()
+            indexes = reader.read_array(dtype=int64)
+            merged_counts = reader.read_array(dtype=int64)
+            if not same_layout:
+                values = layout.highest_equivalent_values()[indexes].clip(0, self._highest_trackable_value)
+                indexes = self._layout.indexes_of(values)
+            with self._state_lock:
+                series_counts = frombuffer(self._counts_for(key), dtype=int64)
+                add.at(series_counts, indexes, merged_counts)
+                self._total_count[key] += total_count
+                self._total_sum[key] += total_sum
+
+    async def get_batches(self) -> [MetricBatch]:
+        """
+        Returns the metrics of the LatencyHistogram instance. Next to the sum and the count of every series, this is
+        either the cumulative count of each bucket or the value of each percentile depending on the export mode.
+
+        :return: [MetricBatch]
         """
-        metrics = []
-        metrics += [Metric(self.name + "_sum", key, sum(value), "histogram")
-                    for key, value in self._current_values.items()]
-        metrics += [Metric(self.name + "_count", key, len(value), "histogram")
-                    for key, value in self._current_values.items()]
-
-        for key, value in self._get_histogram(self._bin_count).items():
-            for bin_value in range(self._bin_count):
-                full_key = key + tuple({"le": str(value[1][bin_value+1])}.items())
-                metrics += [Metric(self.name + "_bucket", full_key, int(value[0][bin_value]), "histogram")]
-
-        for p in self._percentiles:
-            metrics += [Metric(self.name + "_percentile", key +
-                               tuple({"percentile": str(p)}.items()), float(value), "gauge")
-                        for key, value in self._get_percentile(p).items()]
-        return metrics
+        series = list(self._counts.items())
+        if not series:
+            return []
+        keys = [key for key, _ in series]
+        sums = array("d", [self._total_sum[key] / 1e9 for key in keys])
+        totals = array("q", [self._total_count[key] for key in keys])
+        if self._export_mode == "buckets":
+            # Buckets include their upper bound, so each one runs up to the end of the slot its bound is counted in.
+            bucket_indexes = [self._layout.index_of(min(round(bound * 1e9), self._highest_trackable_value))
+                              if bound >= 0 else -1 for bound in self._buckets]
+            bucket_keys, bucket_counts = [], array("q")
+            for key, counts in series:
+                cumulative = cumsum(frombuffer(counts, dtype=int64))
+                bucket_keys += [key + (("le", str(bound)),) for bound in self._buckets]
+                bucket_counts.extend(int(cumulative[index]) if index >= 0 else 0 for index in bucket_indexes)
+                bucket_keys.append(key + (("le", "+Inf"),))
+                bucket_counts.append(self._total_count[key])
+            return [MetricBatch(self.name + "_bucket", "histogram", bucket_keys, bucket_counts),
+                    MetricBatch(self.name + "_sum", "histogram", keys, sums),
+                    MetricBatch(self.name + "_count", "histogram", keys, totals)]
+        percentile_keys, percentile_values = [], []
+        for key in keys:
+            percentile_keys += [key + (("percentile", str(p)),) for p in self._percentiles]
+            percentile_values += self.get_percentiles(self._percentiles, key)
+        return [MetricBatch(self.name + "_sum", "summary", keys, sums),
+                MetricBatch(self.name + "_count", "summary", keys, totals),
+                MetricBatch(self.name + "_percentile", "gauge", percentile_keys, _value_column(percentile_values))]
@@ -0,0 +1,249 @@
+"""
+This module holds WSGI and ASGI middleware that time every HTTP request an application serves. Requests are tagged by
+the route template they matched, eg "/users/<int:user_id>" instead of "/users/42", so the number of series stays bounded
+however many different paths are requested, along with the request method and the response status code.
+
+Two Timers are kept per middleware: <name> measures the total time of a request including the time spent producing and
+sending the response body, and <name>_headers measures the time until the application started the response.
+The status code is taken from the response as the application starts it, start_response for WSGI and the
+http.response.start message for ASGI, so nothing depends on the internals of a framework.
+"""
+from functools import wraps
+from time import perf_counter_ns
+from weakref import WeakKeyDictionary
+from knotty import meters, registry
+
+UNMATCHED_ROUTE = "unmatched"
+
+
+def flask_route(environ: dict) -> str:
+    """
+    Finds the route template of the request Flask is handling for the environ, eg "/users/<int:user_id>". This only
+    works while Flask is handling the request, which is the case when the application starts its response.
+
+    :param environ: dict: The WSGI environ of the request
+    :return: str: The rule of the matched url_rule, or None when no rule matched
+    """
+    url_rule = getattr(environ.get("werkzeug.request"), "url_rule", None)
+    return None if url_rule is None else url_rule.rule
+
+
+_starlette_routes = WeakKeyDictionary()
+
+
+def _starlette_endpoint_routes(routes, prefix: str = "") -> dict:
+    """
+    Maps the endpoints of the routes of a Starlette router to their path templates, including the routes of mounted
+    routers.
+
+    :param routes: The routes of the router
+    :param prefix: str: The path template of the mount the routes are under
+    :return: {callable: str}
+    """
+    endpoint_routes = dict()
+    for route in routes:
+        path = getattr(route, "path", None)
+        if path is None:
+            continue
+        endpoint = getattr(route, "endpoint", None)
+        if endpoint is not None:
+            endpoint_routes.setdefault(endpoint, prefix + path)
+        child_routes = getattr(route, "routes", None)
+        if child_routes:
+            for child_endpoint, child_path in _starlette_endpoint_routes(child_routes, prefix + path).items():
+                endpoint_routes.setdefault(child_endpoint, child_path)
+    return endpoint_routes
+
+
+def starlette_route(scope: dict) -> str:
+    """
+    Finds the route template a Starlette or FastAPI request matched, eg "/users/{user_id}", once the request has been
+    handled. FastAPI stores the matched route in the scope. Starlette only stores the endpoint, which is looked up in a
+    map of the endpoints of the router to their templates that is built once per router and rebuilt when an endpoint is
+    missing from it, eg because routes were added.
+
+    :param scope: dict: The ASGI scope of the request
+    :return: str: The path template of the matched route, or None when no route matched
+    """
+    route_path = getattr(scope.get("route"), "path", None)
+    if route_path is not None:
+        return route_path
+    endpoint = scope.get("endpoint")
+    router = scope.get("router")
+    if endpoint is None or router is None:
+        return None
+    endpoint_routes = _starlette_routes.get(router)
+    if endpoint_routes is None or endpoint not in endpoint_routes:
+        endpoint_routes = _starlette_routes[router] = _starlette_endpoint_routes(getattr(router, "routes", ()))
+    return endpoint_routes.get(endpoint)
+
+
+class _RequestTimers:
+    """
+    The meters shared by the WSGI and the ASGI middleware. The series IDs of every route, method and status code are
+    kept in a meters.SeriesIdCache, so recording a request is a dictionary lookup and two additions.
+
+    :param name: str: The name of the Timer of the total request time
+    :param route_resolver: callable that returns the route template of a request, or None when no route matched
+    """
+    def __init__(self, name: str, route_resolver: callable):
+        self.timer = registry.MeterRegistry.get_meter(name, meters.Timer)
+        self.headers_timer = registry.MeterRegistry.get_meter(name + "_headers", meters.Timer)
+        self.route_resolver = route_resolver
+        self._series_ids = meters.SeriesIdCache()
+
+    def _series_for(self, key: tuple) -> tuple:
+        route, method, status_code = key
+        tags = {"route": UNMATCHED_ROUTE if route is None else route, "method": method, "status_code": status_code}
+        return self.timer._series_id(tags), self.headers_timer._series_id(tags)
+
+    def _record(self, route: str, method: str, status_code: int, headers_time: int, total_time: int) -> None:
+        """
+        Records a finished request.
+
+        :param route: str: The route template of the request, None if no route matched
+        :param method: str: The request method
+        :param status_code: int: The response status code
+        :param headers_time: int: Nanoseconds until the response was started, None if it never was
+        :param total_time: int: Nanoseconds until the response was finished
+        :return:
+        """
+        total_series, headers_series = self._series_ids.get((route, method, status_code), self._series_for)
+        self.timer._record_series(total_series, total_time)
+        if headers_time is not None:
+            self.headers_timer._record_series(headers_series, headers_time)
+
+
+class _WSGIResponse:
+    """
+    Follows a single request through a WSGI application. The response body is passed on to the server as the
+    application returned it, and the request is recorded when the server closes the body, which it has to do once the
+    body has been sent or sending it failed.
+    """
+    __slots__ = ("_timers", "_environ", "_start_response", "_start", "_route", "_status_code", "_headers_time",
+                 "_body", "_recorded")
+
+    def __init__(self, timers: _RequestTimers, environ: dict, start_response: callable, start: int):
+        self._timers = timers
+        self._environ = environ
+        self._start_response = start_response
+        self._start = start
+        self._route = None
+        self._status_code = 500
+        self._headers_time = None
+        self._body = ()
+        self._recorded = False
+
+    def start_response(self, status: str, headers: list, exc_info=None) -> callable:
+        self._headers_time = perf_counter_ns() - self._start
+        self._status_code = int(status[:3])
+        self._route = self._timers.route_resolver(self._environ)
+        return self._start_response(status, headers, exc_info)
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self) -> None:
+        try:
+            close = getattr(self._body, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self.record()
+
+    def record(self) -> None:
+        if self._recorded:
+            return
+        self._recorded = True
+        self._timers._record(self._route, self._environ.get("REQUEST_METHOD"), self._status_code,
+                             self._headers_time, perf_counter_ns() - self._start)
+
+
+class WSGIMiddleware(_RequestTimers):
+    """
+    WSGI middleware that times every request of the wrapped application, see the module documentation. By default the
+    route is resolved like Flask does, pass another route_resolver for other frameworks. Requests whose route can not
+    be resolved are tagged with the route "unmatched", never with their raw path.
+
+    app.wsgi_app = WSGIMiddleware(app.wsgi_app)
+
+    :param app: The WSGI application to time
+    :param name: str: The name of the Timer of the total request time
+    :param route_resolver: callable(environ) that returns the route template of a request. It is called when the
+        application starts its response.
+    """
+    def __init__(self, app: callable = None, name: str = "http_server_request", route_resolver: callable = flask_route):
+        super().__init__(name, route_resolver)
+        self.app = app
+
+    def __call__(self, environ: dict, start_response: callable):
+        return self.measure(self.app, environ, start_response)
+
+    def measure(self, app: callable, environ: dict, start_response: callable):
+        """
+        Calls the given WSGI application for a request and times it.
+
+        :param app: The WSGI application
+        :param environ: dict: The WSGI environ of the request
+        :param start_response: The start_response callable of the server
+        :return: The response body
+        """
+        response = _WSGIResponse(self, environ, start_response, perf_counter_ns())
+        try:
+            response._body = app(environ, response.start_response)
+        except BaseException:
+            response.record()
+            raise
+        return response
+
+    def wrap_method(self, wsgi_app: callable) -> callable:
+        """
+        Wraps an unbound wsgi_app method so that every instance of its class is timed, eg
+        Flask.wsgi_app = middleware.wrap_method(Flask.wsgi_app).
+
+        :param wsgi_app: The function that implements the wsgi_app method
+        :return: callable
+        """
+        @wraps(wsgi_app)
+        def timed_wsgi_app(instance, environ: dict, start_response: callable):
+            return self.measure(wsgi_app.__get__(instance), environ, start_response)
+
+        return timed_wsgi_app
+
+
+class ASGIMiddleware(_RequestTimers):
+    """
+    ASGI middleware that times every HTTP request of the wrapped application, see the module documentation. Other
+    connection types, eg websockets and lifespan events, are passed on untouched. By default the route is resolved like
+    Starlette and FastAPI do, pass another route_resolver for other frameworks. Requests whose route can not be resolved
+    are tagged with the route "unmatched", never with their raw path.
+
+    app = ASGIMiddleware(app)
+
+    :param app: The ASGI application to time
+    :param name: str: The name of the Timer of the total request time
+    :param route_resolver: callable(scope) that returns the route template of a request. It is called once the
+        application has handled the request.
+    """
+    def __init__(self, app: callable, name: str = "http_server_request",
+                 route_resolver: callable = starlette_route):
+        super().__init__(name, route_resolver)
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: callable, send: callable) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = perf_counter_ns()
+        response = [500, None]
+
+        async def timed_send(message: dict) -> None:
+            if message["type"] == "http.response.start":
+                response[0] = message["status"]
+                response[1] = perf_counter_ns() - start
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            self._record(self.route_resolver(scope), scope.get("method"), response[0], response[1],
+                         perf_counter_ns() - start)
@@ -0,0 +1,249 @@
+"""
+This module keeps the totals of counting meters across process restarts. A Checkpointer periodically writes snapshots
+of the Counters and Timers of the MeterRegistry (see knotty.snapshots) to a memory-mapped CheckpointFile, and merges
+them back into the registry when the process starts again, so push backends such as Graphite and OpenTSDB do not see a
+counter reset on every deploy. See MeterRegistry.enable_persistence.
+
+The checkpoint file holds two slots that are written in turns, each with a sequence number and a CRC32 of its content.
+A checkpoint only ever overwrites the older slot and its header is written after its content, so a process that dies
+in the middle of a checkpoint leaves the previous checkpoint intact and the torn one fails its checksum. Every process
+needs a checkpoint file of its own.
+"""
+import mmap
+import os
+import struct
+import zlib
+from logging import getLogger
+from threading import Thread, Event, Lock
+from time import perf_counter
+from knotty import registry, snapshots
+
+MAGIC = b"KNC"
+VERSION = 1
+
+_FILE_HEADER = struct.Struct("<3sB4xQ")
+_SLOT_HEADER = struct.Struct("<QQI4x")
+_SLOT_SEQUENCE = struct.Struct("<QQ")
+_PAGE_SIZE = mmap.ALLOCATIONGRANULARITY
+
+
+def _round_to_pages(size: int) -> int:
+    return -(-size // _PAGE_SIZE) * _PAGE_SIZE
+
+
+class CheckpointFile:
+    """
+    A memory-mapped file with two checkpoint slots, see the module documentation. The first page holds the file header
+    with the capacity of the slots, the slots follow it. When a checkpoint does not fit in a slot, a larger file is
+    written next to the current one and moved over it, which replaces the checkpoint file atomically.
+
+    :param path: str: The path of the checkpoint file, it is created if it does not exist
+    :param initial_capacity: int: The number of bytes a slot holds when the file is created
+    """
+    def __init__(self, path: str, initial_capacity: int = 65536):
+        self.path = path
+        self._file = None
+        self._mmap = None
+        self._capacity = 0
+        self._sequence = 0
+        self._slot = 0
+        if not self._open():
+            self._replace(_round_to_pages(initial_capacity), b"")
+
+    def _open(self) -> bool:
+        """
+        Maps the existing checkpoint file and finds its latest valid slot.
+
+        :return: bool: False if there is no valid checkpoint file at the path
+        """
+        try:
+            checkpoint_file = open(self.path, "r+b")
+        except FileNotFoundError:
+            return False
+        size = os.fstat(checkpoint_file.fileno()).st_size
+        if size < _PAGE_SIZE:
+            checkpoint_file.close()
+            return False
+        mapped = mmap.mmap(checkpoint_file.fileno(), size)
+        magic, version, capacity = _FILE_HEADER.unpack_from(mapped)
+        if magic != MAGIC or version != VERSION or size != _PAGE_SIZE + 2 * capacity:
+            mapped.close()
+            checkpoint_file.close()
+            return False
+        self.close()
+        self._file, self._mmap, self._capacity = checkpoint_file, mapped, capacity
+        valid_slots = [(self._read_slot(slot)[0], slot) for slot in (0, 1)]
+        self._sequence, self._slot = max(valid_slots)
+        return True
+
+    def _read_slot(self, slot: int) -> tuple:
+        """
+        Reads a slot and checks its content against its checksum.
+
+        :param slot: int: 0 or 1
+        :return: tuple(sequence, payload), the sequence is 0 if the slot is empty or invalid
+        """
+        offset = _PAGE_SIZE + slot * self._capacity
+        sequence, length, checksum = _SLOT_HEADER.unpack_from(self._mmap, offset)
+        if not sequence or length > self._capacity - _SLOT_HEADER.size:
+            return 0, None
+        payload = self._mmap[offset + _SLOT_HEADER.size:offset + _SLOT_HEADER.size + length]
+        if zlib.crc32(payload, zlib.crc32(_SLOT_SEQUENCE.pack(sequence, length))) != checksum:
+            return 0, None
+        return sequence, payload
+
+    def read(self) -> bytes:
+        """
+        Returns the content of the latest valid checkpoint.
+
+        :return: bytes, None if the file does not hold a checkpoint
+        """
+        if not self._sequence:
+            return None
+        return self._read_slot(self._slot)[1]
+
+    def write(self, payload: bytes) -> None:
+        """
+        Writes a new checkpoint into the older slot, or into a larger file if it does not fit.
+
+        :param payload: bytes
+        :return:
+        """
+        sequence = self._sequence + 1
+        size = _SLOT_HEADER.size + len(payload)
+        if size > self._capacity:
+            self._replace(_round_to_pages(size * 2), payload)
+            return
+        slot = 1 - self._slot if self._sequence else 0
+        offset = _PAGE_SIZE + slot * self._capacity
+        checksum = zlib.crc32(payload, zlib.crc32(_SLOT_SEQUENCE.pack(sequence, len(payload))))
+        self._mmap[offset + _SLOT_HEADER.size:offset + size] = payload
+        _SLOT_HEADER.pack_into(self._mmap, offset, sequence, len(payload), checksum)
+        self._mmap.flush(offset, size)
+        self._sequence, self._slot = sequence, slot
+
+    def _replace(self, capacity: int, payload: bytes) -> None:
+        """
+        Writes a new checkpoint file with the given slot capacity, holding the payload in its first slot, and moves it
+        over the current file.
+
+        :param capacity: int: The slot capacity of the new file, a multiple of the page size
+        :param payload: bytes: The checkpoint to write, empty to leave the slots empty
+        :return:
+        """
+        sequence = self._sequence + 1 if payload else 0
+        content = bytearray(_PAGE_SIZE + 2 * capacity)
+        _FILE_HEADER.pack_into(content, 0, MAGIC, VERSION, capacity)
+        if payload:
+            checksum = zlib.crc32(payload, zlib.crc32(_SLOT_SEQUENCE.pack(sequence, len(payload))))
+            _SLOT_HEADER.pack_into(content, _PAGE_SIZE, sequence, len(payload), checksum)
+            content[_PAGE_SIZE + _SLOT_HEADER.size:_PAGE_SIZE + _SLOT_HEADER.size + len(payload)] = payload
+        temporary_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(temporary_path, "wb") as temporary_file:
+            temporary_file.write(content)
+            temporary_file.flush()
+            os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, self.path)
+        if not self._open():
+            raise OSError("Checkpoint file {0} could not be reopened after it was replaced".format(self.path))
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Checkpointer:
+    """
+    Checkpoints the meters of the MeterRegistry to a CheckpointFile every interval seconds from a background thread,
+    and restores them into the registry. Snapshots that were restored for meters which have not been created again yet
+    are kept in every checkpoint, so they are not lost when a meter is only used now and then.
+
+    Writing a checkpoint takes time in proportion to the size of the registry. After every checkpoint the wait until the
+    next one is stretched if needed, so that checkpointing never takes more than max_cost_fraction of the time.
+
+    :param path: str: The path of the checkpoint file
+    :param interval: float: The number of seconds between two checkpoints
+    :param meter_types: [str]: The snapshot types of the meters to checkpoint
+    :param max_cost_fraction: float: The largest fraction of the time that may be spent checkpointing
+    """
+    def __init__(self, path: str, interval: float = 10, meter_types: [str] = ("Counter", "Timer"),
+                 max_cost_fraction: float = .01):
+        self._logger = getLogger(self.__class__.__name__)
+        self.checkpoint_file = CheckpointFile(path)
+        self.interval = interval
+        self.meter_types = set(meter_types)
+        self.max_cost_fraction = max_cost_fraction
+        self.last_duration = None
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def restore(self) -> int:
+        """
+        Merges the latest checkpoint into the MeterRegistry, see MeterRegistry.restore_snapshots.
+
+        :return: int: The number of meter snapshots restored
+        """
+        payload = self.checkpoint_file.read()
+        if not payload:
+            return 0
+        try:
+            meter_snapshots = snapshots.unpack_batch(payload)
+        except (snapshots.SnapshotFormatException, IndexError) as e:
+            self._logger.error("Could not restore the checkpoint in {0}: {1}".format(self.checkpoint_file.path, e))
+            return 0
+        registry.MeterRegistry.restore_snapshots(meter_snapshots)
+        return len(meter_snapshots)
+
+    def checkpoint(self) -> float:
+        """
+        Writes a checkpoint of the meters of the registry.
+
+        :return: float: The number of seconds the checkpoint took
+        """
+        with self._lock:
+            start = perf_counter()
+            meter_snapshots = registry.MeterRegistry.snapshot_all(self.meter_types)
+            meter_snapshots += registry.MeterRegistry.get_pending_snapshots(self.meter_types)
+            self.checkpoint_file.write(snapshots.pack_batch(meter_snapshots))
+            self.last_duration = perf_counter() - start
+        return self.last_duration
+
+    def start(self) -> None:
+        """
+        Starts checkpointing from a background thread.
+
+        :return:
+        """
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the background thread and writes a final checkpoint.
+
+        :return:
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.checkpoint()
+        except Exception as e:
+            self._logger.error(e)
+
+    def _run(self) -> None:
+        wait = self.interval
+        while not self._stopped.wait(wait):
+            try:
+                duration = self.checkpoint()
+            except Exception as e:
+                self._logger.error(e)
+                continue
+            wait = max(self.interval, duration / self.max_cost_fraction)
@@ -0,0 +1,202 @@
+"""
+This module reads process and system statistics straight from the Linux /proc file system. It backs the collectors of
+knotty.collectors on Linux, which fall back to psutil everywhere else. Every file is kept open and read again from the
+start into a buffer that is allocated once, and only the fields that are exported are parsed. The values follow the
+definitions psutil uses, so the exported metrics are the same whichever way they are read.
+"""
+import os
+import stat
+import sys
+from time import monotonic
+
+AVAILABLE = sys.platform.startswith("linux") and os.path.exists("/proc/self/stat")
+
+_SECTOR_SIZE = 512
+
+
+class ProcFile:
+    """
+    Reads a file of the /proc file system into a reused buffer. The file is reopened after a fork, as /proc/self then
+    refers to a different process.
+    """
+    def __init__(self, path: str, buffer_size: int = 4096):
+        self._path = path
+        self._buffer = bytearray(buffer_size)
+        self._fd = None
+        self._pid = None
+
+    def read(self) -> bytes:
+        """
+        Reads the whole file, growing the buffer if the file does not fit.
+
+        :return: bytes
+        """
+        pid = os.getpid()
+        if self._fd is None or self._pid != pid:
+            self.close()
+            self._fd = os.open(self._path, os.O_RDONLY)
+            self._pid = pid
+        length = os.preadv(self._fd, [self._buffer], 0)
+        while length == len(self._buffer):
+            self._buffer = bytearray(len(self._buffer) * 2)
+            length = os.preadv(self._fd, [self._buffer], 0)
+        return bytes(memoryview(self._buffer)[:length])
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+def _parse_kilobyte_fields(data: bytes, wanted: dict) -> dict:
+    """
+    Parses the "Name:   123 kB" lines of files such as /proc/meminfo into bytes, keeping only the wanted names.
+
+    :param data: bytes: The content of the file
+    :param wanted: {bytes: str}: The line prefixes to keep, eg b"MemTotal:", mapped to the name to store them as
+    :return: {str: int}
+    """
+    values = dict()
+    for line in data.split(b"\n"):
+        name, _, rest = line.partition(b" ")
+        field = wanted.get(name)
+        if field is not None:
+            values[field] = values.get(field, 0) + int(rest.split()[0]) * 1024
+    return values
+
+
+class ProcessReader:
+    """
+    Reads the statistics of the current process. The CPU percentage is calculated like psutil.Process.cpu_percent
+    without an interval, comparing the CPU time used since the previous call with the wall time that passed, so the
+    first call returns 0.0.
+    """
+    _rollup_fields = {b"Private_Clean:": "uss", b"Private_Dirty:": "uss", b"Private_Hugetlb:": "uss", b"Pss:": "pss",
+                      b"Swap:": "swap"}
+
+    def __init__(self):
+        self._stat = ProcFile("/proc/self/stat")
+        self._statm = ProcFile("/proc/self/statm")
+        self._smaps_rollup = ProcFile("/proc/self/smaps_rollup")
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self._clock_ticks = os.sysconf("SC_CLK_TCK")
+        self._total_memory = SystemReader().total_memory()
+        self._last_cpu = None
+
+    def stat(self) -> tuple:
+        """
+        Reads the CPU percentage, the memory percentage and the thread count of the process from /proc/self/stat.
+
+        :return: tuple(cpu_percent, memory_percent, num_threads)
+        """
+        now = monotonic()
+        # The command name can contain spaces, the fields that follow it are fixed.
+        fields = self._stat.read().rpartition(b")")[2].split()
+        cpu_time = (int(fields[11]) + int(fields[12])) / self._clock_ticks
+        last, self._last_cpu = self._last_cpu, (now, cpu_time)
+        cpu_percent = 0.0
+        if last is not None and now > last[0]:
+            cpu_percent = round((cpu_time - last[1]) / (now - last[0]) * 100, 1)
+        memory_percent = int(fields[21]) * self._page_size / self._total_memory * 100
+        return cpu_percent, memory_percent, int(fields[17])
+
+    def open_file_count(self) -> int:
+        """
+        Counts the regular files the process has open, like len(psutil.Process.open_files()) but without reading the
+        path and position of every file.
+
+        :return: int
+        """
+        count = 0
+        with os.scandir("/proc/self/fd") as entries:
+            for entry in entries:
+                try:
+                    file_stat = entry.stat()
+                except OSError:
+                    continue
+                # psutil leaves out files that have been deleted while open, they have no links left.
+                if stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink:
+                    count += 1
+        return count
+
+    def memory_full_info(self) -> [tuple]:
+        """
+        Reads the same fields as psutil.Process.memory_full_info from /proc/self/statm and /proc/self/smaps_rollup.
+
+        :return: [tuple]: (field, bytes) pairs in the order of psutil
+        """
+        page_size = self._page_size
+        vms, rss, shared, text, lib, data, dirty = (int(value) * page_size for value in self._statm.read().split()[:7])
+        rollup = _parse_kilobyte_fields(self._smaps_rollup.read(), self._rollup_fields)
+        return [("rss", rss), ("vms", vms), ("shared", shared), ("text", text), ("lib", lib), ("data", data),
+                ("dirty", dirty), ("uss", rollup.get("uss", 0)), ("pss", rollup.get("pss", 0)),
+                ("swap", rollup.get("swap", 0))]
+
+
+class SystemReader:
+    """
+    Reads the memory and disk statistics of the host.
+    """
+    _meminfo_fields = {b"MemTotal:": "total", b"MemFree:": "free", b"MemAvailable:": "available",
+                       b"Buffers:": "buffers", b"Cached:": "cached", b"SReclaimable:": "cached", b"Shmem:": "shared",
+                       b"Active:": "active", b"Inactive:": "inactive", b"Slab:": "slab"}
+
+    def __init__(self):
+        self._meminfo = ProcFile("/proc/meminfo")
+        self._diskstats = ProcFile("/proc/diskstats", buffer_size=16384)
+        self._disks = dict()
+
+    def total_memory(self) -> int:
+        return _parse_kilobyte_fields(self._meminfo.read(), {b"MemTotal:": "total"})["total"]
+
+    def virtual_memory(self) -> [tuple]:
+        """
+        Reads the same fields as psutil.virtual_memory from /proc/meminfo.
+
+        :return: [tuple]: (field, value) pairs in the order of psutil
+        """
+        memory = _parse_kilobyte_fields(self._meminfo.read(), self._meminfo_fields)
+        total = memory["total"]
+        available = memory.get("available") or memory["free"] + memory.get("buffers", 0) + memory.get("cached", 0)
+        if available > total:
+            available = memory["free"]
+        return [("total", total), ("available", available), ("percent", round((total - available) / total * 100, 1)),
+                ("used", total - available), ("free", memory["free"]), ("active", memory.get("active", 0)),
+                ("inactive", memory.get("inactive", 0)), ("buffers", memory.get("buffers", 0)),
+                ("cached", memory.get("cached", 0)), ("shared", memory.get("shared", 0)),
+                ("slab", memory.get("slab", 0))]
+
+    def _is_disk(self, name: bytes) -> bool:
+        """
+        Tells whole disks apart from their partitions, which psutil leaves out of its totals, by looking for the device
+        in /sys/block. The answer is remembered for every device.
+
+        :param name: bytes: The device name from /proc/diskstats
+        :return: bool
+        """
+        is_disk = self._disks.get(name)
+        if is_disk is None:
+            is_disk = self._disks[name] = os.path.exists(b"/sys/block/" + name.replace(b"/", b"!"))
+        return is_disk
+
+    def disk_io_counters(self) -> [tuple]:
+        """
+        Reads the same fields as psutil.disk_io_counters from /proc/diskstats, summed over all disks.
+
+        :return: [tuple]: (field, value) pairs in the order of psutil
+        """
+        totals = [0] * 9
+        for line in self._diskstats.read().split(b"\n"):
+            fields = line.split()
+            if len(fields) < 14 or not self._is_disk(fields[2]):
+                continue
+            reads, reads_merged, read_sectors, read_time, writes, writes_merged, write_sectors, write_time, _, \
+                busy_time = map(int, fields[3:13])
+            for index, value in enumerate((reads, writes, read_sectors * _SECTOR_SIZE, write_sectors * _SECTOR_SIZE,
+                                           read_time, write_time, reads_merged, writes_merged, busy_time)):
+                totals[index] += value
+        return list(zip(("read_count", "write_count", "read_bytes", "write_bytes", "read_time", "write_time",
+                         "read_merged_count", "write_merged_count", "busy_time"), totals))
@@ -2,7 +2,9 @@
 This module should hold the registries responsible for managing different metric groups
 """
 import asyncio
-from threading import Thread
+import atexit
+from bisect import bisect_left, insort
+from threading import Thread, Lock
 from logging import getLogger
 
 
@@ -10,11 +12,219 @@ class RegistryCollisionException(Exception):
     pass
 
 
+class _MeterIndex:
+    """
+    Indexes the registered meters by name and by the tags of their series, so that a filtered collection only runs the
+    meters that can match it. Meters are added as they are registered, and every meter reports its new series as it
+    creates them (see knotty.meters.BaseMeter._index_series), so a query never has to read the series of the meters.
+    Only the series a meter derives from its current tags (see knotty.meters.BaseMeter.tag_series_keys) are read at
+    every query, as tags can change at any time. The index is rebuilt from scratch if the meters dictionary is replaced
+    or changed behind the back of the registry. The entries of series that a meter no longer holds, eg once it has been
+    drained, are only removed by prune. Until then they can only add candidates, the collected metrics are filtered
+    again afterwards.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._meters = None
+        self._meter_count = 0
+        self._names = []
+        self._by_name = dict()
+        self._by_tag = dict()
+        self._by_tag_key = dict()
+        self._any_value = dict()
+        self._any_tag = set()
+        self._tag_derived = dict()
+
+    def _refresh(self, meters: dict) -> None:
+        if meters is self._meters and len(meters) == self._meter_count:
+            return
+        self.__init__()
+        self._meters = meters
+        for meter_key, meter in list(meters.items()):
+            self.add_meter(meters, meter_key, meter)
+
+    def add_meter(self, meters: dict, meter_key: tuple, meter: "knotty.meters.BaseMeter") -> None:
+        """
+        Adds a meter that has just been registered, along with the series it already holds.
+
+        :param meters: dict: The meters dictionary of the registry
+        :param meter_key: tuple: The key of the meter in the meters dictionary
+        :param meter: knotty.meters.BaseMeter
+        :return:
+        """
+        if meters is not self._meters:
+            self._refresh(meters)
+            return
+        self._meter_count = len(meters)
+        name = meter_key[1]
+        if name not in self._by_name:
+            insort(self._names, name)
+        self._by_name.setdefault(name, []).append(meter_key)
+        if meter._tag_derived_series:
+            self._tag_derived[meter_key] = meter
+        series_keys = meter.series_keys()
+        if series_keys is None:
+            self._any_tag.add(meter_key)
+            return
+        for series_key in list(series_keys):
+            self.add_series(meter_key, series_key)
+
+    def add_series(self, meter_key: tuple, series_key: tuple) -> None:
+        """
+        Adds a new series of a meter.
+
+        :param meter_key: tuple: The key of the meter in the meters dictionary
+        :param series_key: tuple: The metric key of the series, a tag value of None stands for any value
+        :return:
+        """
+        with self._lock:
+            _index_series(meter_key, series_key, self._by_tag, self._by_tag_key, self._any_value)
+
+    def prune(self, meters: dict) -> None:
+        """
+        Rebuilds the tag entries of the index from the series the meters hold now, which removes the entries of the
+        series they no longer hold. The entries are rebuilt aside while queries keep using the current ones, and new
+        series wait for the rebuild to finish, so none of them is left out.
+
+        :param meters: dict: The meters dictionary of the registry
+        :return:
+        """
+        if meters is not self._meters:
+            self._refresh(meters)
+            return
+        by_tag, by_tag_key, any_value = dict(), dict(), dict()
+        with self._lock:
+            for meter_key, meter in list(meters.items()):
+                series_keys = meter.series_keys()
+                if series_keys is not None:
+                    for series_key in list(series_keys):
+                        _index_series(meter_key, series_key, by_tag, by_tag_key, any_value)
+            self._by_tag, self._by_tag_key, self._any_value = by_tag, by_tag_key, any_value
+
+    def _tag_derived_matches(self, tag: str, value) -> set:
+        """
+        Finds the meters whose tag derived series can have the given tag, see knotty.meters.BaseMeter.tag_series_keys.
+        """
+        matching = set()
+        for meter_key, meter in list(self._tag_derived.items()):
+            series_keys = meter.tag_series_keys()
+            if series_keys is None:
+                matching.add(meter_key)
+                continue
+            for series_key in series_keys:
+                if any(tag == key and (value is None or series_value is None or str(series_value) == str(value))
+                       for key, series_value in series_key):
+                    matching.add(meter_key)
+                    break
+        return matching
+
+    def find(self, meters: dict, names: [str] = None, tags: dict = None) -> set:
+        """
+        Finds the keys of the meters that can produce metrics matching the filters.
+
+        :param meters: dict: The meters dictionary of the registry
+        :param names: [str]: Metric name prefixes, a meter matches if it can produce a metric with any of them
+        :param tags: {str: str}: Tags that the metrics need to have, a value of None matches any value of the tag
+        :return: set: The matching meter keys, None if no filter was given
+        """
+        self._refresh(meters)
+        found = None
+        if names:
+            found = set()
+            for prefix in names:
+                position = bisect_left(self._names, prefix)
+                while position < len(self._names) and self._names[position].startswith(prefix):
+                    found.update(self._by_name[self._names[position]])
+                    position += 1
+                # The metric names of a meter extend its name, eg <name>_time_sum
+                for end in range(1, len(prefix)):
+                    found.update(self._by_name.get(prefix[:end], ()))
+        for tag, value in (tags or dict()).items():
+            if value is None:
+                matching = self._by_tag_key.get(tag, set()) | self._any_tag
+            else:
+                matching = self._by_tag.get((tag, str(value)), set()) | self._any_value.get(tag, set()) | self._any_tag
+            matching = matching | self._tag_derived_matches(tag, value)
+            found = matching if found is None else found & matching
+        return found
+
+
+def _index_series(meter_key: tuple, series_key: tuple, by_tag: dict, by_tag_key: dict, any_value: dict) -> None:
+    """
+    Adds the entries of a series of a meter to the tag entries of a _MeterIndex.
+    """
+    for tag, value in series_key:
+        by_tag_key.setdefault(tag, set()).add(meter_key)
+        if value is None:
+            any_value.setdefault(tag, set()).add(meter_key)
+        else:
+            by_tag.setdefault((tag, str(value)), set()).add(meter_key)
+
+
+def _metric_matches(metric: "knotty.meters.Metric", names: [str] = None, tags: dict = None) -> bool:
+    """
+    Checks a collected metric against the filters of MeterRegistry.get_all_metrics.
+    """
+    if names and not any(metric.name.startswith(prefix) for prefix in names):
+        return False
+    if tags:
+        return _tags_match(metric.tags, tags)
+    return True
+
+
+def _tags_match(metric_tags: tuple, tags: dict) -> bool:
+    metric_tags = {tag: str(value) for tag, value in metric_tags}
+    return all(tag in metric_tags and (value is None or metric_tags[tag] == str(value)) for tag, value in tags.items())
+
+
+def _filter_batch(batch: "knotty.meters.MetricBatch", names: [str] = None,
+                  tags: dict = None) -> "knotty.meters.MetricBatch":
+    """
+    Applies the filters of MeterRegistry.get_all_metrics to a batch of metrics. The name is checked once for the whole
+    batch, the tags are checked per sample.
+
+    :return: knotty.meters.MetricBatch: The batch or the part of it that matches, None if nothing does
+    """
+    if names and not any(batch.name.startswith(prefix) for prefix in names):
+        return None
+    if tags:
+        rows = [index for index, key in enumerate(batch.keys) if _tags_match(key, tags)]
+        if len(rows) < len(batch):
+            batch = type(batch)(batch.name, batch.prometheus_type, [batch.keys[index] for index in rows],
+                                [batch.values[index] for index in rows])
+    return batch if len(batch) else None
+
+
+def _group_name(meter: "knotty.meters.BaseMeter") -> str:
+    """
+    Returns the name of the meter, or the name of the meter it belongs to, that aiter_metric_batches groups it by.
+
+    :param meter: knotty.meters.BaseMeter
+    :return: str
+    """
+    return meter.name if meter.owner is None else meter.owner.name
+
+
+async def _next_batch(batches) -> list:
+    """
+    Awaits the next batch of an async generator of batches.
+
+    :return: list, or None when the generator is exhausted
+    """
+    try:
+        return await batches.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
 class MeterRegistry:
     push_interval: int = None
     _meters = dict()
+    _index = _MeterIndex()
     _loop = asyncio.new_event_loop()
     _thread: Thread = None
+    _pending_snapshots = dict()
+    _checkpointer = None
 
     @classmethod
     def add_meter(cls, meter: "knotty.meters.BaseMeter") -> None:
@@ -27,6 +237,12 @@ class MeterRegistry:
         meter_key = tuple([meter.__class__, meter.name])
         logger.debug(f"Adding meter {meter_key}")
         cls._meters[meter_key] = meter
+        cls._index.add_meter(cls._meters, meter_key, meter)
+        if cls._pending_snapshots:
+            pending_snapshot = cls._pending_snapshots.pop((meter.snapshot_type, meter.name), None)
+            if pending_snapshot is not None:
+                logger.debug(f"Restoring meter {meter_key}")
+                meter.merge(pending_snapshot)
 
     @classmethod
     def get_meter(cls, name: str, meter_class: "knotty.meters.BaseMeter") -> "knotty.meters.BaseMeter":
@@ -41,6 +257,16 @@ class MeterRegistry:
         """
         return cls._meters.get(tuple([meter_class, name])) or meter_class(name)
 
+    @classmethod
+    def index_series(cls, meter: "knotty.meters.BaseMeter", series_key: tuple) -> None:
+        """
+        Adds a new series of a meter to the index that filtered collections use, see find_meters.
+        :param meter: knotty.meters.BaseMeter
+        :param series_key: tuple: The metric key of the series
+        :return:
+        """
+        cls._index.add_series(tuple([meter.__class__, meter.name]), series_key)
+
     @classmethod
     def is_meter_registered(cls, meter: "knotty.meters.BaseMeter") -> bool:
         """
@@ -50,6 +276,120 @@ class MeterRegistry:
         """
         return tuple([meter.__class__, meter.name]) in cls._meters.keys()
 
+    @classmethod
+    def snapshot_all(cls, meter_types: {str} = None) -> [bytes]:
+        """
+        Takes a snapshot of every registered meter that supports them. Counters that belong to a Timer are left out, as
+        the snapshot of the Timer already holds their counts.
+        :param meter_types: {str}: Only snapshot the meters with one of these snapshot types, eg {"Counter", "Timer"}
+        :return: [bytes]: One snapshot per meter, see knotty.snapshots
+        """
+        return [meter.snapshot() for meter in list(cls._meters.values())
+                if meter.snapshot_type is not None and meter.owner is None and
+                (meter_types is None or meter.snapshot_type in meter_types)]
+
+    @classmethod
+    def drain_all(cls, max_snapshot_size: int = None) -> [bytes]:
+        """
+        Drains every registered meter that supports snapshots, see knotty.meters.BaseMeter.drain. Counters that belong
+        to a Timer are drained along with their Timer. With a max_snapshot_size the snapshot of a meter is split into
+        several snapshots that do not exceed it, see knotty.meters.BaseMeter.drain_split. Before the meters are drained
+        the series IDs of the series that were not recorded since the previous drain are released, see
+        release_unused_series, so the IDs of series that are not recorded for two drains in a row are reused.
+        :param max_snapshot_size: int: The size in bytes the snapshots should not exceed, None to never split them
+        :return: [bytes]: The snapshots of every meter, holding what was recorded since the previous drain
+        """
+        cls.release_unused_series()
+        drained = [meter for meter in list(cls._meters.values())
+                   if meter.snapshot_type is not None and meter.owner is None]
+        if max_snapshot_size is None:
+            return [meter.drain() for meter in drained]
+        return [snapshot for meter in drained for snapshot in meter.drain_split(max_snapshot_size)]
+
+    @classmethod
+    def release_unused_series(cls) -> int:
+        """
+        Releases the series IDs that none of the registered meters holds, see knotty.meters.TagSets.release_unused. An
+        ID is only released once it was unused at two consecutive calls. The index of the meters is pruned of the series
+        the meters no longer hold along with it, see _MeterIndex.prune.
+        :return: int: The number of IDs released
+        """
+        from knotty import meters
+        cls._index.prune(cls._meters)
+        used_ids = set()
+        for meter in list(cls._meters.values()):
+            used_ids |= meter.series_ids()
+        return meters.TagSets.release_unused(used_ids)
+
+    @classmethod
+    def merge_snapshot(cls, snapshot: bytes) -> "knotty.meters.BaseMeter":
+        """
+        Merges a meter snapshot into the registry, creating the meter it belongs to if it does not exist yet.
+        :param snapshot: bytes: A snapshot created by knotty.meters.BaseMeter.snapshot
+        :return: knotty.meters.BaseMeter: The meter the snapshot was merged into
+        """
+        from knotty import meters, snapshots
+        reader = snapshots.SnapshotReader(snapshot)
+        meter_class = getattr(meters, reader.meter_type, None)
+        if not (isinstance(meter_class, type) and issubclass(meter_class, meters.BaseMeter)):
+            raise snapshots.SnapshotFormatException("Unknown meter type {0}".format(reader.meter_type))
+        meter = cls.get_meter(reader.name, meter_class)
+        meter.merge(snapshot)
+        return meter
+
+    @classmethod
+    def restore_snapshots(cls, snapshots: [bytes]) -> None:
+        """
+        Merges snapshots that were persisted by an earlier run of the process. Snapshots of meters that are registered
+        are merged right away, the others are kept until their meter is created, so restoring does not create meters
+        and the application can still create them directly.
+        :param snapshots: [bytes]: Snapshots created by knotty.meters.BaseMeter.snapshot
+        :return:
+        """
+        from knotty import meters, snapshots as snapshot_format
+        for snapshot in snapshots:
+            reader = snapshot_format.SnapshotReader(snapshot)
+            meter_class = getattr(meters, reader.meter_type, None)
+            meter = cls._meters.get(tuple([meter_class, reader.name]))
+            if meter is not None:
+                meter.merge(snapshot)
+            else:
+                cls._pending_snapshots[(reader.meter_type, reader.name)] = snapshot
+
+    @classmethod
+    def get_pending_snapshots(cls, meter_types: {str} = None) -> [bytes]:
+        """
+        Returns the restored snapshots whose meters have not been created yet.
+        :param meter_types: {str}: Only return the snapshots of these snapshot types
+        :return: [bytes]
+        """
+        return [snapshot for (meter_type, _), snapshot in list(cls._pending_snapshots.items())
+                if meter_types is None or meter_type in meter_types]
+
+    @classmethod
+    def enable_persistence(cls, path: str, interval: float = 10, meter_types: [str] = ("Counter", "Timer"),
+                           max_cost_fraction: float = .01) -> "knotty.persistence.Checkpointer":
+        """
+        Restores the meters checkpointed to the given file by an earlier run of the process, and starts checkpointing
+        them to it every interval seconds and once more when the process exits, see knotty.persistence.
+        :param path: str: The path of the checkpoint file
+        :param interval: float: The number of seconds between two checkpoints
+        :param meter_types: [str]: The snapshot types of the meters to persist
+        :param max_cost_fraction: float: The largest fraction of the time that may be spent checkpointing
+        :return: knotty.persistence.Checkpointer
+        """
+        from knotty import persistence
+        logger = getLogger(f"{cls.__name__}.enable_persistence")
+        if cls._checkpointer is not None:
+            cls._checkpointer.stop()
+            atexit.unregister(cls._checkpointer.stop)
+        cls._checkpointer = persistence.Checkpointer(path, interval, meter_types, max_cost_fraction)
+        restored = cls._checkpointer.restore()
+        logger.debug(f"Restored {restored} meters from {path}")
+        cls._checkpointer.start()
+        atexit.register(cls._checkpointer.stop)
+        return cls._checkpointer
+
     @classmethod
     def _start_background_loop(cls) -> None:
         """
@@ -63,27 +403,124 @@ class MeterRegistry:
         cls._loop.run_forever()
 
     @classmethod
-    async def _async_gather_metrics(cls) -> "[knotty.meters.Metric]":
+    def find_meters(cls, names: [str] = None, tags: dict = None) -> "[knotty.meters.BaseMeter]":
+        """
+        Finds the registered meters that can produce metrics matching the given filters, using the name and tag index.
+        :param names: [str]: Metric name prefixes, any of which the metrics need to start with
+        :param tags: {str: str}: Tags the metrics need to have, a value of None matches any value of the tag
+        :return: [knotty.meters.BaseMeter]
+        """
+        found = cls._index.find(cls._meters, names, tags)
+        if found is None:
+            return list(cls._meters.values())
+        return [meter for key, meter in list(cls._meters.items()) if key in found]
+
+    @classmethod
+    def get_collection_ages(cls) -> dict:
+        """
+        Reports how old the metrics served for every meter with a collection interval are, see
+        knotty.meters.BaseMeter.set_collection_interval.
+        :return: {tuple: float}: The age in seconds by meter key, None for meters that have not been collected yet
+        """
+        return {key: meter.collection_age for key, meter in list(cls._meters.items())
+                if meter._collection_interval is not None}
+
+    @classmethod
+    async def _async_gather_metrics(cls, meters: "[knotty.meters.BaseMeter]" = None) -> "[knotty.meters.Metric]":
         """
         Creates a list of synchronous tasks and applies them to the class async event loop.
+        :param meters: [knotty.meters.BaseMeter]: The meters to collect, all registered meters if not provided
         :return: [knotty.meters.Metric]: A list of metrics returned from the registered meters
         """
-        tasks = [cls._loop.create_task(meter.get_metrics()) for key, meter in cls._meters.items()]
+        if meters is None:
+            meters = list(cls._meters.values())
+        tasks = [cls._loop.create_task(meter.collect_metrics()) for meter in meters]
         results = await asyncio.gather(*tasks)
         return results
 
     @classmethod
-    def get_all_metrics(cls) -> "[knotty.meters.Metric]":
+    def _ensure_collection_thread(cls) -> None:
+        logger = getLogger(f"{cls.__name__}._ensure_collection_thread")
+        if cls._thread is None:
+            logger.debug("Knotty collection thread not initiated, starting now.")
+            cls._thread = Thread(target=cls._start_background_loop, daemon=True)
+            cls._thread.start()
+
+    @classmethod
+    def get_all_metrics(cls, names: [str] = None, tags: dict = None) -> "[knotty.meters.Metric]":
         """
         Ensures that the classes execution thread is up and running before managing the collection and return of all
-        metrics from all registered meters.
+        metrics from all registered meters. If filters are given only the meters that can match them are collected, and
+        only the matching metrics are returned.
+        :param names: [str]: Metric name prefixes, any of which the metrics need to start with
+        :param tags: {str: str}: Tags the metrics need to have, a value of None matches any value of the tag
         :return: [knotty.meters.Metric]: A flattened list of all metrics from all registered meters
         """
         logger = getLogger(f"{cls.__name__}.get_all_metrics")
         logger.debug("Collecting all metrics.")
-        if cls._thread is None:
-            logger.debug("Knotty collection thread not initiated, starting now.")
-            cls._thread = Thread(target=cls._start_background_loop, daemon=True)
-            cls._thread.start()
-        task = asyncio.run_coroutine_threadsafe(cls._async_gather_metrics(), cls._loop)
-        return [metric for metric_list in task.result() for metric in metric_list]
+        cls._ensure_collection_thread()
+        if not (names or tags):
+            task = asyncio.run_coroutine_threadsafe(cls._async_gather_metrics(), cls._loop)
+            return [metric for metric_list in task.result() for metric in metric_list]
+        task = asyncio.run_coroutine_threadsafe(cls._async_gather_metrics(cls.find_meters(names, tags)), cls._loop)
+        return [metric for metric_list in task.result() for metric in metric_list
+                if _metric_matches(metric, names, tags)]
+
+    @classmethod
+    async def aiter_metric_batches(cls, names: [str] = None, tags: dict = None, meters_per_batch: int = 64):
+        """
+        Collects the metrics of the registered meters a few meters at a time, yielding the MetricBatches of every
+        meters_per_batch meters together. The meters of a batch are collected concurrently, and the next meters are only
+        collected once the batch has been consumed, so the metrics of the whole registry are never held at once. The
+        meters that share a name, eg the collectors of a process, are always collected in the same batch, and so is a
+        Counter that belongs to a Timer along with its Timer, so the metrics of a family are never split between two
+        batches as long as the family names of every meter start with its own name.
+        :param names: [str]: Metric name prefixes, any of which the metrics need to start with
+        :param tags: {str: str}: Tags the metrics need to have, a value of None matches any value of the tag
+        :param meters_per_batch: int: The number of meters to collect for each batch
+        :return: An async generator of [knotty.meters.MetricBatch] lists, empty lists are left out
+        """
+        filtered = bool(names or tags)
+        meters = cls.find_meters(names, tags) if filtered else list(cls._meters.values())
+        # The meters are grouped by name in the order the names were first registered, a Counter is grouped with the
+        # Timer it belongs to, which it is registered just before.
+        groups = dict()
+        for meter in meters:
+            groups.setdefault(_group_name(meter), []).append(meter)
+        meters = [meter for group in groups.values() for meter in group]
+        start = 0
+        while start < len(meters):
+            end = min(start + meters_per_batch, len(meters))
+            while end < len(meters) and (meters[end - 1].owner is not None or
+                                         _group_name(meters[end - 1]) == _group_name(meters[end])):
+                end += 1
+            results = await asyncio.gather(*[meter.collect_batches() for meter in meters[start:end]])
+            start = end
+            if filtered:
+                batches = [_filter_batch(batch, names, tags) for batch_list in results for batch in batch_list]
+                batches = [batch for batch in batches if batch is not None]
+            else:
+                batches = [batch for batch_list in results for batch in batch_list if len(batch)]
+            if batches:
+                yield batches
+
+    @classmethod
+    def iter_metric_batches(cls, names: [str] = None, tags: dict = None, meters_per_batch: int = 64):
+        """
+        Collects the metrics of the registered meters on the classes execution thread one batch at a time, see
+        aiter_metric_batches. Each batch is only collected when the previous one has been consumed.
+        :param names: [str]: Metric name prefixes, any of which the metrics need to start with
+        :param tags: {str: str}: Tags the metrics need to have, a value of None matches any value of the tag
+        :param meters_per_batch: int: The number of meters to collect for each batch
+        :return: A generator of [knotty.meters.MetricBatch] lists
+        """
+        cls._ensure_collection_thread()
+        batches = cls.aiter_metric_batches(names, tags, meters_per_batch)
+        try:
+            while True:
+                batch = asyncio.run_coroutine_threadsafe(_next_batch(batches), cls._loop).result()
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            asyncio.run_coroutine_threadsafe(batches.aclose(), cls._loop).result()
@@ -0,0 +1,330 @@
+"""
+This module holds the wire format of the Prometheus remote write protocol, which the RemoteWriteExporter pushes metrics
+with (see knotty.exporters). A remote write request is a protobuf WriteRequest message compressed with the block
+format of snappy:
+
+message WriteRequest { repeated TimeSeries timeseries = 1; }
+message TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; }
+message Label { string name = 1; string value = 2; }
+message Sample { double value = 1; int64 timestamp = 2; }
+
+The few messages involved are encoded by hand, so neither protobuf nor generated code is needed. The labels of a series
+are encoded once into the bytes they take up in a TimeSeries (see encode_labels), and can be cached and reused for every
+sample of the series. Snappy compression uses python-snappy when it is installed, and a pure Python implementation of
+the block format otherwise, which produces larger payloads more slowly but is understood by every receiver.
+"""
+import re
+import struct
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+CONTENT_TYPE = "application/x-protobuf"
+CONTENT_ENCODING = "snappy"
+PROTOCOL_VERSION = "0.1.0"
+
+_DOUBLE = struct.Struct("<d")
+_invalid_name_characters = re.compile(r"[^a-zA-Z0-9_:]")
+_invalid_label_characters = re.compile(r"[^a-zA-Z0-9_]")
+
+
+class RemoteWriteFormatException(Exception):
+    pass
+
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, position: int) -> tuple:
+    """
+    Reads a varint of at most 64 bits.
+
+    :return: tuple(int, int): The value and the position after it
+    """
+    result = 0
+    shift = 0
+    while True:
+        if position >= len(data) or shift > 63:
+            raise RemoteWriteFormatException("Truncated or overlong varint at {0}".format(position))
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _write_field(buffer: bytearray, field_tag: int, content: bytes) -> None:
+    """
+    Writes a length delimited field, eg an embedded message or a string.
+    """
+    buffer.append(field_tag)
+    _write_varint(buffer, len(content))
+    buffer += content
+
+
+def metric_name(name: str) -> str:
+    """
+    Replaces the characters Prometheus does not allow in metric names with underscores.
+
+    :param name: str
+    :return: str
+    """
+    name = _invalid_name_characters.sub("_", name)
+    return "_" + name if name[:1].isdigit() else name
+
+
+def label_name(name: str) -> str:
+    """
+    Replaces the characters Prometheus does not allow in label names with underscores. A single invalid label makes a
+    receiver reject the whole request, so labels are always sanitized.
+
+    :param name: str
+    :return: str
+    """
+    name = _invalid_label_characters.sub("_", name)
+    return "_" + name if name[:1].isdigit() else name
+
+
+def encode_labels(name: str, tags: tuple) -> bytes:
+    """
+    Encodes the labels of a series, the metric name as __name__ followed by its tags sorted by name as receivers
+    require, into the label fields of a TimeSeries message.
+
+    :param name: str: The metric name
+    :param tags: tuple of (str, value) pairs, the values are converted to str
+    :return: bytes
+    """
+    labels = {label_name(str(tag)): str(value) for tag, value in tags}
+    labels["__name__"] = metric_name(name)
+    buffer = bytearray()
+    for label, value in sorted(labels.items()):
+        label_buffer = bytearray()
+        _write_field(label_buffer, 0x0a, label.encode("utf-8"))
+        _write_field(label_buffer, 0x12, value.encode("utf-8"))
+        _write_field(buffer, 0x0a, label_buffer)
+    return bytes(buffer)
+
+
+def encode_write_request(samples: [tuple]) -> bytes:
+    """
+    Encodes samples into a WriteRequest. The samples of the same series are sent in a single TimeSeries, in the order
+    they are given, which needs to be the order of their timestamps.
+
+    :param samples: [tuple(bytes, float, int)]: The encoded labels of the series (see encode_labels), the value and the
+        timestamp in milliseconds of every sample
+    :return: bytes
+    """
+    series = dict()
+    for labels, value, timestamp in samples:
+        sample = bytearray(b"\x09")
+        sample += _DOUBLE.pack(value)
+        if timestamp:
+            sample.append(0x10)
+            _write_varint(sample, timestamp & 0xffffffffffffffff)
+        encoded = series.get(labels)
+        if encoded is None:
+            encoded = series[labels] = bytearray(labels)
+        _write_field(encoded, 0x12, sample)
+    buffer = bytearray()
+    for encoded in series.values():
+        _write_field(buffer, 0x0a, encoded)
+    return bytes(buffer)
+
+
+def _fields(data: bytes) -> iter:
+    """
+    Iterates over the fields of a protobuf message, skipping over the wire types that remote write does not use.
+
+    :return: A generator of tuple(field number, wire type, value), the value of a length delimited field is bytes
+    """
+    position = 0
+    while position < len(data):
+        key, position = _read_varint(data, position)
+        field_number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, position = _read_varint(data, position)
+        elif wire_type == 1:
+            value, position = data[position:position + 8], position + 8
+        elif wire_type == 2:
+            length, position = _read_varint(data, position)
+            value, position = data[position:position + length], position + length
+        elif wire_type == 5:
+            value, position = data[position:position + 4], position + 4
+        else:
+            raise RemoteWriteFormatException("Unsupported wire type {0}".format(wire_type))
+        if position > len(data):
+            raise RemoteWriteFormatException("Truncated field {0}".format(field_number))
+        yield field_number, wire_type, value
+
+
+def decode_write_request(payload: bytes) -> [tuple]:
+    """
+    Decodes an uncompressed WriteRequest, eg in a receiver.
+
+    :param payload: bytes
+    :return: [tuple([(str, str)], [(float, int)])]: The labels and the samples of every TimeSeries
+    """
+    series = []
+    for field_number, wire_type, time_series in _fields(payload):
+        if field_number != 1 or wire_type != 2:
+            continue
+        labels, samples = [], []
+        for series_field, series_wire_type, content in _fields(time_series):
+            if series_wire_type != 2:
+                continue
+            if series_field == 1:
+                label = {number: value.decode("utf-8") for number, _, value in _fields(content)}
+                labels.append((label.get(1, ""), label.get(2, "")))
+            elif series_field == 2:
+                sample = {number: value for number, _, value in _fields(content)}
+                timestamp = sample.get(2, 0)
+                if timestamp >= 1 << 63:
+                    timestamp -= 1 << 64
+                samples.append((_DOUBLE.unpack(sample[1])[0] if 1 in sample else 0.0, timestamp))
+        series.append((labels, samples))
+    return series
+
+
+def _snappy_literal(buffer: bytearray, literal: bytes) -> None:
+    length = len(literal) - 1
+    if length < 60:
+        buffer.append(length << 2)
+    else:
+        extra_bytes = (length.bit_length() + 7) // 8
+        buffer.append((59 + extra_bytes) << 2)
+        buffer += length.to_bytes(extra_bytes, "little")
+    buffer += literal
+
+
+def _snappy_copy(buffer: bytearray, offset: int, length: int) -> None:
+    while length > 0:
+        if 4 <= length <= 11 and offset < 2048:
+            buffer.append(0x01 | ((length - 4) << 2) | ((offset >> 8) << 5))
+            buffer.append(offset & 0xff)
+            return
+        # Keep at least 4 bytes for the last copy, so it can use the short form.
+        part = min(length, 64) if length - 64 >= 4 or length <= 64 else 60
+        buffer.append(0x02 | ((part - 1) << 2))
+        buffer += offset.to_bytes(2, "little")
+        length -= part
+
+
+def _compress(data: bytes) -> bytes:
+    """
+    Compresses data into the snappy block format. Matches are found through a table of the last position of every four
+    byte sequence, and the distance between lookups grows while no match is found, so data that does not compress is
+    skipped over quickly.
+
+    :param data: bytes
+    :return: bytes
+    """
+    data = bytes(data)
+    buffer = bytearray()
+    _write_varint(buffer, len(data))
+    table = dict()
+    literal_start = position = 0
+    misses = 32
+    limit = len(data) - 4
+    while position <= limit:
+        sequence = data[position:position + 4]
+        candidate = table.get(sequence)
+        table[sequence] = position
+        if candidate is None or position - candidate > 0xffff:
+            position += misses >> 5
+            misses += 1
+            continue
+        length = 4
+        # Extend the match in steps of 64 and then 8 bytes before comparing single bytes.
+        for step in (64, 8, 1):
+            while position + length + step <= len(data) and \
+                    data[candidate + length:candidate + length + step] == \
+                    data[position + length:position + length + step]:
+                length += step
+        if literal_start < position:
+            _snappy_literal(buffer, data[literal_start:position])
+        _snappy_copy(buffer, position - candidate, length)
+        position += length
+        literal_start = position
+        misses = 32
+    if literal_start < len(data):
+        _snappy_literal(buffer, data[literal_start:])
+    return bytes(buffer)
+
+
+def _decompress(data: bytes) -> bytes:
+    """
+    Decompresses data in the snappy block format.
+
+    :param data: bytes
+    :return: bytes
+    """
+    length, position = _read_varint(data, 0)
+    output = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        element_type = tag & 0x03
+        if element_type == 0:
+            literal_length = tag >> 2
+            if literal_length >= 60:
+                extra_bytes = literal_length - 59
+                literal_length = int.from_bytes(data[position:position + extra_bytes], "little")
+                position += extra_bytes
+            literal_length += 1
+            if position + literal_length > len(data):
+                raise RemoteWriteFormatException("Truncated literal at {0}".format(position))
+            output += data[position:position + literal_length]
+            position += literal_length
+            continue
+        if element_type == 1:
+            copy_length = ((tag >> 2) & 0x07) + 4
+            offset = ((tag >> 5) << 8) | data[position]
+            position += 1
+        else:
+            copy_length = (tag >> 2) + 1
+            offset_bytes = 2 if element_type == 2 else 4
+            offset = int.from_bytes(data[position:position + offset_bytes], "little")
+            position += offset_bytes
+        if not 0 < offset <= len(output):
+            raise RemoteWriteFormatException("Invalid copy offset {0} at {1}".format(offset, position))
+        start = len(output) - offset
+        if offset >= copy_length:
+            output += output[start:start + copy_length]
+        else:
+            # The copy overlaps the bytes it produces, which repeats the last offset bytes.
+            pattern = output[start:]
+            output += (pattern * (copy_length // offset + 1))[:copy_length]
+    if len(output) != length:
+        raise RemoteWriteFormatException("Expected {0} bytes, decompressed {1}".format(length, len(output)))
+    return bytes(output)
+
+
+def compress(data: bytes) -> bytes:
+    """
+    Compresses data into the snappy block format, with python-snappy if it is installed.
+
+    :param data: bytes
+    :return: bytes
+    """
+    if snappy is not None:
+        return snappy.compress(data)
+    return _compress(data)
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Decompresses data in the snappy block format, with python-snappy if it is installed.
+
+    :param data: bytes
+    :return: bytes
+    """
+    if snappy is not None:
+        return snappy.decompress(data)
+    return _decompress(data)
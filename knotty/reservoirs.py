@@ -0,0 +1,243 @@
+"""
+This module holds the reservoirs that a Histogram can use to store the values of each of its series. A reservoir decides
+which of the recorded values are kept, and therefore which values the exported sums, counts, buckets and percentiles
+describe. Every reservoir uses a bounded amount of memory no matter how many values are recorded.
+"""
+from time import monotonic
+from random import random, randrange
+from heapq import heappush, heapreplace
+from itertools import count
+from math import exp
+from numpy import percentile, asarray, argsort, cumsum, searchsorted, empty, ones, int64, float64
+
+
+class Reservoir:
+    """
+    Base class for all reservoirs.
+    """
+    def update(self, value: float, weight: int = 1) -> None:
+        """
+        Records a new value.
+
+        :param value: float (or int)
+        :param weight: int: The number of observations the value represents when the caller is sampling
+        :return:
+        """
+        raise NotImplementedError()
+
+    def update_many(self, values, weight: int = 1) -> None:
+        """
+        Records a batch of values that all carry the same weight. Reservoirs that can store a whole batch at once
+        override this, the default records the values one by one.
+
+        :param values: A list or NumPy array of values
+        :param weight: int: The number of observations each value represents when the caller is sampling
+        :return:
+        """
+        for value in values:
+            self.update(value, weight)
+
+    def snapshot(self) -> tuple:
+        """
+        Returns the values currently held by the reservoir along with their weights. The weights state how many
+        observations each value stands for, so that summing them gives the count of observations that the values
+        describe. If every value stands for a single observation the weights are None.
+
+        :return: tuple(values, weights)
+        """
+        raise NotImplementedError()
+
+    def percentiles(self, percentiles: [float]) -> list:
+        """
+        Calculates the requested percentiles of the values currently held by the reservoir.
+
+        :param percentiles: [float]: The percentiles to calculate, eg [50, 99]
+        :return: list: The value of each requested percentile
+        """
+        values, _ = self.snapshot()
+        return list(percentile(values, percentiles))
+
+
+class RecentValuesReservoir(Reservoir):
+    """
+    Keeps the most recent size values regardless of their age. This is the default reservoir of the Histogram. The
+    values are kept in a NumPy ring buffer that is allocated once, with an integer dtype as long as only integers are
+    recorded. Weights are only allocated once a sampled value is recorded. Snapshots are copies of the buffer in storage
+    order rather than the order the values were recorded in, which does not matter for any of the exported statistics.
+    """
+    _no_values = empty(0, dtype=int64)
+    _int64_max = 2 ** 63 - 1
+
+    def __init__(self, size: int = 1000):
+        self._size = size
+        self._values = None
+        self._weights = None
+        self._index = 0
+        self._filled = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def is_full(self) -> bool:
+        return self._filled == self._size
+
+    def update(self, value: float, weight: int = 1) -> None:
+        values = self._values
+        if values is None:
+            values = self._values = empty(self._size, dtype=int64 if isinstance(value, int) else float64)
+        elif values.dtype == int64 and not isinstance(value, int):
+            values = self._values = values.astype(float64)
+        index = self._index
+        try:
+            values[index] = value
+        except OverflowError:
+            # Integers outside the range of int64 are kept as floats.
+            values = self._values = values.astype(float64)
+            values[index] = value
+        if self._weights is not None:
+            self._weights[index] = weight
+        elif weight != 1:
+            self._weights = ones(self._size, dtype=int64)
+            self._weights[index] = weight
+        self._index = index + 1 if index + 1 < self._size else 0
+        if self._filled < self._size:
+            self._filled += 1
+
+    def update_many(self, values, weight: int = 1) -> None:
+        values = asarray(values)
+        if not len(values):
+            return
+        if len(values) > self._size:
+            values = values[-self._size:]
+        integral = values.dtype.kind in "ib" or (values.dtype.kind == "u" and values.max() <= self._int64_max)
+        if self._values is None:
+            self._values = empty(self._size, dtype=int64 if integral else float64)
+        elif self._values.dtype == int64 and not integral:
+            self._values = self._values.astype(float64)
+        if self._weights is None and weight != 1:
+            self._weights = ones(self._size, dtype=int64)
+        start = self._index
+        head = min(len(values), self._size - start)
+        self._values[start:start + head] = values[:head]
+        self._values[:len(values) - head] = values[head:]
+        if self._weights is not None:
+            self._weights[start:start + head] = weight
+            self._weights[:len(values) - head] = weight
+        self._index = (start + len(values)) % self._size
+        self._filled = min(self._filled + len(values), self._size)
+
+    def snapshot(self) -> tuple:
+        if self._values is None:
+            return self._no_values, None
+        filled = self._filled
+        return self._values[:filled].copy(), None if self._weights is None else self._weights[:filled].copy()
+
+
+class SlidingTimeWindowReservoir(Reservoir):
+    """
+    Keeps the values recorded during the last window seconds. The window is split into a ring of intervals, each holding
+    the values recorded during it, and an interval is discarded as a whole once it has left the window. At most
+    max_values_per_interval values are kept per interval, once an interval is full it keeps a uniform sample of its
+    values and tracks how many observations that sample represents so the counts and sums stay correct.
+    """
+    def __init__(self, window: float = 60, intervals: int = 12, max_values_per_interval: int = 256):
+        if window <= 0 or intervals < 1 or max_values_per_interval < 1:
+            raise ValueError("window, intervals and max_values_per_interval must all be positive")
+        self._interval_length = window / intervals
+        self._max_values = max_values_per_interval
+        self._epochs = [None] * intervals
+        self._values = [[] for _ in range(intervals)]
+        self._weights = [[] for _ in range(intervals)]
+        self._observed = [0] * intervals
+
+    def update(self, value: float, weight: int = 1) -> None:
+        epoch = int(monotonic() // self._interval_length)
+        index = epoch % len(self._epochs)
+        if self._epochs[index] != epoch:
+            self._epochs[index] = epoch
+            self._values[index] = []
+            self._weights[index] = []
+            self._observed[index] = 0
+        values = self._values[index]
+        self._observed[index] += 1
+        if len(values) < self._max_values:
+            values.append(value)
+            self._weights[index].append(weight)
+        else:
+            replace = randrange(self._observed[index])
+            if replace < self._max_values:
+                values[replace] = value
+                self._weights[index][replace] = weight
+
+    def snapshot(self) -> tuple:
+        oldest_epoch = int(monotonic() // self._interval_length) - len(self._epochs) + 1
+        values = []
+        weights = []
+        for index, epoch in enumerate(self._epochs):
+            if epoch is None or epoch < oldest_epoch:
+                continue
+            # Once an interval has been sampled every kept value also stands for the observations that were dropped.
+            scale = self._observed[index] / len(self._values[index])
+            values += self._values[index]
+            weights += [weight * scale for weight in self._weights[index]]
+        return values, weights
+
+
+class ExponentiallyDecayingReservoir(Reservoir):
+    """
+    Keeps a sample of size values that is biased towards recent values using forward decay. Every value is given a
+    weight that grows exponentially with the time it was recorded at, and a priority of its weight divided by a random
+    number. Only the values with the highest priorities are kept in a min-heap, so recording is O(log size). The
+    percentiles are weighted by the decay weights, giving recent values more influence. With the default alpha of 0.015
+    the sample mostly represents the last five minutes.
+    """
+    def __init__(self, size: int = 1028, alpha: float = 0.015, rescale_threshold: float = 3600):
+        self._size = size
+        self._alpha = alpha
+        self._rescale_threshold = rescale_threshold
+        self._landmark = monotonic()
+        self._heap = []
+        self._sequence = count()
+
+    def _rescale(self, now: float) -> None:
+        """
+        Moves the landmark of the forward decay to now. This keeps the weights from overflowing, scaling the stored
+        priorities and weights by the same factor leaves their order and ratios intact.
+
+        :param now: float: The current monotonic time
+        :return:
+        """
+        factor = exp(-self._alpha * (now - self._landmark))
+        self._heap = [(priority * factor, sequence, value, decay_weight * factor, weight)
+                      for priority, sequence, value, decay_weight, weight in self._heap]
+        self._landmark = now
+
+    def update(self, value: float, weight: int = 1) -> None:
+        now = monotonic()
+        if now - self._landmark >= self._rescale_threshold:
+            self._rescale(now)
+        decay_weight = exp(self._alpha * (now - self._landmark))
+        priority = decay_weight / (1.0 - random())
+        entry = (priority, next(self._sequence), value, decay_weight, weight)
+        if len(self._heap) < self._size:
+            heappush(self._heap, entry)
+        elif priority > self._heap[0][0]:
+            heapreplace(self._heap, entry)
+
+    def snapshot(self) -> tuple:
+        heap = self._heap
+        weights = [entry[4] for entry in heap]
+        return [entry[2] for entry in heap], None if all(weight == 1 for weight in weights) else weights
+
+    def percentiles(self, percentiles: [float]) -> list:
+        heap = self._heap
+        values = asarray([entry[2] for entry in heap], dtype=float)
+        decay_weights = asarray([entry[3] for entry in heap], dtype=float)
+        order = argsort(values)
+        values = values[order]
+        cumulative = cumsum(decay_weights[order])
+        cumulative /= cumulative[-1]
+        positions = searchsorted(cumulative, asarray(percentiles, dtype=float) / 100.0)
+        return list(values[positions.clip(0, len(values) - 1)])
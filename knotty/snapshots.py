@@ -0,0 +1,291 @@
+"""
+This module defines the compact binary format used to take the state of a meter out of one process and merge it into a
+meter of another process, or to persist and reload it. The meters write and read their own state through the
+SnapshotWriter and SnapshotReader defined here, see BaseMeter.snapshot and BaseMeter.merge.
+
+Every snapshot starts with a magic marker and a version, followed by the meter type and the meter name. The rest of the
+snapshot is specific to the meter type, and is built from unsigned varints, numbers, strings, tag tuples and arrays.
+Every meter type ends its snapshot with the number of series it holds followed by the series, each starting with its
+metric key, which lets a snapshot that is too large be split into snapshots of ranges of its series, see
+SnapshotWriter.split.
+"""
+import struct
+from numpy import frombuffer, ascontiguousarray, dtype as numpy_dtype, float64
+
+MAGIC = b"KNS"
+BATCH_MAGIC = b"KNB"
+VERSION = 1
+
+_DOUBLE = struct.Struct("<d")
+_LONG = struct.Struct("<q")
+
+
+class SnapshotFormatException(Exception):
+    pass
+
+
+def _varint(value: int) -> bytearray:
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return encoded
+
+
+class SnapshotWriter:
+    """
+    Builds a snapshot in a single growing bytearray. The meters write the number of their series with
+    write_series_count and start every series with write_series_key, so that the writer knows where the series start.
+    """
+    def __init__(self, meter_type: str, name: str):
+        self._buffer = bytearray(MAGIC)
+        self._buffer.append(VERSION)
+        self._series_count_offset = None
+        self._series_offsets = []
+        self.write_str(meter_type)
+        self.write_str(name)
+
+    def getvalue(self) -> bytes:
+        return bytes(self._buffer)
+
+    def write_series_count(self, count: int) -> None:
+        """
+        Writes the number of series that follow, which ends the part of the snapshot that is not specific to a series.
+
+        :param count: int
+        :return:
+        """
+        self._series_count_offset = len(self._buffer)
+        self.write_varint(count)
+
+    def write_series_key(self, tags: tuple) -> None:
+        """
+        Starts a series by writing its metric key, see write_tags.
+
+        :param tags: tuple of (str, value) pairs
+        :return:
+        """
+        self._series_offsets.append(len(self._buffer))
+        self.write_tags(tags)
+
+    def split(self, max_size: int) -> [bytes]:
+        """
+        Splits the snapshot into snapshots of at most max_size bytes that each hold a range of the series, and repeat
+        everything that comes before the series. Merging all of them has the same effect as merging the whole snapshot.
+        A single series that is larger than max_size can not be split and is returned in a snapshot of its own, which
+        the caller can tell by its size.
+
+        :param max_size: int: The size in bytes the snapshots should not exceed
+        :return: [bytes]
+        """
+        if len(self._buffer) <= max_size or self._series_count_offset is None or not self._series_offsets:
+            return [self.getvalue()]
+        prefix = self._buffer[:self._series_count_offset]
+        offsets = self._series_offsets + [len(self._buffer)]
+        chunks = []
+        first = 0
+        while first < len(offsets) - 1:
+            last = first + 1
+            # The series count of a chunk takes at most 5 bytes.
+            while last < len(offsets) - 1 and len(prefix) + 5 + offsets[last + 1] - offsets[first] <= max_size:
+                last += 1
+            chunks.append(bytes(prefix + _varint(last - first) + self._buffer[offsets[first]:offsets[last]]))
+            first = last
+        return chunks
+
+    def write_varint(self, value: int) -> None:
+        """
+        Writes a non negative integer using 7 bits per byte.
+
+        :param value: int
+        :return:
+        """
+        if value < 0:
+            raise ValueError("Varints must not be negative, received {0}".format(value))
+        buffer = self._buffer
+        while value > 0x7f:
+            buffer.append((value & 0x7f) | 0x80)
+            value >>= 7
+        buffer.append(value)
+
+    def write_str(self, value: str) -> None:
+        encoded = value.encode("utf-8")
+        self.write_varint(len(encoded))
+        self._buffer += encoded
+
+    def write_number(self, value) -> None:
+        """
+        Writes an int or a float, keeping track of which of the two it was.
+
+        :param value: int or float
+        :return:
+        """
+        if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+            self._buffer += b"i" + _LONG.pack(value)
+        else:
+            self._buffer += b"f" + _DOUBLE.pack(float(value))
+
+    def write_optional_number(self, value) -> None:
+        if value is None:
+            self._buffer += b"n"
+        else:
+            self.write_number(value)
+
+    def write_tags(self, tags: tuple) -> None:
+        """
+        Writes a metric key, keeping the type of every tag value.
+
+        :param tags: tuple of (str, value) pairs
+        :return:
+        """
+        self.write_varint(len(tags))
+        for key, value in tags:
+            self.write_str(str(key))
+            if isinstance(value, str):
+                self._buffer += b"s"
+                self.write_str(value)
+            elif isinstance(value, bool) or value is None:
+                self._buffer += {True: b"T", False: b"F", None: b"N"}[value]
+            elif isinstance(value, (int, float)):
+                self.write_number(value)
+            else:
+                self._buffer += b"s"
+                self.write_str(str(value))
+
+    def write_array(self, values, dtype=float64) -> None:
+        """
+        Writes a sequence of numbers as a packed little endian array.
+
+        :param values: A list or NumPy array
+        :param dtype: The NumPy dtype to store the values as, either float64 or int64
+        :return:
+        """
+        data = ascontiguousarray(values, dtype=numpy_dtype(dtype).newbyteorder("<"))
+        self.write_varint(len(data))
+        self._buffer += data.tobytes()
+
+
+class SnapshotReader:
+    """
+    Reads a snapshot written by a SnapshotWriter. The header is read on creation, exposing the meter type and name.
+    """
+    def __init__(self, data: bytes):
+        self._data = memoryview(data)
+        if bytes(self._data[:len(MAGIC)]) != MAGIC:
+            raise SnapshotFormatException("Data is not a knotty snapshot")
+        version = self._data[len(MAGIC)]
+        if version != VERSION:
+            raise SnapshotFormatException("Unsupported snapshot version {0}".format(version))
+        self._position = len(MAGIC) + 1
+        self.meter_type = self.read_str()
+        self.name = self.read_str()
+
+    def _take(self, length: int) -> memoryview:
+        end = self._position + length
+        if end > len(self._data):
+            raise SnapshotFormatException("Snapshot is truncated")
+        chunk = self._data[self._position:end]
+        self._position = end
+        return chunk
+
+    def read_varint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            byte = self._take(1)[0]
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def read_str(self) -> str:
+        return str(self._take(self.read_varint()), "utf-8")
+
+    def read_number(self):
+        marker = bytes(self._take(1))
+        if marker == b"i":
+            return _LONG.unpack(self._take(8))[0]
+        if marker == b"f":
+            return _DOUBLE.unpack(self._take(8))[0]
+        raise SnapshotFormatException("Unknown number marker {0}".format(marker))
+
+    def read_optional_number(self):
+        if bytes(self._data[self._position:self._position + 1]) == b"n":
+            self._position += 1
+            return None
+        return self.read_number()
+
+    def read_tags(self) -> tuple:
+        tags = []
+        for _ in range(self.read_varint()):
+            key = self.read_str()
+            marker = bytes(self._data[self._position:self._position + 1])
+            if marker == b"s":
+                self._position += 1
+                value = self.read_str()
+            elif marker in (b"T", b"F", b"N"):
+                self._position += 1
+                value = {b"T": True, b"F": False, b"N": None}[marker]
+            else:
+                value = self.read_number()
+            tags.append((key, value))
+        return tuple(tags)
+
+    def read_array(self, dtype=float64):
+        length = self.read_varint()
+        return frombuffer(self._take(length * 8), dtype=numpy_dtype(dtype).newbyteorder("<")).astype(dtype)
+
+    @property
+    def exhausted(self) -> bool:
+        return self._position >= len(self._data)
+
+
+def pack_batch(snapshots: [bytes]) -> bytes:
+    """
+    Packs several snapshots into a single batch, eg to send them in a single datagram.
+
+    :param snapshots: [bytes]
+    :return: bytes
+    """
+    buffer = bytearray(BATCH_MAGIC)
+    buffer.append(VERSION)
+    for snapshot in snapshots:
+        length = len(snapshot)
+        while length > 0x7f:
+            buffer.append((length & 0x7f) | 0x80)
+            length >>= 7
+        buffer.append(length)
+        buffer += snapshot
+    return bytes(buffer)
+
+
+def unpack_batch(batch: bytes) -> [bytes]:
+    """
+    Splits a batch created by pack_batch back into its snapshots.
+
+    :param batch: bytes
+    :return: [bytes]
+    """
+    data = memoryview(batch)
+    if bytes(data[:len(BATCH_MAGIC)]) != BATCH_MAGIC:
+        raise SnapshotFormatException("Data is not a knotty snapshot batch")
+    if data[len(BATCH_MAGIC)] != VERSION:
+        raise SnapshotFormatException("Unsupported batch version {0}".format(data[len(BATCH_MAGIC)]))
+    position = len(BATCH_MAGIC) + 1
+    snapshots = []
+    while position < len(data):
+        length = 0
+        shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            length |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        if position + length > len(data):
+            raise SnapshotFormatException("Batch is truncated")
+        snapshots.append(bytes(data[position:position + length]))
+        position += length
+    return snapshots
@@ -13,5 +13,6 @@ setup(name='knotty',
       long_description=long_desc,
       url="https://github.com/kahinton/knotty",
       long_description_content_type='text/markdown',
-      python_requires='>=3.7'
+      python_requires='>=3.7',
+      entry_points={'console_scripts': ['knotty-agent=knotty.agent:main']}
       )
@@ -0,0 +1,71 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.adapters as adapters
+import knotty.registry as registry
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+import requests
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        status = 404 if self.path.startswith("/missing") else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAdapters(unittest.TestCase):
+    def test_paths_are_templated(self):
+        self.assertEqual(adapters.template_path("/users/42/orders"), "/users/{id}/orders")
+        self.assertEqual(adapters.template_path("/items/123e4567-e89b-12d3-a456-426614174000"), "/items/{uuid}")
+        self.assertEqual(adapters.template_path("/commits/9fceb02d0ae598e95dc970b74767f19372d61af8/"),
+                         "/commits/{hash}/")
+        self.assertEqual(adapters.template_path("/v2/files/aGVsbG8gd29ybGQgaGVsbG8gd29ybGQ1"), "/v2/files/{token}")
+        self.assertEqual(adapters.template_path("/api/v2/status"), "/api/v2/status")
+
+    def test_session_requests_are_timed_and_pools_collected(self):
+        registry.MeterRegistry._meters = dict()
+        server = HTTPServer(("127.0.0.1", 0), _Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        instrumentation = adapters.RequestsInstrumentation("test_http")
+        instrumentation.instrument()
+        try:
+            host = "127.0.0.1:{0}".format(server.server_port)
+            with requests.Session() as session:
+                for path in ("/users/1?page=2", "/users/2", "/missing/3"):
+                    session.get("http://{0}{1}".format(host, path))
+                self.assertRaises(requests.ConnectionError, session.get, "http://127.0.0.1:1/users/4")
+                pool_metrics = {(metric.name, metric.tags): metric.value
+                                for metric in instrumentation.pool_collector.collect()}
+        finally:
+            instrumentation.uninstrument()
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(instrumentation.timer.counter._count,
+                         {(("host", host), ("path", "/users/{id}"), ("method", "GET"), ("status_code", 200)): 2,
+                          (("host", host), ("path", "/missing/{id}"), ("method", "GET"), ("status_code", 404)): 1,
+                          (("host", "127.0.0.1:1"), ("path", "/users/{id}"), ("method", "GET"),
+                           ("status_code", "ConnectionError")): 1})
+        pool_key = (("host", host),)
+        self.assertEqual(pool_metrics[("test_http_pool_idle_connections", pool_key)], 1)
+        self.assertEqual(pool_metrics[("test_http_pool_checked_out_connections", pool_key)], 0)
+        self.assertEqual(pool_metrics[("test_http_pool_checkouts_total", pool_key)], 3)
+        self.assertEqual(pool_metrics[("test_http_pool_connections_created_total", pool_key)], 1)
+        self.assertFalse(hasattr(requests.adapters.HTTPAdapter.send, "__wrapped__"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.agent as agent
+import knotty.exporters as exporters
+import knotty.registry as registry
+import knotty.meters as meters
+import knotty.snapshots as snapshots
+from tempfile import TemporaryDirectory
+import socket
+
+
+class TestAgent(unittest.TestCase):
+    def test_agent_merges_the_deltas_flushed_by_the_agent_exporter(self):
+        with TemporaryDirectory() as directory:
+            knotty_agent = agent.KnottyAgent(socket_path=os.path.join(directory, "knotty.sock"))
+            registry.MeterRegistry._meters = dict()
+            test_counter = meters.Counter("test_counter")
+            test_counter.increment(3)
+            # The exporter flushes once when it starts, the agent merges the deltas back into this same registry.
+            exporter = exporters.AgentExporter(3600, socket_path=knotty_agent.address)
+            self.assertEqual(knotty_agent.receive(), 1)
+            self.assertEqual(test_counter._count, {(): 3})
+
+            test_counter.increment(2)
+            exporter._flush()
+            self.assertEqual(test_counter._count, {})
+            knotty_agent.receive()
+            self.assertEqual(test_counter._count, {(): 5})
+            knotty_agent.close()
+
+    def test_agent_listens_on_udp_and_skips_snapshots_it_can_not_merge(self):
+        knotty_agent = agent.KnottyAgent(address=("127.0.0.1", 0))
+        registry.MeterRegistry._meters = dict()
+        test_meter = meters.Meter("test_meter")
+        test_meter.mark(4)
+        batch = snapshots.pack_batch([snapshots.SnapshotWriter("Unknown", "test_unknown").getvalue(),
+                                      test_meter.drain()])
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM).sendto(batch, knotty_agent.address)
+        self.assertEqual(knotty_agent.receive(), 1)
+        self.assertEqual(test_meter._rates[()].count, 4)
+        knotty_agent.close()
+
+    def test_agent_exporter_splits_snapshots_that_are_too_large_and_drops_single_series(self):
+        knotty_agent = agent.KnottyAgent(address=("127.0.0.1", 0))
+        knotty_agent._socket.settimeout(5)
+        knotty_agent._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        registry.MeterRegistry._meters = dict()
+        large = meters.Counter("test_large")
+        large.increment_many({(("series", "{0:040d}".format(index)),): 1 for index in range(2500)})
+        huge = meters.Counter("test_huge")
+        huge.increment(1, (("series", "x" * 70000),))
+        with self.assertLogs("knotty.exporters", "ERROR") as logs:
+            exporters.AgentExporter(3600, address=knotty_agent.address)
+            datagrams = 0
+            while not datagrams or sum(large._count.values()) < 2500:
+                knotty_agent.receive()
+                datagrams += 1
+        self.assertGreater(datagrams, 2)
+        self.assertIn("too large", logs.output[0])
+        self.assertEqual((sum(large._count.values()), huge._count), (2500, {}))
+        dropped_snapshots = registry.MeterRegistry.get_meter("knotty_agent_exporter_dropped_snapshots", meters.Counter)
+        self.assertEqual(dropped_snapshots._count, {(("meter", "test_huge"),): 1})
+        knotty_agent.close()
+
+    def test_agent_exporter_splits_datagrams_the_socket_does_not_take(self):
+        knotty_agent = agent.KnottyAgent(address=("127.0.0.1", 0))
+        knotty_agent._socket.settimeout(5)
+        registry.MeterRegistry._meters = dict()
+        too_large = meters.Counter("test_too_large")
+        too_large.increment_many({(("series", "{0:040d}".format(index)),): 1 for index in range(2000)})
+        first = meters.Counter("test_first")
+        first.increment_many({(("series", "{0:040d}".format(index)),): 1 for index in range(700)})
+        second = meters.Counter("test_second")
+        second.increment_many({(("series", "{0:040d}".format(index)),): 2 for index in range(700)})
+        exporter = exporters.AgentExporter(3600, address=knotty_agent.address, max_datagram_size=1 << 20)
+        self.assertEqual((knotty_agent.receive(), knotty_agent.receive()), (1, 1))
+        self.assertEqual((sum(first._count.values()), sum(second._count.values())), (700, 1400))
+        # The snapshot that was too large on its own went back into its meter, and is sent in smaller datagrams.
+        self.assertLess(exporter._max_datagram_size, 1 << 19)
+        self.assertEqual(sum(too_large._count.values()), 2000)
+        exporter._flush()
+        while sum(too_large._count.values()) < 2000:
+            knotty_agent.receive()
+        knotty_agent.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
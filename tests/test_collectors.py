@@ -0,0 +1,88 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.collectors as collectors
+import knotty.registry as registry
+import knotty.meters as meters
+import asyncio
+import gc
+from threading import Thread
+
+
+class TestCollectors(unittest.TestCase):
+    def setUp(self) -> None:
+        registry.MeterRegistry._meters = dict()
+
+    def test_collector_turns_one_measurement_into_many_metrics(self):
+        measurements = []
+
+        class QueueCollector(collectors.Collector):
+            def collect(self):
+                measurements.append(1)
+                key = self._base_key()
+                return [meters.Metric("queue_depth", key, 3, "gauge"),
+                        meters.Metric("queue_consumers", key, 2, "gauge")]
+
+        QueueCollector("queue").add_tags({"queue": "jobs"})
+        actual = registry.MeterRegistry.get_all_metrics()
+        self.assertEqual(actual, [meters.Metric("queue_depth", (("queue", "jobs"),), 3, "gauge"),
+                                  meters.Metric("queue_consumers", (("queue", "jobs"),), 2, "gauge")])
+        self.assertEqual(measurements, [1])
+        self.assertEqual([metric.name for metric in registry.MeterRegistry.get_all_metrics(names=["queue_c"])],
+                         ["queue_consumers"])
+
+    def test_failing_collector_returns_no_metrics(self):
+        class BrokenCollector(collectors.Collector):
+            def collect(self):
+                raise OSError("gone")
+
+        loop = asyncio.get_event_loop()
+        self.assertEqual(loop.run_until_complete(BrokenCollector("broken").get_metrics()), [])
+
+    def test_disk_space_collector_reports_total_and_used_per_mount_point(self):
+        metrics = collectors.DiskSpaceCollector().collect()
+        totals = {dict(metric.tags)["mount_point"] for metric in metrics if metric.name == "disk_space_total"}
+        used = {dict(metric.tags)["mount_point"] for metric in metrics if metric.name == "disk_space_used"}
+        self.assertEqual(totals, used)
+
+    def test_runtime_collector_records_gc_pauses_and_counts(self):
+        runtime = collectors.RuntimeCollector()
+        try:
+            gc.collect(1)
+        finally:
+            runtime.stop()
+        self.assertNotIn(runtime._gc_callback, gc.callbacks)
+        # Stopping records the buffered pauses.
+        self.assertEqual(runtime.pause_histogram._total_count[(("generation", 1),)], 1)
+        names = [metric.name for metric in runtime.collect()]
+        self.assertEqual(names[:4], ["python_gc_collections_total", "python_gc_objects_collected_total",
+                                     "python_gc_objects_uncollectable_total", "python_gc_objects_tracked"])
+        self.assertEqual(len(names), 13)
+        self.assertEqual(names[-1], "python_allocated_blocks")
+
+    def test_runtime_collector_pauses_can_be_drained_while_collections_run(self):
+        runtime = collectors.RuntimeCollector()
+        threshold = gc.get_threshold()
+        drained = []
+        gc.set_threshold(1)
+        try:
+            drainer = Thread(target=lambda: drained.extend(runtime.pause_histogram.drain() for _ in range(100)),
+                             daemon=True)
+            drainer.start()
+            drainer.join(timeout=10)
+            self.assertFalse(drainer.is_alive())
+            gc.collect(0)
+            self.assertEqual(len(drained), 100)
+            runtime.collect()
+            self.assertGreater(sum(runtime.pause_histogram._total_count.values()), 0)
+        finally:
+            gc.set_threshold(*threshold)
+            runtime.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
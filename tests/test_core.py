@@ -8,7 +8,10 @@ if lib_dir not in sys.path:
 import knotty.core as core
 import knotty.registry as registry
 import knotty.meters as meters
+import knotty.collectors as collectors
+import knotty.adapters as adapters
 import logging
+import subprocess
 import flask
 import requests
 
@@ -20,22 +23,63 @@ class TestKnotty(unittest.TestCase):
         self.assertEqual({metric.name for metric in registry.MeterRegistry.get_all_metrics()},
                          {'process_memory_percentage', 'process_open_file_count', 'disk_space_used',
                           'process_thread_count', 'process_memory_info', 'disk_space_total', 'system_cpu_percentage',
-                          'disk_io_stats', 'system_network_io_stats', 'process_cpu_percentage', 'system_memory_stats'}
+                          'disk_io_stats', 'system_network_io_stats', 'process_cpu_percentage', 'system_memory_stats',
+                          'process_collection_age_seconds', 'disk_space_collection_age_seconds'}
                          )
 
+    def test_registy_is_populated_with_expected_metrics_via_start_runtime_monitors(self):
+        registry.MeterRegistry._meters = dict()
+        core.Knotty._start_runtime_monitors()
+        self.assertEqual(list(registry.MeterRegistry._meters.keys()),
+                         [(collectors.RuntimeCollector, "python"), (meters.LatencyHistogram, "python_gc_pause")])
+        registry.MeterRegistry._meters[(collectors.RuntimeCollector, "python")].stop()
+
     def test_registy_is_populated_with_expected_metrics_via_start_std_lib_monitoring(self):
         registry.MeterRegistry._meters = dict()
         core.Knotty._start_std_lib_monitoring()
         self.assertEqual(list(registry.MeterRegistry._meters.keys()), [(meters.Counter, "logback_events_count")])
 
+    def test_log_events_are_counted_by_level_and_logger_when_emitted(self):
+        registry.MeterRegistry._meters = dict()
+        core.Knotty._start_std_lib_monitoring()
+        core.Knotty._start_std_lib_monitoring()
+        handlers = [handler for handler in logging.getLogger().handlers if isinstance(handler, core.LogEventHandler)]
+        self.assertEqual(handlers, [])
+        test_logger = logging.getLogger("test_app.module")
+        test_logger.setLevel(logging.INFO)
+        test_logger.debug("filtered out")
+        test_logger.info("counted")
+        test_logger.critical("counted")
+        test_logger.log(logging.ERROR, "counted")
+        logging_counter = registry.MeterRegistry.get_meter("logback_events_count", meters.Counter)
+        self.assertEqual({key: value for key, value in logging_counter._count.items() if ("logger", "test_app") in key},
+                         {(("level", "info"), ("logger", "test_app")): 1,
+                          (("level", "critical"), ("logger", "test_app")): 1,
+                          (("level", "error"), ("logger", "test_app")): 1})
+
+    def test_importing_knotty_leaves_logging_unconfigured(self):
+        script = "\n".join(["import logging, knotty",
+                            "assert logging.getLogger().handlers == []",
+                            "logging.getLogger('test_app').warning('last resort')",
+                            "logging.basicConfig(format='configured %(message)s')",
+                            "logging.getLogger('test_app').warning('basic config')",
+                            "print(knotty.core.counter('logback_events_count')._count)"])
+        result = subprocess.run([sys.executable, "-c", script], cwd=lib_dir, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stderr, "last resort\nconfigured basic config\n")
+        self.assertIn("(('level', 'warning'), ('logger', 'test_app')): 2", result.stdout)
+
     def test_registy_is_populated_with_expected_metrics_via_start_third_party_lib_monitors(self):
         registry.MeterRegistry._meters = dict()
         core.Knotty._start_third_party_lib_monitors()
         self.assertEqual(list(registry.MeterRegistry._meters.keys()),
                          [(meters.Counter, "requests_http_time_count"),
                           (meters.Timer, "requests_http"),
+                          (adapters.ConnectionPoolCollector, "requests_http_pool"),
                           (meters.Counter, "flask_http_request_time_count"),
-                          (meters.Timer, "flask_http_request")])
+                          (meters.Timer, "flask_http_request"),
+                          (meters.Counter, "flask_http_request_headers_time_count"),
+                          (meters.Timer, "flask_http_request_headers")])
 
     def test_timer_returns_timer_as_expected(self):
         test_timer = core.timer("test_timer")
@@ -53,6 +97,14 @@ class TestKnotty(unittest.TestCase):
         test_histogram = core.histogram("test_histogram")
         self.assertTrue(isinstance(test_histogram, meters.Histogram))
 
+    def test_meter_returns_meter_as_expected(self):
+        test_meter = core.meter("test_meter")
+        self.assertTrue(isinstance(test_meter, meters.Meter))
+
+    def test_latency_histogram_returns_latency_histogram_as_expected(self):
+        test_histogram = core.latency_histogram("test_latency_histogram")
+        self.assertTrue(isinstance(test_histogram, meters.LatencyHistogram))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -9,6 +9,12 @@ import knotty.registry as registry
 import knotty.exporters as exporters
 import knotty.meters as meters
 from time import sleep
+import json
+from urllib.parse import parse_qs
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from threading import Thread
+from unittest import mock
 
 
 class DependableTimer(meters.Timer):
@@ -60,6 +66,75 @@ class TestExporters(unittest.TestCase):
         expected = "#TYPE test_histogram histogram test_histogram_sum{} 4950 test_histogram_count{} 100 test_histogram_bucket{le=\"49.5\"} 50 test_histogram_bucket{le=\"99.0\"} 50 #TYPE test_histogram_percentile gauge test_histogram_percentile{percentile=\"50\"} 49.5 #TYPE test_timer_time summary test_timer_time_count{} 1 test_timer_time_sum{} 1 #TYPE test_gauge gauge test_gauge{} 1 "
         self.assertEqual(any_prometheus._metrics_translator().replace("\n", " "), expected)
 
+    def test__PrometheusStarter_metrics_can_be_filtered(self):
+        any_prometheus = exporters._PrometheusStarter()
+        names, tags = any_prometheus._filters_from_query(parse_qs("name[]=test_gauge&name[]=test_timer_time_sum"))
+        self.assertEqual((names, tags), (["test_gauge", "test_timer_time_sum"], None))
+        expected = "#TYPE test_timer_time summary test_timer_time_sum{} 1 #TYPE test_gauge gauge test_gauge{} 1 "
+        self.assertEqual(any_prometheus._metrics_translator(names, tags).replace("\n", " "), expected)
+        self.assertEqual(any_prometheus._filters_from_query(parse_qs("tag[]=pid:12&tag[]=path")),
+                         (None, {"pid": "12", "path": None}))
+
+    def test__PrometheusStarter_exposition_is_written_in_bounded_chunks(self):
+        any_prometheus = exporters._PrometheusStarter()
+        chunks = [bytes(chunk) for chunk in any_prometheus._exposition_chunks(chunk_size=128)]
+        self.assertTrue(all(len(chunk) <= 128 for chunk in chunks))
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(b"".join(chunks).decode("ascii"), any_prometheus._metrics_translator())
+
+    def test__PrometheusStarter_drops_families_that_come_back_in_a_later_batch(self):
+        any_prometheus = exporters._PrometheusStarter()
+        batches = [[meters.MetricBatch("test_family", "gauge", [()], [1])],
+                   [meters.MetricBatch("test_later", "gauge", [()], [2]),
+                    meters.MetricBatch("test_family", "gauge", [(("pid", 1),)], [3])]]
+        with mock.patch.object(registry.MeterRegistry, "iter_metric_batches", return_value=iter(batches)), \
+                self.assertLogs(exporters.__name__, "WARNING") as logs:
+            exposition = any_prometheus._metrics_translator()
+        self.assertEqual(exposition.replace("\n", " "),
+                         "#TYPE test_family gauge test_family{} 1 #TYPE test_later gauge test_later{} 2 ")
+        self.assertIn("Dropping 1 samples of test_family", logs.output[0])
+
+    def test_PrometheusExporter_streams_metrics_with_chunked_encoding(self):
+        handler = type("handler", (exporters.PrometheusExporter._PrometheusHandler,), {"metrics_path": "/metrics"})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            connection = HTTPConnection("127.0.0.1", server.server_port)
+            connection.request("GET", "/metrics?name[]=test_gauge")
+            response = connection.getresponse()
+            self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+            self.assertEqual(response.read().decode("ascii"), "#TYPE test_gauge gauge\ntest_gauge{} 1\n")
+            connection.request("GET", "/missing")
+            self.assertEqual(connection.getresponse().status, 404)
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_PrometheusExporter_adds_its_endpoints_to_a_flask_app(self):
+        from flask import Flask
+        app = Flask(__name__)
+        exporter = exporters.PrometheusExporter(flask_app=app)
+        exporter._thread.join(timeout=5)
+        client = app.test_client()
+        response = client.get("/metrics?name[]=test_gauge")
+        self.assertEqual((response.status_code, response.get_data(as_text=True)),
+                         (200, "#TYPE test_gauge gauge\ntest_gauge{} 1\n"))
+        response = client.get("/debug/slow_calls")
+        self.assertEqual((response.status_code, response.content_type), (200, "application/json"))
+
+    def test__PrometheusStarter_slow_calls_are_formatted_correctly(self):
+        any_prometheus = exporters._PrometheusStarter()
+        test_timer = registry.MeterRegistry.get_meter("test_timer", DependableTimer)
+        test_timer.enable_slow_call_capture(max_calls=2)
+        test_timer._capture_slow_call((("path", "/slow"),), 2000000000, (), {})
+        actual = json.loads(any_prometheus._slow_calls_translator())
+        test_timer.disable_slow_call_capture()
+        self.assertEqual(len(actual), 1)
+        self.assertEqual(actual[0]["timer"], "test_timer")
+        self.assertEqual(actual[0]["duration"], 2)
+        self.assertEqual(actual[0]["tags"], {"path": "/slow"})
+
     def test__InfluxDB_metrics_are_formatted_correctly(self):
         class FakeInflux:
             host = "http://localhost"
@@ -0,0 +1,66 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.loops as loops
+import knotty.registry as registry
+import asyncio
+import time
+
+
+class TestLoops(unittest.TestCase):
+    def test_loop_monitor_measures_lag_tasks_and_slow_callbacks(self):
+        registry.MeterRegistry._meters = dict()
+        loop = asyncio.new_event_loop()
+        monitor = loops.LoopMonitor("test_loop")
+        monitor.attach(loop, interval=.01, slow_callback_threshold=.02)
+
+        async def blocking_work():
+            time.sleep(.15)
+
+        pending_tasks = []
+
+        async def application():
+            await asyncio.sleep(.05)
+            pending_tasks.append(monitor.collect()[0].value)
+            await asyncio.gather(blocking_work(), asyncio.sleep(.01))
+            await asyncio.sleep(.05)
+
+        loop.run_until_complete(application())
+        monitor.detach()
+        loop.close()
+
+        self.assertGreater(monitor.lag_histogram._total_count[()], 5)
+        self.assertGreater(monitor.lag_histogram.get_percentiles([100])[0], .1)
+        slow_callbacks = monitor.get_slow_callbacks()
+        self.assertEqual(len(slow_callbacks), 1)
+        self.assertIn("blocking_work", slow_callbacks[0].stack)
+        metrics = {metric.name: metric.value for metric in monitor.collect()}
+        self.assertEqual(metrics["test_loop_slow_callbacks_total"], 1)
+        self.assertEqual(pending_tasks, [1])
+
+    def test_loop_monitor_attaches_to_the_running_loop_and_ignores_stopped_loops(self):
+        registry.MeterRegistry._meters = dict()
+        monitor = loops.LoopMonitor("test_loop")
+        self.assertRaises(ValueError, monitor.attach)
+        loop = asyncio.new_event_loop()
+
+        async def attach():
+            monitor.attach(interval=.01, slow_callback_threshold=.02)
+            await asyncio.sleep(.05)
+
+        loop.run_until_complete(attach())
+        self.assertIs(monitor._loop, loop)
+        # The loop is stopped but not closed, which is not a stall.
+        time.sleep(.15)
+        loop.run_until_complete(asyncio.sleep(.05))
+        monitor.detach()
+        loop.close()
+        self.assertEqual(monitor.get_slow_callbacks(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,8 +7,12 @@ if lib_dir not in sys.path:
 
 import knotty.meters as meters
 import knotty.registry as registry
+import knotty.reservoirs as reservoirs
 from time import sleep
 import asyncio
+import numpy
+from unittest import mock
+from threading import Thread
 
 
 class TestMeters(unittest.TestCase):
@@ -52,6 +56,61 @@ class TestMeters(unittest.TestCase):
         self.assertEqual(actual[0].tags, expected[0].tags)
         self.assertEqual(actual[0].prometheus_type, expected[0].prometheus_type)
 
+    def test_timers_store_integer_nanoseconds(self):
+        test_timer = meters.Timer("test_timer")
+
+        @test_timer.timer
+        def bogus_function():
+            sleep(.001)
+
+        bogus_function()
+        self.assertTrue(all(isinstance(value, int) for value in test_timer.total_time.values()))
+        self.assertGreaterEqual(test_timer.total_time[()], 1000000)
+
+    def test_timers_record_cpu_time_when_cpu_clock_set(self):
+        test_timer = meters.Timer("test_timer")
+        test_timer.set_cpu_clock("thread")
+
+        @test_timer.timer
+        def busy_function():
+            return sum(range(100000))
+
+        busy_function()
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_timer.get_metrics()))
+        self.assertEqual([metric.name for metric in actual], ["test_timer_time_sum", "test_timer_cpu_time_total"])
+        self.assertGreater(actual[1].value, 0)
+        self.assertRaises(ValueError, test_timer.set_cpu_clock, "wall")
+
+    def test_timers_keep_only_the_slowest_calls(self):
+        test_timer = meters.Timer("test_timer")
+        test_timer.enable_slow_call_capture(max_calls=3, argument_summarizer=lambda args, kwargs: args[0])
+
+        @test_timer.timer
+        def bogus_function(duration):
+            sleep(duration)
+
+        for duration in [.001, .025, .005, .02, .015]:
+            bogus_function(duration)
+
+        slowest = test_timer.get_slowest_calls()[()]
+        self.assertEqual([call.arguments for call in slowest], [.025, .02, .015])
+        self.assertTrue(slowest[0].duration >= slowest[1].duration >= slowest[2].duration)
+        self.assertEqual(len(test_timer._slow_calls[()]), 3)
+
+    def test_timers_drop_slow_calls_when_window_expires(self):
+        test_timer = meters.Timer("test_timer")
+        test_timer.enable_slow_call_capture(max_calls=3, window=.01)
+
+        @test_timer.timer
+        def bogus_function():
+            pass
+
+        bogus_function()
+        self.assertEqual(len(test_timer.get_slowest_calls()[()]), 1)
+        sleep(.02)
+        self.assertEqual(test_timer.get_slowest_calls(), {})
+
     def test_counters_wrap_functions_as_expected(self):
         test_counter = meters.Counter("test_counter")
 
@@ -65,6 +124,57 @@ class TestMeters(unittest.TestCase):
         expected = [meters.Metric(name='test_counter', tags=(), value=1, prometheus_type='counter')]
         self.assertEqual(actual, expected)
 
+    def test_sampled_timers_extrapolate_sum_and_count(self):
+        test_timer = meters.Timer("test_timer")
+        test_timer.set_sample_rate(4)
+
+        @test_timer.timer
+        def bogus_function():
+            pass
+
+        for _ in range(100):
+            bogus_function()
+        loop = asyncio.get_event_loop()
+        counts = loop.run_until_complete(loop.create_task(test_timer.counter.get_metrics()))
+        self.assertEqual(counts[0].value, 100)
+        self.assertEqual(test_timer._skipped_calls, 0)
+
+    def test_sampled_counters_keep_exact_count(self):
+        test_counter = meters.Counter("test_counter")
+        test_counter.set_sample_rate(10)
+        calls = []
+
+        @test_counter.auto_count_method
+        def bogus_function():
+            calls.append(1)
+
+        for _ in range(100):
+            bogus_function()
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_counter.get_metrics()))
+        self.assertEqual(len(calls), 100)
+        self.assertEqual(actual, [meters.Metric(name='test_counter', tags=(), value=100, prometheus_type='counter')])
+        self.assertRaises(ValueError, test_counter.set_sample_rate, 0)
+
+    def test_sampled_histograms_weight_sum_and_count(self):
+        test_histogram = meters.Histogram("test_histogram")
+        test_histogram.set_sample_rate(2)
+
+        @test_histogram.summarize_method
+        def x(f):
+            return f
+
+        for q in range(100):
+            x(q)
+
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_histogram.get_metrics()))
+        useful = [metric for metric in actual if metric.name in ["test_histogram_sum", "test_histogram_count"]]
+        self.assertEqual(sorted(test_histogram._current_values[()].snapshot()[0])[:3], [1, 3, 5])
+        self.assertEqual([metric.value for metric in useful], [5000, 100])
+        buckets = [metric.value for metric in actual if metric.name == "test_histogram_bucket"]
+        self.assertEqual(sum(buckets), 100)
+
     def test_counters_increment_as_expected(self):
         test_counter = meters.Counter("test_counter")
         test_counter.increment()
@@ -74,6 +184,37 @@ class TestMeters(unittest.TestCase):
         expected = [meters.Metric(name='test_counter', tags=(), value=2, prometheus_type='counter')]
         self.assertEqual(actual, expected)
 
+    def test_meters_report_moving_and_mean_rates(self):
+        test_meter = meters.Meter("test_meter")
+        loop = asyncio.get_event_loop()
+        with mock.patch("knotty.meters.monotonic", return_value=100.0):
+            test_meter.mark(50)
+        with mock.patch("knotty.meters.monotonic", return_value=105.0):
+            actual = loop.run_until_complete(loop.create_task(test_meter.get_metrics()))
+        self.assertEqual([(metric.name, metric.tags, metric.value) for metric in actual],
+                         [("test_meter_total", (), 50),
+                          ("test_meter_rate", (("window", "1m"),), 10.0),
+                          ("test_meter_rate", (("window", "5m"),), 10.0),
+                          ("test_meter_rate", (("window", "15m"),), 10.0),
+                          ("test_meter_mean_rate", (), 10.0)])
+        with mock.patch("knotty.meters.monotonic", return_value=165.0):
+            actual = loop.run_until_complete(loop.create_task(test_meter.get_metrics()))
+        self.assertAlmostEqual(actual[1].value, 10.0 / 2.718281828, 5)
+        self.assertAlmostEqual(actual[4].value, 50 / 65.0)
+
+    def test_meters_wrap_functions_as_expected(self):
+        test_meter = meters.Meter("test_meter")
+
+        @test_meter.auto_mark_method
+        def bogus_function():
+            pass
+
+        for _ in range(3):
+            bogus_function()
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_meter.get_metrics()))
+        self.assertEqual(actual[0], meters.Metric(name='test_meter_total', tags=(), value=3, prometheus_type='counter'))
+
     def test_gauge_when_gauge_function_returns_number(self):
         test_gauge = meters.Gauge("Test Gauge")
         test_gauge.set_gauge_function(lambda: 1)
@@ -191,6 +332,441 @@ class TestMeters(unittest.TestCase):
         acutal_percentiles = [int(metric.tags[0][1]) for metric in actual if metric.name == "test_histogram_percentile"]
         self.assertEqual(acutal_percentiles, percentiles)
 
+    def test_histogram_statistics_are_calculated_from_copied_snapshots(self):
+        test_histogram = meters.Histogram("test_histogram")
+        test_histogram.set_percentiles([50, 100])
+        test_histogram.add_values([1, 2, 3, 4])
+        reservoir_snapshots = test_histogram._reservoir_snapshots()
+        test_histogram.add_values(range(1000, 2000))
+        total, number, _, _, percentiles = test_histogram._statistics(reservoir_snapshots)[()]
+        self.assertEqual((total, number), (10, 4))
+        self.assertEqual(list(percentiles), [2.5, 4])
+
+
+    def test_histograms_use_the_reservoir_set_by_set_reservoir(self):
+        test_histogram = meters.Histogram("test_histogram")
+        test_histogram.set_reservoir(reservoirs.SlidingTimeWindowReservoir, window=10, intervals=5)
+        test_histogram.set_percentiles([50])
+        with mock.patch("knotty.reservoirs.monotonic", return_value=100.0):
+            test_histogram.add_new_value(1)
+        with mock.patch("knotty.reservoirs.monotonic", return_value=108.0):
+            test_histogram.add_new_value(3)
+        loop = asyncio.get_event_loop()
+        self.assertTrue(isinstance(test_histogram._current_values[()], reservoirs.SlidingTimeWindowReservoir))
+        with mock.patch("knotty.reservoirs.monotonic", return_value=112.0):
+            actual = loop.run_until_complete(loop.create_task(test_histogram.get_metrics()))
+        useful = [(metric.name, metric.value) for metric in actual if metric.name != "test_histogram_bucket"]
+        self.assertEqual(useful, [("test_histogram_sum", 3), ("test_histogram_count", 1),
+                                  ("test_histogram_percentile", 3)])
+        with mock.patch("knotty.reservoirs.monotonic", return_value=200.0):
+            actual = loop.run_until_complete(loop.create_task(test_histogram.get_metrics()))
+        self.assertEqual(actual, [])
+
+
+    def test_latency_histograms_calculate_percentiles_within_precision(self):
+        test_histogram = meters.LatencyHistogram("test_latency")
+        for value in range(1, 10001):
+            test_histogram.record(value * 1000)
+        for expected, actual in zip([.005, .009, .0099], test_histogram.get_percentiles([50, 90, 99])):
+            self.assertAlmostEqual(actual, expected, delta=expected / 100)
+        self.assertEqual(len(test_histogram._counts[()]), test_histogram._layout.counts_length)
+
+    def test_latency_histograms_export_cumulative_buckets(self):
+        test_histogram = meters.LatencyHistogram("test_latency")
+        test_histogram.set_buckets([.001, .01])
+        for value in [.0005, .005, .005, 20]:
+            test_histogram.add_new_value(value)
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_histogram.get_metrics()))
+        self.assertEqual([(metric.name, metric.tags, metric.value) for metric in actual],
+                         [("test_latency_bucket", (("le", "0.001"),), 1),
+                          ("test_latency_bucket", (("le", "0.01"),), 3),
+                          ("test_latency_bucket", (("le", "+Inf"),), 4),
+                          ("test_latency_sum", (), 20.0105),
+                          ("test_latency_count", (), 4)])
+
+    def test_latency_histogram_buckets_include_their_bounds(self):
+        test_histogram = meters.LatencyHistogram("test_latency")
+        test_histogram.set_buckets([.05, .1])
+        test_histogram.record_many([100000000] * 100)
+        test_histogram.add_new_value(.05)
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_histogram.get_metrics()))
+        self.assertEqual([metric.value for metric in actual if metric.name == "test_latency_bucket"], [1, 101, 101])
+
+    def test_latency_histograms_export_percentiles(self):
+        test_histogram = meters.LatencyHistogram("test_latency")
+        test_histogram.set_export_mode("percentiles")
+        test_histogram.set_percentiles([50])
+        test_histogram.add_new_value(.25)
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_histogram.get_metrics()))
+        self.assertEqual([metric.name for metric in actual],
+                         ["test_latency_sum", "test_latency_count", "test_latency_percentile"])
+        self.assertAlmostEqual(actual[2].value, .25, delta=.0025)
+        self.assertRaises(ValueError, test_histogram.set_export_mode, "sketch")
+
+    def test_timers_record_into_latency_histogram_when_enabled(self):
+        test_timer = meters.Timer("test_timer")
+        latency_histogram = test_timer.enable_latency_histogram(significant_digits=3)
+
+        @test_timer.timer
+        def bogus_function():
+            sleep(.001)
+
+        bogus_function()
+        self.assertTrue(registry.MeterRegistry.is_meter_registered(latency_histogram))
+        self.assertEqual(latency_histogram.name, "test_timer_latency")
+        self.assertEqual(latency_histogram._total_count[()], 1)
+        self.assertGreaterEqual(latency_histogram.get_percentiles([100], ())[0], .001)
+
+
+    def test_histograms_stack_full_series_with_the_same_results_as_numpy(self):
+        test_histogram = meters.Histogram("test_histogram")
+        test_histogram.set_max_data_values(50)
+        series = {(("series", "random"),): list(numpy.random.default_rng(7).normal(10, 3, 80)),
+                  (("series", "integers"),): list(range(60)),
+                  (("series", "constant"),): [4.0] * 50}
+        for key, values in series.items():
+            for value in values:
+                test_histogram.add_new_value(value, metric_key=key)
+
+        statistics = test_histogram._statistics(test_histogram._reservoir_snapshots())
+        for key, values in series.items():
+            kept = numpy.asarray(values[-50:])
+            counts, edges = numpy.histogram(kept, bins=10)
+            total, count, actual_counts, actual_edges, percentiles = statistics[key]
+            self.assertAlmostEqual(total, kept.sum())
+            self.assertEqual(count, 50)
+            self.assertEqual(list(actual_counts), list(counts))
+            numpy.testing.assert_allclose(actual_edges, edges)
+            numpy.testing.assert_allclose(percentiles, numpy.percentile(kept, [50, 75, 90, 95, 99]))
+
+
+    def test_histograms_add_values_in_bulk(self):
+        test_histogram = meters.Histogram("test_histogram")
+        test_histogram.set_max_data_values(25)
+        test_histogram.add_values(numpy.arange(10), tags={"source": "batch"})
+        test_histogram.add_values(list(range(10, 100)), tags={"source": "batch"})
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_histogram.get_metrics()))
+        useful = [metric for metric in actual if metric.name in ["test_histogram_sum", "test_histogram_count"]]
+        expected = [meters.Metric(name='test_histogram_sum', tags=(("source", "batch"),), value=2175,
+                                  prometheus_type='histogram'),
+                    meters.Metric(name='test_histogram_count', tags=(("source", "batch"),), value=25,
+                                  prometheus_type='histogram')]
+        self.assertEqual(useful, expected)
+
+    def test_counters_increment_many_series_at_once(self):
+        test_counter = meters.Counter("test_counter")
+        test_counter.increment_many({(("status", "200"),): 5, (("status", "500"),): 1, None: 2})
+        test_counter.increment_many({(("status", "200"),): 5})
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(test_counter.get_metrics()))
+        self.assertEqual([(metric.tags, metric.value) for metric in actual],
+                         [((("status", "200"),), 10), ((("status", "500"),), 1), ((), 2)])
+
+    def test_timers_record_many_durations(self):
+        test_timer = meters.Timer("test_timer")
+        latency_histogram = test_timer.enable_latency_histogram()
+        test_timer.enable_slow_call_capture(max_calls=2, argument_summarizer=lambda args, kwargs: args[0])
+        test_timer.record_many(numpy.array([.001, .003, .002]), tags={"job": "batch"})
+        key = (("job", "batch"),)
+        self.assertEqual(test_timer.total_time[key], 6000000)
+        self.assertEqual(test_timer.counter._count[key], 3)
+        self.assertEqual(latency_histogram._total_count[key], 3)
+        self.assertEqual([(call.duration, call.arguments) for call in test_timer.get_slowest_calls()[key]],
+                         [(.003, None), (.002, None)])
+
+    def test_latency_histograms_record_many_matches_record(self):
+        single = meters.LatencyHistogram("test_single")
+        bulk = meters.LatencyHistogram("test_bulk")
+        values = numpy.random.default_rng(3).integers(0, 10 ** 11, 2000)
+        for value in values:
+            single.record(int(value))
+        bulk.record_many(values)
+        self.assertEqual(list(single._counts[()]), list(bulk._counts[()]))
+        self.assertEqual(single._total_sum[()], bulk._total_sum[()])
+
+
+    def test_counter_snapshots_merge_by_adding(self):
+        test_counter = meters.Counter("test_counter")
+        test_counter.increment_many({(("pid", 1),): 3, (): 2})
+        snapshot = test_counter.snapshot()
+        registry.MeterRegistry._meters = dict()
+        other_counter = meters.Counter("test_counter")
+        other_counter.increment(5)
+        other_counter.merge(snapshot)
+        self.assertEqual(other_counter._count, {(): 7, (("pid", 1),): 3})
+        self.assertRaises(ValueError, meters.Gauge("test_gauge").merge, snapshot)
+
+    def test_timer_snapshots_merge_time_and_count(self):
+        test_timer = meters.Timer("test_timer")
+        test_timer.record_many([.5, .25])
+        snapshot = test_timer.snapshot()
+        registry.MeterRegistry._meters = dict()
+        other_timer = meters.Timer("test_timer")
+        other_timer.record_many([.25])
+        other_timer.merge(snapshot)
+        self.assertEqual(other_timer.total_time[()], 1000000000)
+        self.assertEqual(other_timer.counter._count[()], 3)
+
+    def test_histogram_snapshots_merge_values(self):
+        test_histogram = meters.Histogram("test_histogram")
+        test_histogram.add_values(range(50), tags={"source": "a"})
+        test_histogram.add_new_value(10, weight=4)
+        snapshot = test_histogram.snapshot()
+        registry.MeterRegistry._meters = dict()
+        other_histogram = meters.Histogram("test_histogram")
+        other_histogram.add_values(range(50, 100), tags={"source": "a"})
+        other_histogram.merge(snapshot)
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(other_histogram.get_metrics()))
+        useful = [(metric.name, metric.tags, metric.value) for metric in actual
+                  if metric.name in ["test_histogram_sum", "test_histogram_count"]]
+        self.assertEqual(useful, [("test_histogram_sum", (("source", "a"),), 4950),
+                                  ("test_histogram_sum", (), 40),
+                                  ("test_histogram_count", (("source", "a"),), 100),
+                                  ("test_histogram_count", (), 4)])
+
+    def test_histogram_snapshots_merge_counts_and_sums_of_full_series(self):
+        test_histogram = meters.Histogram("test_histogram")
+        test_histogram.add_values(range(1000))
+        snapshot = test_histogram.snapshot()
+        self.assertLess(len(snapshot), 4000)
+        registry.MeterRegistry._meters = dict()
+        other_histogram = meters.Histogram("test_histogram")
+        other_histogram.set_percentiles([50])
+        other_histogram.add_values(range(1000, 2000))
+        other_histogram.merge(snapshot)
+        other_histogram.merge(snapshot)
+        loop = asyncio.get_event_loop()
+        actual = {metric.name: metric.value for metric in loop.run_until_complete(other_histogram.get_metrics())}
+        self.assertEqual((actual["test_histogram_sum"], actual["test_histogram_count"]), (2498500, 3000))
+        self.assertAlmostEqual(actual["test_histogram_percentile"], 750, delta=20)
+        drained = other_histogram.drain()
+        self.assertEqual(other_histogram.series_keys(), set())
+        registry.MeterRegistry._meters = dict()
+        agent_histogram = meters.Histogram("test_histogram")
+        agent_histogram.merge(drained)
+        self.assertEqual(agent_histogram._merged[()][:2], [3000, 2498500.0])
+        self.assertEqual(len(agent_histogram._merged[()][2]), agent_histogram.sketch_size)
+
+    def test_latency_histogram_snapshots_merge_buckets(self):
+        test_histogram = meters.LatencyHistogram("test_latency")
+        test_histogram.record_many(numpy.arange(1, 1001) * 1000)
+        snapshot = test_histogram.snapshot()
+        registry.MeterRegistry._meters = dict()
+        same_precision = meters.LatencyHistogram("test_latency")
+        same_precision.record_many(numpy.arange(1001, 2001) * 1000)
+        same_precision.merge(snapshot)
+        self.assertEqual(same_precision._total_count[()], 2000)
+        self.assertEqual(same_precision._total_sum[()], sum(range(1, 2001)) * 1000)
+        self.assertAlmostEqual(same_precision.get_percentiles([50])[0], .001, delta=.00001)
+
+        registry.MeterRegistry._meters = dict()
+        other_precision = meters.LatencyHistogram("test_latency")
+        other_precision.set_precision(significant_digits=3)
+        other_precision.merge(snapshot)
+        self.assertEqual(sum(other_precision._counts[()]), 1000)
+        self.assertAlmostEqual(other_precision.get_percentiles([50])[0], .0005, delta=.00001)
+
+    def test_meter_snapshots_merge_counts_and_rates(self):
+        test_meter = meters.Meter("test_meter")
+        with mock.patch("knotty.meters.monotonic", return_value=100.0):
+            test_meter.mark(50)
+        with mock.patch("knotty.meters.monotonic", return_value=105.0):
+            snapshot = test_meter.snapshot()
+            registry.MeterRegistry._meters = dict()
+            other_meter = meters.Meter("test_meter")
+            other_meter.mark(10)
+        with mock.patch("knotty.meters.monotonic", return_value=110.0):
+            other_meter.merge(snapshot)
+        series = other_meter._rates[()]
+        self.assertEqual(series.count, 60)
+        self.assertAlmostEqual(series.rates[0], 12.0)
+
+    def test_gauge_snapshots_merge_latest_values(self):
+        test_gauge = meters.Gauge("test_gauge")
+        test_gauge.set_gauge_function(lambda: {"a": 1, "b": 2}, key_tag="key")
+        snapshot = test_gauge.snapshot()
+        registry.MeterRegistry._meters = dict()
+        other_gauge = meters.Gauge("test_gauge")
+        other_gauge.merge(snapshot)
+        loop = asyncio.get_event_loop()
+        actual = loop.run_until_complete(loop.create_task(other_gauge.get_metrics()))
+        self.assertEqual(actual, [meters.Metric("test_gauge", (("key", "a"),), 1, "gauge"),
+                                  meters.Metric("test_gauge", (("key", "b"),), 2, "gauge")])
+
+    def test_merged_gauge_values_expire(self):
+        test_gauge = meters.Gauge("test_gauge")
+        test_gauge.set_gauge_function(lambda: 1)
+        snapshot = test_gauge.snapshot()
+        registry.MeterRegistry._meters = dict()
+        other_gauge = meters.Gauge("test_gauge")
+        other_gauge.set_merged_value_ttl(60)
+        with mock.patch("knotty.meters.monotonic", return_value=100.0):
+            other_gauge.merge(snapshot)
+        loop = asyncio.get_event_loop()
+        with mock.patch("knotty.meters.monotonic", return_value=160.0):
+            self.assertEqual(len(loop.run_until_complete(other_gauge.get_metrics())), 1)
+        with mock.patch("knotty.meters.monotonic", return_value=160.5):
+            self.assertEqual(loop.run_until_complete(other_gauge.get_metrics()), [])
+        self.assertEqual(other_gauge._merged_values, {})
+
+    def test_drained_snapshots_add_up_to_the_full_state(self):
+        test_timer = meters.Timer("test_timer")
+        test_timer.record_many([.5])
+        first = test_timer.drain()
+        self.assertEqual((test_timer.total_time, test_timer.counter._count), ({}, {}))
+        test_timer.record_many([.25, .25])
+        second = test_timer.drain()
+        registry.MeterRegistry._meters = dict()
+        other_timer = meters.Timer("test_timer")
+        other_timer.merge(first)
+        other_timer.merge(second)
+        self.assertEqual(other_timer.total_time[()], 1000000000)
+        self.assertEqual(other_timer.counter._count[()], 3)
+
+        test_meter = meters.Meter("test_meter")
+        with mock.patch("knotty.meters.monotonic", return_value=100.0):
+            test_meter.mark(50)
+            drained = test_meter.drain()
+            other_meter = meters.Meter("other_meter")
+            other_meter.merge(drained)
+        with mock.patch("knotty.meters.monotonic", return_value=105.0):
+            other_meter._rates[()].tick(105.0)
+        self.assertEqual(test_meter._rates, {})
+        self.assertEqual(other_meter._rates[()].count, 50)
+        self.assertAlmostEqual(other_meter._rates[()].rates[0], 10.0)
+
+    def test_drains_do_not_lose_concurrent_recordings(self):
+        test_counter = meters.Counter("test_counter")
+        threads = [Thread(target=lambda: [test_counter.increment() for _ in range(20000)]) for _ in range(4)]
+        drained = []
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            drained.append(test_counter.drain())
+        drained.append(test_counter.drain())
+        registry.MeterRegistry._meters = dict()
+        other_counter = meters.Counter("test_counter")
+        for snapshot in drained:
+            other_counter.merge(snapshot)
+        self.assertEqual(other_counter._count, {(): 80000})
+
+    def test_collection_interval_serves_cached_metrics_until_due(self):
+        calls = []
+        test_gauge = meters.Gauge("test_gauge")
+        test_gauge.set_gauge_function(lambda: len(calls.append(1) or calls))
+        test_gauge.set_collection_interval(30)
+        loop = asyncio.get_event_loop()
+        with mock.patch("knotty.meters.monotonic", return_value=100.0):
+            first = loop.run_until_complete(test_gauge.collect_metrics())
+        with mock.patch("knotty.meters.monotonic", return_value=120.0):
+            second = loop.run_until_complete(test_gauge.collect_metrics())
+            self.assertEqual(registry.MeterRegistry.get_collection_ages(), {(meters.Gauge, "test_gauge"): 20.0})
+        with mock.patch("knotty.meters.monotonic", return_value=130.0):
+            third = loop.run_until_complete(test_gauge.collect_metrics())
+            self.assertEqual(test_gauge.collection_age, 0)
+        self.assertEqual([first[0].value, second[0].value, third[0].value], [1, 1, 2])
+        self.assertEqual([(metric.name, metric.value, metric.prometheus_type)
+                          for metric in (first[1], second[1], third[1])],
+                         [("test_gauge_collection_age_seconds", age, "gauge") for age in (0.0, 20.0, 0.0)])
+
+    def test_meters_collect_columnar_batches(self):
+        test_counter = meters.Counter("test_counter")
+        test_counter.increment_many({(("code", "200"),): 3, (("code", "500"),): 1})
+        test_timer = meters.Timer("test_timer")
+        test_timer.record_many([.5, .25], tags={"job": "a"})
+        loop = asyncio.get_event_loop()
+        counter_batch, = loop.run_until_complete(test_counter.collect_batches())
+        self.assertEqual((counter_batch.name, counter_batch.prometheus_type, len(counter_batch)),
+                         ("test_counter", "counter", 2))
+        self.assertEqual(counter_batch.values.typecode, "q")
+        self.assertIs(counter_batch.keys[0], next(iter(test_counter._count)))
+        timer_batch, = loop.run_until_complete(test_timer.collect_batches())
+        self.assertEqual((timer_batch.values.typecode, list(timer_batch.values)), ("d", [.75]))
+        self.assertEqual(loop.run_until_complete(test_counter.get_metrics()), counter_batch.metrics())
+
+        class ListedMeter(meters.Counter):
+            async def get_metrics(self):
+                return [meters.Metric("listed", (), 1, "gauge"), meters.Metric("listed", (("a", "b"),), 2.5, "gauge")]
+
+        listed_batch, = loop.run_until_complete(ListedMeter("listed").collect_batches())
+        self.assertEqual((listed_batch.name, listed_batch.keys, list(listed_batch.values)),
+                         ("listed", [(), (("a", "b"),)], [1, 2.5]))
+        self.assertIsInstance(listed_batch.values, list)
+
+    def test_series_are_interned_and_stored_by_id(self):
+        key = (("route", "/users"), ("method", "GET"))
+        series_id = meters.TagSets.intern(key)
+        self.assertEqual(meters.TagSets.intern((("route", "/users"), ("method", "GET"))), series_id)
+        self.assertIs(meters.TagSets.key_of(series_id), key)
+        test_timer = meters.Timer("test_timer")
+        test_timer._record((("route", "/users"), ("method", "GET")), 1000)
+        test_timer.counter.increment(2, key)
+        # The Timer and its Counter keep their values in the columns of a single table.
+        self.assertIs(test_timer.counter._series, test_timer._series)
+        self.assertEqual(list(test_timer._series.ids), [series_id])
+        self.assertEqual((test_timer.total_time, test_timer.counter._count), ({key: 1000}, {key: 3}))
+        self.assertIs(next(iter(test_timer.total_time)), key)
+
+        test_counter = meters.Counter("test_counter")
+        test_counter.increment()
+        test_counter.add_tags({"region": "eu"})
+        test_counter.increment(.5)
+        self.assertEqual(test_counter._count, {(): 1, (("region", "eu"),): .5})
+        self.assertEqual([type(value) for value in test_counter._count.values()], [int, float])
+
+    def test_series_ids_follow_tags_changed_in_place(self):
+        test_counter = meters.Counter("test_counter")
+        tags = {"a": "1"}
+        test_counter.set_tags(tags)
+        test_counter.increment()
+        tags["a"] = "2"
+        test_counter.increment()
+        meters.GlobalTags.tags["pid"] = "12"
+        test_counter.increment()
+        self.assertEqual(test_counter._count, {(("a", "1"),): 1, (("a", "2"),): 1, (("pid", "12"), ("a", "2")): 1})
+
+    def test_unused_series_ids_are_released_and_reused(self):
+        test_counter = meters.Counter("test_counter")
+        test_counter.increment_many({(("job", "a"),): 1, (("job", "b"),): 2, None: 1})
+        unused_id = meters.TagSets.intern((("job", "b"),))
+        registry.MeterRegistry.drain_all()
+        test_counter.increment_many({(("job", "a"),): 1, None: 1})
+        registry.MeterRegistry.drain_all()
+        generation = meters.TagSets.generation
+        test_counter.increment()
+        # Only the series of job b was not recorded before either of the last two drains.
+        registry.MeterRegistry.drain_all()
+        self.assertGreater(meters.TagSets.generation, generation)
+        self.assertEqual([key in meters.TagSets._ids for key in [(("job", "a"),), (("job", "b"),), ()]],
+                         [True, False, True])
+        self.assertIsNone(meters.TagSets._keys[unused_id])
+        free_ids = set(meters.TagSets._free_ids)
+        self.assertIn(unused_id, free_ids)
+        self.assertIn(meters.TagSets.intern((("job", "c"),)), free_ids)
+        test_counter.increment()
+        test_counter.increment(1, (("job", "c"),))
+        self.assertEqual(test_counter._count, {(): 1, (("job", "c"),): 1})
+
+    def test_series_id_cache_is_cleared_when_series_ids_are_released_or_it_is_full(self):
+        cache = meters.SeriesIdCache(max_size=2)
+        lookups = []
+
+        def factory(key):
+            lookups.append(key)
+            return len(lookups)
+
+        self.assertEqual([cache.get(key, factory) for key in ["a", "b", "a"]], [1, 2, 1])
+        self.assertEqual(cache.get("c", factory), 3)
+        self.assertEqual(cache.get("a", factory), 4)
+        with mock.patch.object(meters.TagSets, "generation", meters.TagSets.generation + 1):
+            self.assertEqual(cache.get("a", factory), 5)
+        self.assertEqual(lookups, ["a", "b", "c", "a", "a"])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.middleware as middleware
+import knotty.registry as registry
+import asyncio
+import flask
+import time
+
+
+class TestMiddleware(unittest.TestCase):
+    def test_wsgi_middleware_tags_flask_requests_by_route_template(self):
+        registry.MeterRegistry._meters = dict()
+        app = flask.Flask("test_app")
+
+        @app.route("/users/<int:user_id>")
+        def get_user(user_id):
+            return str(user_id)
+
+        app.wsgi_app = middleware.WSGIMiddleware(app.wsgi_app, "test_http")
+        client = app.test_client()
+        for path in ("/users/1", "/users/2", "/missing"):
+            client.get(path).close()
+
+        test_timer = registry.MeterRegistry.get_meter("test_http", middleware.meters.Timer)
+        self.assertEqual(test_timer.counter._count,
+                         {(("route", "/users/<int:user_id>"), ("method", "GET"), ("status_code", 200)): 2,
+                          (("route", "unmatched"), ("method", "GET"), ("status_code", 404)): 1})
+        self.assertEqual(set(test_timer.total_time), set(test_timer.counter._count))
+
+    def test_wsgi_middleware_includes_the_body_in_the_total_time(self):
+        registry.MeterRegistry._meters = dict()
+
+        def streaming_app(environ, start_response):
+            start_response("201 Created", [("Content-Type", "text/plain")])
+            time.sleep(.05)
+            yield b"done"
+
+        timed_app = middleware.WSGIMiddleware(streaming_app, "test_http", route_resolver=lambda environ: "/stream")
+        statuses = []
+        body = timed_app({"REQUEST_METHOD": "POST"}, lambda status, headers, exc_info=None: statuses.append(status))
+        self.assertEqual(b"".join(body), b"done")
+        body.close()
+
+        key = (("route", "/stream"), ("method", "POST"), ("status_code", 201))
+        self.assertEqual(statuses, ["201 Created"])
+        self.assertLess(timed_app.headers_timer.total_time[key], 5e7)
+        self.assertGreaterEqual(timed_app.timer.total_time[key], 5e7)
+
+    def test_asgi_middleware_tags_requests_by_route_and_times_the_body(self):
+        registry.MeterRegistry._meters = dict()
+
+        def endpoint():
+            pass
+
+        class Route:
+            def __init__(self):
+                self.path = "/users/{user_id}"
+                self.endpoint = endpoint
+
+        class Router:
+            routes = [Route()]
+
+        async def app(scope, receive, send):
+            if scope["path"] != "/missing":
+                scope["router"] = Router()
+                scope["endpoint"] = endpoint
+            await send({"type": "http.response.start", "status": 200 if scope["path"] != "/missing" else 404})
+            await asyncio.sleep(.05)
+            await send({"type": "http.response.body", "body": b"done"})
+
+        async def send(message):
+            pass
+
+        timed_app = middleware.ASGIMiddleware(app, "test_http")
+        for path in ("/users/1", "/users/2", "/missing"):
+            asyncio.run(timed_app({"type": "http", "method": "GET", "path": path}, None, send))
+
+        found_key = (("route", "/users/{user_id}"), ("method", "GET"), ("status_code", 200))
+        self.assertEqual(timed_app.timer.counter._count,
+                         {found_key: 2, (("route", "unmatched"), ("method", "GET"), ("status_code", 404)): 1})
+        self.assertLess(timed_app.headers_timer.total_time[found_key], 5e7)
+        self.assertGreaterEqual(timed_app.timer.total_time[found_key], 1e8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.persistence as persistence
+import knotty.registry as registry
+import knotty.meters as meters
+import tempfile
+
+
+class TestPersistence(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "knotty.checkpoint")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_checkpoint_file_keeps_the_previous_checkpoint_when_a_write_is_torn(self):
+        checkpoint_file = persistence.CheckpointFile(self.path, initial_capacity=1)
+        self.assertIsNone(checkpoint_file.read())
+        checkpoint_file.write(b"first")
+        checkpoint_file.write(b"second")
+        large = b"x" * 10000
+        checkpoint_file.write(large)
+        checkpoint_file.write(b"third")
+        checkpoint_file.close()
+        self.assertEqual(persistence.CheckpointFile(self.path).read(), b"third")
+
+        # Tear the latest checkpoint, the one before it has to be read instead.
+        checkpoint_file = persistence.CheckpointFile(self.path)
+        slot_offset = persistence._PAGE_SIZE + checkpoint_file._slot * checkpoint_file._capacity
+        checkpoint_file._mmap[slot_offset + persistence._SLOT_HEADER.size] ^= 0xff
+        checkpoint_file.close()
+        self.assertEqual(persistence.CheckpointFile(self.path).read(), large)
+
+    def test_counters_and_timers_survive_a_restart(self):
+        registry.MeterRegistry._meters = dict()
+        registry.MeterRegistry._pending_snapshots = dict()
+        counter = registry.MeterRegistry.get_meter("test_counter", meters.Counter)
+        counter.increment(3)
+        timer = registry.MeterRegistry.get_meter("test_timer", meters.Timer)
+        timer._record((), 1000)
+        registry.MeterRegistry.get_meter("test_gauge", meters.Gauge)
+        checkpointer = persistence.Checkpointer(self.path)
+        checkpointer.checkpoint()
+        checkpointer.checkpoint_file.close()
+
+        registry.MeterRegistry._meters = dict()
+        counter = registry.MeterRegistry.get_meter("test_counter", meters.Counter)
+        counter.increment(1)
+        checkpointer = persistence.Checkpointer(self.path)
+        self.assertEqual(checkpointer.restore(), 2)
+        self.assertEqual(counter._count, {(): 4})
+        self.assertEqual(list(registry.MeterRegistry._meters), [(meters.Counter, "test_counter")])
+
+        # The Timer was not created yet, its snapshot is kept in the next checkpoints until it is.
+        checkpointer.checkpoint()
+        checkpointer.checkpoint_file.close()
+        registry.MeterRegistry._meters = dict()
+        registry.MeterRegistry._pending_snapshots = dict()
+        persistence.Checkpointer(self.path).restore()
+        timer = meters.Timer("test_timer")
+        self.assertEqual((timer.total_time, timer.counter._count), ({(): 1000}, {(): 1}))
+        self.assertEqual(registry.MeterRegistry.get_meter("test_counter", meters.Counter)._count, {(): 4})
+        registry.MeterRegistry._pending_snapshots = dict()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.procfs as procfs
+import knotty.collectors as collectors
+import knotty.registry as registry
+import psutil
+
+
+@unittest.skipUnless(procfs.AVAILABLE, "/proc is only available on Linux")
+class TestProcfs(unittest.TestCase):
+    def test_process_reader_matches_psutil(self):
+        reader = procfs.ProcessReader()
+        process = psutil.Process()
+        self.assertEqual(reader.stat()[0], 0.0)
+        _, memory_percent, thread_count = reader.stat()
+        self.assertEqual(thread_count, process.num_threads())
+        self.assertAlmostEqual(memory_percent, process.memory_percent(), delta=1)
+        self.assertEqual(reader.open_file_count(), len(process.open_files()))
+        memory_info = reader.memory_full_info()
+        self.assertEqual([field for field, _ in memory_info], list(process.memory_full_info()._fields))
+
+    def test_system_reader_matches_psutil(self):
+        reader = procfs.SystemReader()
+        memory = dict(reader.virtual_memory())
+        expected = psutil.virtual_memory()
+        self.assertEqual(list(memory), list(expected._fields))
+        self.assertEqual(memory["total"], expected.total)
+        self.assertEqual([field for field, _ in reader.disk_io_counters()],
+                         ["read_count", "write_count", "read_bytes", "write_bytes", "read_time", "write_time",
+                          "read_merged_count", "write_merged_count", "busy_time"])
+
+    def test_proc_file_grows_its_buffer_to_fit_the_file(self):
+        proc_file = procfs.ProcFile("/proc/self/status", buffer_size=16)
+        self.assertTrue(proc_file.read().startswith(b"Name:"))
+        self.assertIn(b"Threads:", proc_file.read())
+        proc_file.close()
+
+    def test_collectors_produce_the_same_series_with_and_without_procfs(self):
+        series = dict()
+        for use_procfs in (False, True):
+            registry.MeterRegistry._meters = dict()
+            collectors.Collector.use_procfs = use_procfs
+            series[use_procfs] = [(metric.name, metric.tags) for collector in (collectors.ProcessCollector(),
+                                                                               collectors.ProcessResourceCollector(),
+                                                                               collectors.SystemCollector())
+                                  for metric in collector.collect()]
+        collectors.Collector.use_procfs = procfs.AVAILABLE
+        self.assertEqual(series[False], series[True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,8 @@ if lib_dir not in sys.path:
     sys.path.insert(1, lib_dir)
 
 import knotty.registry as registry
+import asyncio
+from unittest import mock
 import knotty.meters as meters
 
 
@@ -37,6 +39,111 @@ class TestRegistry(unittest.TestCase):
                                                                                   prometheus_type='gauge')])
 
 
+    def test_snapshot_all_and_merge_snapshot_recreate_meters(self):
+        registry.MeterRegistry._meters = dict()
+        test_timer = meters.Timer("test_timer")
+        test_timer.record_many([1, 2])
+        meters.Counter("test_counter").increment(3)
+        snapshots = registry.MeterRegistry.snapshot_all()
+        self.assertEqual(len(snapshots), 2)
+        registry.MeterRegistry._meters = dict()
+        for snapshot in snapshots:
+            registry.MeterRegistry.merge_snapshot(snapshot)
+        self.assertEqual(sorted((metric.name, metric.value) for metric in registry.MeterRegistry.get_all_metrics()),
+                         [("test_counter", 3), ("test_timer_time_count", 2), ("test_timer_time_sum", 3.0)])
+
+    def test_filtered_collection_only_runs_matching_meters(self):
+        registry.MeterRegistry._meters = dict()
+        calls = []
+        test_gauge = meters.Gauge("test_gauge")
+        test_gauge.set_gauge_function(lambda: calls.append(1) or {"/": 1}, key_tag="mount_point")
+        meters.Timer("test_timer").record_many([1], tags={"path": "/a"})
+        test_counter = meters.Counter("test_counter")
+        test_counter.increment(1, (("pid", 12),))
+        test_counter.increment(1, (("pid", 13),))
+
+        self.assertEqual(sorted(meter.name for meter in registry.MeterRegistry.find_meters(names=["test_t"])),
+                         ["test_timer", "test_timer_time_count"])
+        actual = registry.MeterRegistry.get_all_metrics(names=["test_timer_time_s"])
+        self.assertEqual([(metric.name, metric.tags) for metric in actual], [("test_timer_time_sum", (("path", "/a"),))])
+        actual = registry.MeterRegistry.get_all_metrics(tags={"pid": "12"})
+        self.assertEqual([(metric.name, metric.value) for metric in actual], [("test_counter", 1)])
+        self.assertEqual(calls, [])
+        actual = registry.MeterRegistry.get_all_metrics(tags={"mount_point": None})
+        self.assertEqual([metric.name for metric in actual], ["test_gauge"])
+        self.assertEqual(calls, [1])
+
+    def test_index_follows_new_series_without_reading_the_meters(self):
+        registry.MeterRegistry._meters = dict()
+        test_counter = meters.Counter("test_counter")
+        test_timer = meters.Timer("test_timer")
+        test_gauge = meters.Gauge("test_gauge")
+        self.assertEqual(registry.MeterRegistry.find_meters(tags={"pid": "12"}), [])
+        test_counter.increment(1, (("pid", 12),))
+        test_timer.record_many([1], tags={"pid": 13})
+        test_gauge.set_gauge_function(lambda: 1)
+        test_gauge.add_tags({"pid": 14})
+        with mock.patch.object(meters.Counter, "series_keys", side_effect=AssertionError), \
+                mock.patch.object(meters.Timer, "series_keys", side_effect=AssertionError):
+            for pid, names in [("12", ["test_counter"]), ("13", ["test_timer", "test_timer_time_count"]),
+                               ("14", ["test_gauge"])]:
+                self.assertEqual(sorted(meter.name for meter in registry.MeterRegistry.find_meters(tags={"pid": pid})),
+                                 names)
+
+    def test_metrics_are_collected_in_batches_on_demand(self):
+        registry.MeterRegistry._meters = dict()
+        meters.Counter("test_counter_a").increment()
+        meters.Timer("test_timer").record_many([1])
+        meters.Counter("test_counter_b").increment()
+        collected = []
+        test_gauge = meters.Gauge("test_gauge")
+        test_gauge.set_gauge_function(lambda: collected.append(1) or 1)
+
+        batches = registry.MeterRegistry.iter_metric_batches(meters_per_batch=2)
+        # The Counter of the Timer is the second meter, the Timer joins it in the first batch.
+        self.assertEqual([batch.name for batch in next(batches)],
+                         ["test_counter_a", "test_timer_time_count", "test_timer_time_sum"])
+        self.assertEqual(collected, [])
+        self.assertEqual([[batch.name for batch in batch_list] for batch_list in batches],
+                         [["test_counter_b", "test_gauge"]])
+        self.assertEqual(collected, [1])
+        filtered = registry.MeterRegistry.iter_metric_batches(names=["test_counter"], meters_per_batch=1)
+        self.assertEqual([[batch.name for batch in batch_list] for batch_list in filtered],
+                         [["test_counter_a"], ["test_counter_b"]])
+        meters.Counter("test_counter_c").increment_many({(("job", "a"),): 1, (("job", "b"),): 2})
+        tagged, = registry.MeterRegistry.iter_metric_batches(names=["test_counter_c"], tags={"job": "b"})
+        self.assertEqual([(batch.keys, list(batch.values)) for batch in tagged], [([(("job", "b"),)], [2])])
+
+        async def collect_all():
+            return [batch async for batch in registry.MeterRegistry.aiter_metric_batches(tags={"missing": None})]
+
+        self.assertEqual(asyncio.run(collect_all()), [])
+
+    def test_index_is_pruned_of_the_series_meters_no_longer_hold(self):
+        registry.MeterRegistry._meters = dict()
+        test_counter = meters.Counter("test_counter")
+        for round_number in range(3):
+            test_counter.increment_many({(("request_id", "{0}-{1}".format(round_number, index)),): 1
+                                         for index in range(2000)})
+            registry.MeterRegistry.drain_all()
+        index = registry.MeterRegistry._index
+        self.assertEqual(len(index._by_tag), 2000)
+        registry.MeterRegistry.drain_all()
+        self.assertEqual((index._by_tag, index._by_tag_key), (dict(), dict()))
+        test_counter.increment(1, (("request_id", "new"),))
+        self.assertEqual([meter.name for meter in registry.MeterRegistry.find_meters(tags={"request_id": "new"})],
+                         ["test_counter"])
+
+    def test_meters_that_share_a_name_are_collected_in_the_same_batch(self):
+        registry.MeterRegistry._meters = dict()
+        meters.Counter("test_shared").increment()
+        meters.Counter("test_other").increment()
+        meters.Gauge("test_shared").set_gauge_function(lambda: 1)
+        batches = registry.MeterRegistry.iter_metric_batches(meters_per_batch=1)
+        self.assertEqual([[(batch.name, batch.prometheus_type) for batch in batch_list] for batch_list in batches],
+                         [[("test_shared", "counter"), ("test_shared", "gauge")], [("test_other", "counter")]])
+
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.remote_write as remote_write
+import knotty.exporters as exporters
+import knotty.registry as registry
+import knotty.meters as meters
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+
+class RemoteWriteReceiver(BaseHTTPRequestHandler):
+    """
+    A stand-in for a remote write endpoint, which decodes every request it receives and answers with the next of its
+    statuses, 204 once they have run out.
+    """
+    statuses = []
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.received.append((dict(self.headers), remote_write.decode_write_request(remote_write.decompress(body))))
+        self.send_response(self.statuses.pop(0) if self.statuses else 204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRemoteWrite(unittest.TestCase):
+    def setUp(self):
+        registry.MeterRegistry._meters = dict()
+        self.receiver = type("receiver", (RemoteWriteReceiver,), {"statuses": [], "received": []})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.receiver)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = "http://127.0.0.1:{0}/api/v1/write".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_snappy_fallback_round_trips_and_compresses(self):
+        for data in [b"", b"a", bytes(range(256)) * 3, b"ab" * 5000, b"label_value " * 100 + bytes(range(70))]:
+            compressed = remote_write._compress(data)
+            self.assertEqual(remote_write._decompress(compressed), data)
+        self.assertLess(len(remote_write._compress(b"ab" * 5000)), 500)
+        # A literal of 3 bytes followed by an overlapping copy of 6 bytes at offset 3.
+        self.assertEqual(remote_write._decompress(b"\x09\x08abc\x09\x03"), b"abcabcabc")
+        self.assertRaises(remote_write.RemoteWriteFormatException, remote_write._decompress, b"\x05\x08abc")
+
+    def test_write_requests_round_trip(self):
+        labels = remote_write.encode_labels("http_requests_total", (("status", 200), ("9-route", "/users/{id}")))
+        other = remote_write.encode_labels("up", ())
+        payload = remote_write.encode_write_request([(labels, 1.0, 1700000000000), (other, 1.0, 1700000000000),
+                                                     (labels, 2.5, 1700000001000)])
+        self.assertEqual(remote_write.decode_write_request(payload),
+                         [([("_9_route", "/users/{id}"), ("__name__", "http_requests_total"), ("status", "200")],
+                           [(1.0, 1700000000000), (2.5, 1700000001000)]),
+                          ([("__name__", "up")], [(1.0, 1700000000000)])])
+
+    def test_exporter_sends_batches_of_samples_from_every_shard(self):
+        test_counter = meters.Counter("test_counter")
+        test_counter.increment_many({(("shard", index),): index for index in range(5)})
+        meters.Gauge("test_gauge").set_gauge_function(lambda: 1.5)
+        exporter = exporters.RemoteWriteExporter(3600, self.endpoint, shards=3, max_samples_per_send=2)
+        self.assertTrue(exporter.close(timeout=5))
+
+        headers = [request[0] for request in self.receiver.received]
+        self.assertTrue(all(header["Content-Encoding"] == "snappy" and header["X-Prometheus-Remote-Write-Version"]
+                            == "0.1.0" for header in headers))
+        series = [time_series for _, request in self.receiver.received for time_series in request]
+        self.assertTrue(all(len(request) <= 2 for _, request in self.receiver.received))
+        samples = {tuple(labels): [value for value, _ in series_samples] for labels, series_samples in series}
+        expected = {(("__name__", "test_counter"), ("shard", str(index))): [index] for index in range(5)}
+        expected[(("__name__", "test_gauge"),)] = [1.5]
+        self.assertEqual(samples, expected)
+        self.assertEqual(exporter.samples_counter._count, {(("result", "sent"),): 6})
+
+    def test_exporter_retries_server_errors_and_drops_rejected_sends(self):
+        meters.Counter("test_counter").increment()
+        exporter = exporters.RemoteWriteExporter(3600, self.endpoint, shards=1, min_backoff=.01)
+        self.receiver.statuses += [503, 429]
+        self.assertTrue(exporter.flush(timeout=5))
+        self.assertEqual(len(self.receiver.received), 3)
+        self.assertEqual(self.receiver.received[0][1], self.receiver.received[2][1])
+        self.assertEqual((exporter.samples_counter._count, exporter.retries_counter._count),
+                         ({(("result", "sent"),): 1}, {(): 2}))
+
+        # The counters of the exporter are sent as well now.
+        self.receiver.statuses.append(400)
+        self.assertTrue(exporter.close(timeout=5))
+        self.assertEqual(len(self.receiver.received), 4)
+        self.assertEqual(exporter.samples_counter._count, {(("result", "sent"),): 1, (("result", "failed"),): 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
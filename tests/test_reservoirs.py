@@ -0,0 +1,102 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.reservoirs as reservoirs
+from unittest import mock
+
+
+class TestReservoirs(unittest.TestCase):
+    def test_recent_values_reservoir_keeps_most_recent_values(self):
+        reservoir = reservoirs.RecentValuesReservoir(3)
+        for value in range(5):
+            reservoir.update(value)
+        self.assertEqual(sorted(reservoir.snapshot()[0]), [2, 3, 4])
+        self.assertIsNone(reservoir.snapshot()[1])
+        self.assertEqual(reservoir.percentiles([50]), [3])
+
+    def test_recent_values_reservoir_switches_to_floats_when_needed(self):
+        reservoir = reservoirs.RecentValuesReservoir(3)
+        reservoir.update(1)
+        self.assertEqual(reservoir.snapshot()[0].dtype.kind, "i")
+        reservoir.update(1.5, weight=2)
+        values, weights = reservoir.snapshot()
+        self.assertEqual(list(values), [1, 1.5])
+        self.assertEqual(list(weights), [1, 2])
+
+    def test_recent_values_reservoir_stores_integers_beyond_int64_as_floats(self):
+        reservoir = reservoirs.RecentValuesReservoir(3)
+        reservoir.update(1)
+        reservoir.update(2 ** 64)
+        self.assertEqual(list(reservoir.snapshot()[0]), [1, 2.0 ** 64])
+        reservoir = reservoirs.RecentValuesReservoir(3)
+        reservoir.update_many([2 ** 63])
+        self.assertEqual(list(reservoir.snapshot()[0]), [2.0 ** 63])
+
+    def test_recent_values_reservoir_update_many_wraps_around(self):
+        reservoir = reservoirs.RecentValuesReservoir(4)
+        reservoir.update_many([1, 2, 3])
+        reservoir.update_many([4, 5, 6], weight=3)
+        values, weights = reservoir.snapshot()
+        self.assertEqual(list(values), [5, 6, 3, 4])
+        self.assertEqual(list(weights), [3, 3, 1, 3])
+        reservoir.update_many(range(10))
+        self.assertEqual(sorted(reservoir.snapshot()[0]), [6, 7, 8, 9])
+
+    def test_recent_values_reservoir_snapshots_are_copies(self):
+        reservoir = reservoirs.RecentValuesReservoir(4)
+        reservoir.update_many([1, 2, 3, 4])
+        values, _ = reservoir.snapshot()
+        reservoir.update_many([5, 6])
+        self.assertEqual(list(values), [1, 2, 3, 4])
+
+    def test_sliding_time_window_reservoir_drops_expired_intervals(self):
+        with mock.patch("knotty.reservoirs.monotonic", return_value=100.0):
+            reservoir = reservoirs.SlidingTimeWindowReservoir(window=10, intervals=5)
+            reservoir.update(1)
+        with mock.patch("knotty.reservoirs.monotonic", return_value=105.0):
+            reservoir.update(2)
+            self.assertEqual(reservoir.snapshot(), ([1, 2], [1.0, 1.0]))
+        with mock.patch("knotty.reservoirs.monotonic", return_value=111.0):
+            self.assertEqual(reservoir.snapshot(), ([2], [1.0]))
+        with mock.patch("knotty.reservoirs.monotonic", return_value=200.0):
+            self.assertEqual(reservoir.snapshot(), ([], []))
+
+    def test_sliding_time_window_reservoir_bounds_interval_size_and_keeps_counts(self):
+        with mock.patch("knotty.reservoirs.monotonic", return_value=100.0):
+            reservoir = reservoirs.SlidingTimeWindowReservoir(window=10, intervals=5, max_values_per_interval=10)
+            for value in range(100):
+                reservoir.update(value)
+            values, weights = reservoir.snapshot()
+        self.assertEqual(len(values), 10)
+        self.assertAlmostEqual(sum(weights), 100)
+
+    def test_exponentially_decaying_reservoir_is_bounded_and_favours_recent_values(self):
+        reservoir = reservoirs.ExponentiallyDecayingReservoir(size=100, alpha=0.1)
+        with mock.patch("knotty.reservoirs.monotonic", return_value=reservoir._landmark):
+            for _ in range(1000):
+                reservoir.update(1000)
+        with mock.patch("knotty.reservoirs.monotonic", return_value=reservoir._landmark + 120):
+            for _ in range(100):
+                reservoir.update(1)
+        self.assertEqual(len(reservoir.snapshot()[0]), 100)
+        self.assertEqual(reservoir.percentiles([50, 99]), [1, 1])
+
+    def test_exponentially_decaying_reservoir_rescales_without_changing_percentiles(self):
+        reservoir = reservoirs.ExponentiallyDecayingReservoir(size=10, rescale_threshold=60)
+        start = reservoir._landmark
+        with mock.patch("knotty.reservoirs.monotonic", return_value=start):
+            for value in range(5):
+                reservoir.update(value)
+        before = reservoir.percentiles([25, 50, 75])
+        with mock.patch("knotty.reservoirs.monotonic", return_value=start + 61):
+            reservoir._rescale(start + 61)
+        self.assertEqual(reservoir._landmark, start + 61)
+        self.assertEqual(reservoir.percentiles([25, 50, 75]), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
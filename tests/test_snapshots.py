@@ -0,0 +1,68 @@
+import unittest
+import os
+import sys
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if lib_dir not in sys.path:
+    sys.path.insert(1, lib_dir)
+
+import knotty.snapshots as snapshots
+import numpy
+
+
+class TestSnapshots(unittest.TestCase):
+    def test_values_survive_a_round_trip(self):
+        writer = snapshots.SnapshotWriter("Counter", "test_counter")
+        writer.write_varint(300)
+        writer.write_number(7)
+        writer.write_number(2.5)
+        writer.write_optional_number(None)
+        writer.write_tags((("path", "/"), ("pid", 12), ("ratio", .5), ("flag", True), ("none", None)))
+        writer.write_array([1.5, 2.5])
+        writer.write_array(numpy.array([3, 4]), dtype=numpy.int64)
+
+        reader = snapshots.SnapshotReader(writer.getvalue())
+        self.assertEqual((reader.meter_type, reader.name), ("Counter", "test_counter"))
+        self.assertEqual(reader.read_varint(), 300)
+        self.assertEqual(reader.read_number(), 7)
+        self.assertEqual(reader.read_number(), 2.5)
+        self.assertIsNone(reader.read_optional_number())
+        self.assertEqual(reader.read_tags(), (("path", "/"), ("pid", 12), ("ratio", .5), ("flag", True),
+                                              ("none", None)))
+        self.assertEqual(list(reader.read_array()), [1.5, 2.5])
+        self.assertEqual(list(reader.read_array(dtype=numpy.int64)), [3, 4])
+        self.assertTrue(reader.exhausted)
+
+    def test_invalid_data_is_rejected(self):
+        self.assertRaises(snapshots.SnapshotFormatException, snapshots.SnapshotReader, b"nope")
+        data = snapshots.SnapshotWriter("Counter", "test_counter").getvalue()
+        self.assertRaises(snapshots.SnapshotFormatException, snapshots.SnapshotReader, data[:-3])
+
+    def test_batches_survive_a_round_trip(self):
+        parts = [snapshots.SnapshotWriter("Counter", "test_counter").getvalue(), b"x" * 300]
+        self.assertEqual(snapshots.unpack_batch(snapshots.pack_batch(parts)), parts)
+        self.assertRaises(snapshots.SnapshotFormatException, snapshots.unpack_batch, parts[0])
+        self.assertRaises(snapshots.SnapshotFormatException, snapshots.unpack_batch, snapshots.pack_batch(parts)[:-1])
+
+    def test_snapshots_are_split_by_series(self):
+        writer = snapshots.SnapshotWriter("LatencyHistogram", "test_histogram")
+        writer.write_varint(2)
+        writer.write_series_count(3)
+        for index in range(3):
+            writer.write_series_key((("series", "x" * 40 * (index + 1)),))
+            writer.write_number(index)
+        self.assertEqual(writer.split(len(writer.getvalue())), [writer.getvalue()])
+        chunks = writer.split(140)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual([len(chunk) <= 140 for chunk in chunks], [True, True, False])
+        series = []
+        for chunk in chunks:
+            reader = snapshots.SnapshotReader(chunk)
+            self.assertEqual((reader.name, reader.read_varint()), ("test_histogram", 2))
+            for _ in range(reader.read_varint()):
+                series.append((len(dict(reader.read_tags())["series"]), reader.read_number()))
+            self.assertTrue(reader.exhausted)
+        self.assertEqual(series, [(40, 0), (80, 1), (120, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()